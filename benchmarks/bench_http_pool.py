@@ -0,0 +1,61 @@
+"""
+Compares TCP connections opened per report between module level requests calls and the pooled per-region session.
+
+Each simulated report does what AmazonAdvertisingApiService does for one report: create, poll status twice and
+download the gzip file.
+
+Usage (from repo root):
+    python -m benchmarks.bench_http_pool --reports 200
+"""
+
+import argparse
+import time
+
+import requests
+
+from benchmarks.stub_amz_server import StubAmazonAdsServer
+from services.amz_advertising.sessions import close_sessions, get_session, get_timeout
+
+
+def run_report_flow(http, base_url, reports):
+    for _ in range(reports):
+        report_id = http.post(f"{base_url}/v2/sp/campaigns/report", json={"reportDate": "20210101"}).json()["reportId"]
+        for _ in range(2):
+            location = http.get(f"{base_url}/v2/reports/{report_id}").json()["location"]
+        http.get(location).content
+
+
+class _SessionClient:
+    def __init__(self, session):
+        self._session = session
+
+    def post(self, url, **kwargs):
+        return self._session.post(url, timeout=get_timeout(), **kwargs)
+
+    def get(self, url, **kwargs):
+        return self._session.get(url, timeout=get_timeout(), **kwargs)
+
+
+def bench(name, http, server, reports):
+    server.reset_counters()
+    start = time.perf_counter()
+    run_report_flow(http, server.base_url, reports)
+    elapsed = time.perf_counter() - start
+    print(
+        f"{name:<16} reports={reports} requests={server.request_count} connections={server.connection_count} "
+        f"connections/report={server.connection_count / reports:.2f} wall={elapsed:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reports", type=int, default=200)
+    args = parser.parse_args()
+
+    server = StubAmazonAdsServer().start()
+    try:
+        bench("requests.<verb>", requests, server, args.reports)
+        bench("pooled session", _SessionClient(get_session("NA")), server, args.reports)
+    finally:
+        close_sessions()
+        server.stop()
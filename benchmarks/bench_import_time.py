@@ -0,0 +1,40 @@
+"""
+Measures cold import time of the Amazon Advertising service module (what every Cloud Function cold start pays before
+handling its first request) in fresh interpreters.
+
+Usage (from repo root):
+    python -m benchmarks.bench_import_time --runs 10
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULE = "services.amz_advertising.amz_advertising"
+
+
+def time_import(module):
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, "-c", f"import {module}"], capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{proc.stderr}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--module", default=MODULE)
+    args = parser.parse_args()
+
+    baseline = [time_import("config") for _ in range(args.runs)]
+    timings = [time_import(args.module) for _ in range(args.runs)]
+    print(f"interpreter + config: median={statistics.median(baseline) * 1000:.0f}ms")
+    print(
+        f"{args.module}: median={statistics.median(timings) * 1000:.0f}ms "
+        f"min={min(timings) * 1000:.0f}ms max={max(timings) * 1000:.0f}ms runs={args.runs}"
+    )
@@ -0,0 +1,50 @@
+"""
+Compares the two bq_load_json_list upload payloads on synthetic SP targets rows: newline delimited json
+(load_format="json") vs snappy parquet built from schema typed arrow batches (load_format="parquet").
+Reports serialization time and the number of bytes that would be uploaded to BigQuery.
+
+Usage (from repo root):
+    python -m benchmarks.bench_load_format --rows 200000
+"""
+
+import argparse
+import os
+import time
+
+from benchmarks.bench_normalizer import schema_for
+from benchmarks.bench_report_stream import synthetic_row
+from utils.bq import write_ndjson_temp_file
+from utils.bq_arrow import write_parquet_temp_file
+from utils.bq_rows import get_row_normalizer
+
+
+def rows(count):
+    for i in range(count):
+        yield dict(synthetic_row(i), date="2021-06-01")
+
+
+def bench(name, serialize):
+    start = time.perf_counter()
+    payload = serialize()
+    elapsed = time.perf_counter() - start
+    payload.seek(0, os.SEEK_END)
+    size_mb = payload.tell() / 1024 / 1024
+    payload.close()
+    print(f"{name:<8} time={elapsed:.2f}s payload={size_mb:.1f}MB")
+    return elapsed, size_mb
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200_000)
+    args = parser.parse_args()
+
+    schema = schema_for(dict(synthetic_row(0), date="2021-06-01"))
+    schema[-1]["type"] = "DATE"
+
+    print(f"rows={args.rows}")
+    json_time, json_size = bench(
+        "json", lambda: write_ndjson_temp_file(get_row_normalizer(schema).normalize_all(rows(args.rows)))
+    )
+    parquet_time, parquet_size = bench("parquet", lambda: write_parquet_temp_file(rows(args.rows), schema))
+    print(f"parquet vs json: time {parquet_time / json_time:.2f}x, payload {parquet_size / json_size:.2f}x")
@@ -0,0 +1,82 @@
+"""
+Throughput of turning downloaded reports into BigQuery load files, in-thread (iter_report_rows + RowNormalizer +
+newline delimited json on the downloading threads, as without REPORT_PARSE_PROCESSES) vs on a ReportParsePool of
+1, 2, 4... processes, on synthetic SP targets reports.
+
+Each report is "downloaded" by its own thread reading the gzip file in AMZ_REPORT_DOWNLOAD_CHUNK_SIZE chunks, like
+the threads of a report worker. In-thread parsing is bound by the GIL and stays at about one core whatever the
+thread count, the pool scales with the number of vCPUs (run it on a multi vCPU instance, nproc caps the speedup).
+
+Usage (from repo root):
+    python -m benchmarks.bench_parallel_parse --reports 8 --mb 25 --processes 1 2 4 8
+"""
+
+import argparse
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+from benchmarks.bench_report_stream import write_synthetic_report
+from services.amz_advertising.report_registry import get_report_definition
+from services.amz_advertising.report_stream import iter_report_rows
+from utils.bq_rows import get_row_normalizer, write_ndjson_gzip
+from utils.parse_pool import ReportParsePool
+
+CHUNK_SIZE = config.AMZ_REPORT_DOWNLOAD_CHUNK_SIZE
+
+
+def read_chunks(path):
+    with open(path, "rb") as f:
+        yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+
+
+def parse_in_thread(path, schema):
+    rows = (dict(row, date="2021-03-04") for row in iter_report_rows(read_chunks(path)))
+    with tempfile.TemporaryFile() as load_file:
+        write_ndjson_gzip(get_row_normalizer(schema).normalize_all(rows), load_file)
+
+
+def parse_on_pool(pool, path, schema):
+    pool.parse(read_chunks(path), schema, "2021-03-04", "json").discard()
+
+
+def bench(label, parse, paths, json_mb):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(paths)) as executor:
+        list(executor.map(parse, paths))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<22} {elapsed:6.1f}s {json_mb / elapsed:7.1f} MB/s of json")
+    return elapsed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--reports", type=int, default=8)
+    parser.add_argument("--mb", type=int, default=25, help="uncompressed json size of each report")
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    schema = get_report_definition("sp", "targets", None, None).schema_fields
+    print(f"{os.cpu_count()} cpus, {args.reports} reports of {args.mb}MB json")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
+        for i in range(args.reports):
+            paths.append(os.path.join(tmp_dir, f"report_{i}.json.gz"))
+            write_synthetic_report(paths[-1], args.mb)
+        json_mb = args.reports * args.mb
+
+        baseline = bench("in-thread", lambda path: parse_in_thread(path, schema), paths, json_mb)
+        for processes in args.processes:
+            pool = ReportParsePool(processes, CHUNK_SIZE, config.REPORT_PARSE_SLOTS)
+            try:
+                # Start the worker processes before timing
+                parse_on_pool(pool, paths[0], schema)
+                elapsed = bench(
+                    f"pool, {processes} processes", lambda path: parse_on_pool(pool, path, schema), paths, json_mb
+                )
+            finally:
+                pool.close()
+            print(f"{'':<22} {baseline / elapsed:.2f}x in-thread")
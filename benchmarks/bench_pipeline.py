@@ -0,0 +1,147 @@
+"""
+End to end throughput of the function, offline: main.main GET creates the reports of every account and report type on
+a local StubAmazonAdsServer and dispatches the report tasks to a fake Cloud Tasks queue, then the captured task bodies
+are replayed as concurrent main.main POSTs (re-enqueued tasks included) that wait for, download, parse and load the
+reports into a fake BigQuery client.
+
+Reports reports/s, rows/s, the latency percentiles of the report tasks, the peak Python heap (tracemalloc) and peak
+RSS, and the requests the stub received per endpoint (429s included), so regressions in the hot paths of dispatch,
+download, parse and load are measurable without network access. Run it before and after a change with the same
+arguments.
+
+Usage (from repo root):
+    python -m benchmarks.bench_pipeline --backfill-days 3 --rows 5000 --concurrency 8
+    python -m benchmarks.bench_pipeline --backfill-days 7 --batch-days 7 --throttle-every 20 --latency-ms 20
+"""
+
+import argparse
+import logging
+import resource
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import flask
+
+import config
+import main
+from benchmarks.fake_gcp import (
+    FakeBigQueryClient,
+    FakeCloudTasksClient,
+    offline_services,
+)
+from benchmarks.stub_amz_server import StubAmazonAdsServer, build_profiles
+
+app = flask.Flask(__name__)
+
+
+def dispatch(query_string):
+    with app.test_request_context("/", method="GET", query_string=query_string):
+        response = main.main(flask.request)
+    if response.status_code != 200:
+        raise Exception(f"Dispatch failed: {response.get_data(as_text=True)}")
+    return response.get_data(as_text=True)
+
+
+def run_task(payload):
+    """Returns (seconds, status code, number of reports) of one report task POST"""
+    started_at = time.perf_counter()
+    with app.test_request_context("/", method="POST", json=payload):
+        response = main.make_response(main.main(flask.request))
+    reports = len(payload.get("specific_requests") or [payload.get("specific_request")])
+    return time.perf_counter() - started_at, response.status_code, reports
+
+
+def run_tasks(tasks_client, concurrency, max_rounds):
+    """Replays the queued tasks round after round (re-enqueued tasks are the next round) until the queue is empty"""
+    results = []
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(max_rounds):
+            payloads = tasks_client.pop_payloads()
+            if not payloads:
+                break
+            results.extend(executor.map(run_task, payloads))
+    return results
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))] if values else 0.0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backfill-days", type=int, default=2)
+    parser.add_argument("--batch-days", type=int, default=1)
+    parser.add_argument("--collect", action="store_true", help="one collector task per region instead of per batch")
+    parser.add_argument("--rows", type=int, default=1000, help="rows per report")
+    parser.add_argument("--concurrency", type=int, default=8, help="report tasks run at the same time")
+    parser.add_argument("--latency-ms", type=float, default=0, help="latency of every stub API request")
+    parser.add_argument("--generation-seconds", type=float, default=0, help="seconds a report stays IN_PROGRESS")
+    parser.add_argument("--throttle-every", type=int, default=0, help="answer every n-th API request with a 429")
+    parser.add_argument("--rate-limit-rps", type=float, default=1000, help="client side AMZ_RATE_LIMIT_RPS")
+    parser.add_argument("--load-format", choices=["json", "parquet"], default=config.BQ_LOAD_FORMAT)
+    parser.add_argument("--max-rounds", type=int, default=50)
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logging.getLogger().setLevel(args.log_level)
+
+    server = StubAmazonAdsServer(
+        rows_per_report=args.rows,
+        profiles=build_profiles(main.ACCOUNTS),
+        generation_seconds=args.generation_seconds,
+        latency=args.latency_ms / 1000,
+        throttle_every=args.throttle_every,
+    ).start()
+    tasks_client = FakeCloudTasksClient()
+    bq_client = FakeBigQueryClient()
+
+    try:
+        with offline_services(server, tasks_client, bq_client, rate_limit_rps=args.rate_limit_rps):
+            tracemalloc.start()
+            started_at = time.perf_counter()
+            print(
+                dispatch(
+                    {
+                        "target_project": bq_client.project,
+                        "target_dataset": "bench",
+                        "backfill_days": args.backfill_days,
+                        "batch_days": args.batch_days,
+                        "collect": str(args.collect).lower(),
+                    }
+                )
+            )
+            dispatch_seconds = time.perf_counter() - started_at
+            dispatch_requests = dict(server.request_counts)
+
+            with mock.patch.object(config, "BQ_LOAD_FORMAT", args.load_format):
+                results = run_tasks(tasks_client, args.concurrency, args.max_rounds)
+            elapsed = time.perf_counter() - started_at
+            _, peak_heap = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    finally:
+        server.stop()
+
+    task_seconds = [seconds for seconds, _, _ in results]
+    reports = sum(report_count for _, status, report_count in results if status == 200)
+    failed = sum(1 for _, status, _ in results if status != 200)
+    rows = sum(load.rows for load in bq_client.loads)
+
+    print(f"dispatch        {dispatch_seconds:.2f}s requests={dispatch_requests}")
+    print(
+        f"tasks           {len(results)} ({failed} failed) reports={reports} loads={len(bq_client.loads)} rows={rows}"
+    )
+    print(f"throughput      {reports / elapsed:.1f} reports/s {rows / elapsed:.0f} rows/s wall={elapsed:.2f}s")
+    print(
+        f"task latency    p50={percentile(task_seconds, 50):.3f}s p90={percentile(task_seconds, 90):.3f}s "
+        f"p99={percentile(task_seconds, 99):.3f}s"
+    )
+    print(
+        f"memory          heap_peak={peak_heap / 2 ** 20:.1f}MB "
+        f"max_rss={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB"
+    )
+    print(
+        f"stub requests   total={server.request_count} throttled={server.throttled_count} "
+        f"connections={server.connection_count} {dict(server.request_counts)}"
+    )
@@ -0,0 +1,126 @@
+"""
+Peak RSS of processing a downloaded report, buffered (the old _download_report: full content, gzip.decompress,
+json.loads, formatted list) vs streamed (iter_report_rows over 1MB chunks into a gzip newline delimited json temp
+file, as bq_load_json_list uploads it), on synthetic SP targets sized reports.
+
+Every measurement runs in a fresh interpreter so ru_maxrss is per run. The size of the load file is reported next
+to it: it spills to /tmp, which ru_maxrss doesn't count but which is memory on Cloud Functions.
+
+Usage (from repo root):
+    python -m benchmarks.bench_report_stream --mb 50 100 200 400
+"""
+
+import argparse
+import gzip
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def synthetic_row(i):
+    row = {
+        "campaignName": f"Campaign {i % 500}",
+        "campaignId": 200000000000000 + i % 500,
+        "adGroupName": f"Ad Group {i % 5000}",
+        "adGroupId": 300000000000000 + i % 5000,
+        "targetId": 400000000000000 + i,
+        "targetingExpression": f'asin="B0{i:08d}"',
+        "targetingText": f"asin=B0{i:08d}",
+        "targetingType": "TARGETING_EXPRESSION",
+        "impressions": i % 1000,
+        "clicks": i % 37,
+        "cost": (i % 1000) * 0.37,
+    }
+    for window in (1, 7, 14, 30):
+        row[f"attributedConversions{window}d"] = i % (window + 3)
+        row[f"attributedSales{window}d"] = (i % 211) * 1.13
+        row[f"attributedUnitsOrdered{window}d"] = i % (window + 2)
+    return row
+
+
+def write_synthetic_report(path, target_mb):
+    target_bytes = target_mb * 1024 * 1024
+    written = 0
+    i = 0
+    with gzip.open(path, "wb", compresslevel=1) as f:
+        f.write(b"[")
+        while written < target_bytes:
+            line = (b"," if i else b"") + json.dumps(synthetic_row(i)).encode()
+            f.write(line)
+            written += len(line)
+            i += 1
+        f.write(b"]")
+    return i
+
+
+def run_buffered(path):
+    from utils.bq import file_size, format_list_of_dicts_for_bq, write_ndjson_temp_file
+
+    with open(path, "rb") as f:
+        content = f.read()
+    report = json.loads(gzip.decompress(content))
+    rows = format_list_of_dicts_for_bq(report)
+    with write_ndjson_temp_file(rows) as load_file:
+        return len(rows), file_size(load_file)
+
+
+def run_streaming(path):
+    from services.amz_advertising.report_stream import iter_report_rows
+    from utils.bq import file_size, format_dict_for_bq, write_ndjson_temp_file
+
+    count = 0
+
+    def rows():
+        nonlocal count
+        with open(path, "rb") as f:
+            for row in iter_report_rows(iter(lambda: f.read(CHUNK_SIZE), b"")):
+                count += 1
+                yield format_dict_for_bq(row)
+
+    with write_ndjson_temp_file(rows()) as load_file:
+        return count, file_size(load_file)
+
+
+def child(mode, path):
+    start = time.perf_counter()
+    rows, load_file_bytes = {"buffered": run_buffered, "streaming": run_streaming}[mode](path)
+    elapsed = time.perf_counter() - start
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    load_file_mb = load_file_bytes / 1024 / 1024
+    print(json.dumps({"rows": rows, "seconds": elapsed, "peak_rss_mb": peak_mb, "load_file_mb": load_file_mb}))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mb", type=int, nargs="+", default=[50, 100, 200])
+    parser.add_argument("--child", nargs=2, metavar=("MODE", "PATH"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size_mb in args.mb:
+            path = os.path.join(tmp_dir, f"report_{size_mb}mb.json.gz")
+            rows = write_synthetic_report(path, size_mb)
+            compressed_mb = os.path.getsize(path) / 1024 / 1024
+            for mode in ("buffered", "streaming"):
+                out = subprocess.run(
+                    [sys.executable, "-m", "benchmarks.bench_report_stream", "--child", mode, path],
+                    capture_output=True,
+                    text=True,
+                    check=True,
+                )
+                result = json.loads(out.stdout.strip().splitlines()[-1])
+                print(
+                    f"{size_mb:>5}MB json ({compressed_mb:.0f}MB gz, {rows} rows) {mode:<10} "
+                    f"peak_rss={result['peak_rss_mb']:.0f}MB load_file={result['load_file_mb']:.0f}MB "
+                    f"time={result['seconds']:.1f}s"
+                )
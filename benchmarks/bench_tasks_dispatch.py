@@ -0,0 +1,48 @@
+"""
+Compares enqueuing report tasks one synchronous create_task RPC at a time (the previous dispatch_standard_task loop)
+with create_tasks, which keeps a bounded window of create_task calls in flight on the shared client.
+
+The Cloud Tasks client is replaced by a fake with a fixed per RPC latency, so the benchmark runs offline.
+
+Usage (from repo root):
+    python -m benchmarks.bench_tasks_dispatch --tasks 2000 --latency-ms 40
+"""
+
+import argparse
+import time
+from unittest import mock
+
+from benchmarks.fake_gcp import FakeCloudTasksClient
+from utils import tasks
+from utils.tasks import build_http_task, create_tasks
+
+
+def build_tasks(count):
+    return [
+        build_http_task("https://example.com", "sa@example.com", f"queue/tasks/report-{i}", 1800, {"i": i}, delay=600)
+        for i in range(count)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    parser.add_argument("--in-flight", type=int, default=32)
+    args = parser.parse_args()
+
+    client = FakeCloudTasksClient(latency=args.latency_ms / 1000)
+    start = time.perf_counter()
+    for task in build_tasks(args.tasks):
+        client.create_task(parent="queue", task=task)
+    sequential = time.perf_counter() - start
+    print(f"sequential   tasks={args.tasks} time={sequential:.2f}s")
+
+    with mock.patch.object(tasks, "_tasks_client", FakeCloudTasksClient(latency=args.latency_ms / 1000)):
+        start = time.perf_counter()
+        outcomes = create_tasks("queue", build_tasks(args.tasks), max_in_flight=args.in_flight)
+        bulk = time.perf_counter() - start
+        assert all(outcome.ok for outcome in outcomes)
+        print(f"create_tasks tasks={args.tasks} time={bulk:.2f}s in_flight={args.in_flight}")
+
+    print(f"speedup: {sequential / bulk:.1f}x")
@@ -0,0 +1,229 @@
+"""
+In-memory stand-ins for the Cloud Tasks and BigQuery clients, and offline_services(), which points the whole pipeline
+(Amazon API and token urls, credentials, Cloud Tasks, BigQuery) at a StubAmazonAdsServer and these fakes, so main.main
+can be driven end to end without network access or GCP credentials.
+
+The fakes only implement the calls the pipeline makes. Load files are read and their rows counted (newline delimited
+json lines, gzip compressed or not, parquet row groups), nothing is stored.
+"""
+
+import gzip
+import io
+import json
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from typing import NamedTuple, Optional
+from unittest import mock
+
+import pyarrow.parquet as pq
+from google.api_core import exceptions
+from google.cloud import bigquery
+
+import config
+from services.amz_advertising import rate_limit
+from services.amz_advertising.credentials import (
+    ENV_VAR_AMZ_CREDENTIALS_JSON,
+    amz_credentials_provider,
+)
+from services.amz_advertising.profiles import profile_index
+from services.amz_advertising.readiness import report_readiness
+from services.amz_advertising.report_cache import report_request_coalescer
+from services.amz_advertising.token_cache import access_token_cache
+from utils import bq, tasks
+
+STUB_CREDENTIALS = {"client_id": "stub-client-id", "client_secret": "stub-client-secret", "refresh_token": "stub"}
+
+
+class FakeCloudTasksClient:
+    """
+    Keeps the created tasks, a task name created twice (or in existing) raises AlreadyExists like Cloud Tasks.
+    Task names in failing raise InternalServerError, each create_task call takes latency seconds and the peak number
+    of concurrent calls is kept in max_in_flight.
+    """
+
+    def __init__(self, existing=(), failing=(), latency=0.0):
+        self.tasks = []
+        self.failing = set(failing)
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._names = set(existing)
+        self._lock = threading.Lock()
+
+    def queue_path(self, project, location, queue):
+        return f"projects/{project}/locations/{location}/queues/{queue}"
+
+    def create_task(self, parent, task):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.latency)
+            with self._lock:
+                if task.get("name") in self._names:
+                    raise exceptions.AlreadyExists(f"Task {task['name']} already exists")
+                if task.get("name") in self.failing:
+                    raise exceptions.InternalServerError(f"Could not create task {task['name']}")
+                self._names.add(task.get("name"))
+                self.tasks.append(task)
+            return mock.Mock(name=task.get("name"))
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def pop_payloads(self):
+        """Json bodies of the tasks created since the last call, in creation order"""
+        with self._lock:
+            created, self.tasks = self.tasks, []
+        return [json.loads(task["http_request"]["body"]) for task in created]
+
+
+class BigQueryLoad(NamedTuple):
+    table_id: str
+    partition: Optional[str]
+    rows: int
+    bytes: int
+
+
+class BigQueryQuery(NamedTuple):
+    query: str
+    job_config: Optional[bigquery.QueryJobConfig]
+
+
+class FakeJob:
+    def __init__(self, output_rows=None):
+        self.output_rows = output_rows
+        self.errors = None
+        self.job_id = f"fake-job-{id(self):x}"
+
+    def result(self, *args, **kwargs):
+        return self
+
+
+class FakeBigQueryClient:
+    """
+    Tables are created by create_table and loads, get_table raises NotFound for the others. Loads, queries (with their
+    job config) and deleted table ids are recorded.
+    """
+
+    def __init__(self, project="offline"):
+        self.project = project
+        self.tables = {}
+        self.loads = []
+        self.queries = []
+        self.deleted_tables = []
+        self._lock = threading.Lock()
+
+    def dataset(self, dataset_id):
+        return bigquery.DatasetReference(self.project, dataset_id)
+
+    def get_table(self, table):
+        table_id = _table_id(table)
+        with self._lock:
+            if table_id not in self.tables:
+                raise exceptions.NotFound(f"Not found: Table {table_id}")
+            return self.tables[table_id]
+
+    def create_table(self, table, exists_ok=False, **kwargs):
+        table_id = _table_id(table)
+        with self._lock:
+            if table_id in self.tables and not exists_ok:
+                raise exceptions.Conflict(f"Already Exists: Table {table_id}")
+            return self.tables.setdefault(table_id, table)
+
+    def delete_table(self, table, not_found_ok=False, **kwargs):
+        table_id = _table_id(table)
+        with self._lock:
+            self.deleted_tables.append(table_id)
+            if self.tables.pop(table_id, None) is None and not not_found_ok:
+                raise exceptions.NotFound(f"Not found: Table {table_id}")
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, rewind=False, **kwargs):
+        if rewind:
+            file_obj.seek(0)
+        data = file_obj.read()
+        if job_config is not None and job_config.source_format == bigquery.SourceFormat.PARQUET:
+            rows = pq.read_metadata(io.BytesIO(data)).num_rows
+        else:
+            lines = gzip.decompress(data) if data[:2] == b"\x1f\x8b" else data
+            rows = sum(1 for line in lines.splitlines() if line.strip())
+
+        table_id, _, partition = _table_id(destination).partition("$")
+        with self._lock:
+            self.tables.setdefault(table_id, bigquery.Table(table_id))
+            self.loads.append(BigQueryLoad(table_id, partition or None, rows, len(data)))
+        return FakeJob(output_rows=rows)
+
+    def query(self, query, job_config=None, **kwargs):
+        with self._lock:
+            self.queries.append(BigQueryQuery(query, job_config))
+        return FakeJob()
+
+    def insert_rows_json(self, table, json_rows, **kwargs):
+        return []
+
+
+def _table_id(table):
+    if isinstance(table, str):
+        return table
+    return f"{table.project}.{table.dataset_id}.{table.table_id}"
+
+
+class _AllProjects(dict):
+    """_bq_clients stand-in returning the same client for every project"""
+
+    def __init__(self, bq_client):
+        super().__init__()
+        self.bq_client = bq_client
+
+    def get(self, project_id, default=None):
+        return self.bq_client
+
+
+def _clear_process_caches():
+    amz_credentials_provider.invalidate()
+    access_token_cache.clear()
+    profile_index.clear()
+    report_request_coalescer.clear()
+    bq.table_cache.clear()
+
+
+@contextmanager
+def offline_services(server, tasks_client, bq_client, rate_limit_rps=1000.0):
+    """
+    Points the Amazon API of every region and the token endpoint at the stub server and the Cloud Tasks and BigQuery
+    clients at the fakes for the duration of the block. The process wide caches (token, profiles, report ids,
+    tables, rate limit buckets) are emptied before and after, so nothing leaks in from or out to real services.
+    Report status polls are spaced for the generation time of the stub instead of Amazon's minutes.
+    """
+    api_url = f"{server.base_url}/v2"
+    min_poll_seconds = max(server.generation_seconds / 10, 0.01)
+    with ExitStack() as stack:
+        stack.enter_context(
+            mock.patch.multiple(
+                config,
+                AMZ_API_URLS={region: api_url for region in config.AMZ_API_URLS},
+                AMZ_AUTH_URL=f"{server.base_url}/auth/o2/token",
+                AMZ_RATE_LIMIT_RPS=rate_limit_rps,
+                AMZ_RATE_LIMIT_BURST=rate_limit_rps,
+            )
+        )
+        stack.enter_context(mock.patch.dict("os.environ", {ENV_VAR_AMZ_CREDENTIALS_JSON: json.dumps(STUB_CREDENTIALS)}))
+        stack.enter_context(mock.patch.object(tasks, "_tasks_client", tasks_client))
+        stack.enter_context(mock.patch.object(bq, "_bq_clients", _AllProjects(bq_client)))
+        stack.enter_context(mock.patch.dict(rate_limit._buckets, clear=True))
+        stack.enter_context(
+            mock.patch.multiple(
+                report_readiness,
+                default_seconds=server.generation_seconds,
+                min_poll_seconds=min_poll_seconds,
+                max_poll_seconds=max(server.generation_seconds, min_poll_seconds),
+                _stats={},
+                _updates=set(),
+                synced_at=0.0,
+            )
+        )
+        stack.callback(_clear_process_caches)
+        _clear_process_caches()
+        yield
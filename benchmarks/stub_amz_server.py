@@ -0,0 +1,214 @@
+"""
+Local stand-in for the Amazon Advertising API used by the benchmarks in this folder and the end to end tests.
+
+Serves the LWA token endpoint, profiles, report creation, report status and gzip report download over plain HTTP/1.1
+with keep-alive, and counts the TCP connections and requests (per endpoint) it receives so benchmarks can compare
+client behaviour. Reports stay IN_PROGRESS for generation_seconds after their creation, every throttle_every-th
+request is answered with a 429 and every request can be delayed by latency seconds.
+"""
+
+import gzip
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubAmazonAdsServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        rows_per_report=100,
+        profiles=(),
+        generation_seconds=0.0,
+        latency=0.0,
+        throttle_every=0,
+        retry_after=0,
+    ):
+        """
+        profiles: profile dicts as returned by GET /profiles ({"profileId", "countryCode", "accountInfo": {"id"}})
+        throttle_every: answer every n-th API request (not token requests) with 429 and Retry-After: retry_after
+        """
+        super().__init__((host, port), _StubHandler)
+        self.rows_per_report = rows_per_report
+        self.profiles = list(profiles)
+        self.generation_seconds = generation_seconds
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.connection_count = 0
+        self.request_count = 0
+        self.request_counts = Counter()
+        self.throttled_count = 0
+        self._counter_lock = threading.Lock()
+        # Report ids are unique across stub instances, so the disk report cache never serves a previous run's report
+        self._report_id_prefix = f"amzn1.clicksAPI.v1.{uuid.uuid4().hex[:8]}"
+        self._report_ids = itertools.count(1)
+        self._created_at = {}
+        self._report_payload = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections are expected, not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def reset_counters(self):
+        with self._counter_lock:
+            self.connection_count = 0
+            self.request_count = 0
+            self.request_counts.clear()
+            self.throttled_count = 0
+
+    def count_connection(self):
+        with self._counter_lock:
+            self.connection_count += 1
+
+    def count_request(self, endpoint="other"):
+        """Counts the request, returns whether it must be throttled"""
+        with self._counter_lock:
+            self.request_count += 1
+            self.request_counts[endpoint] += 1
+            throttle = (
+                bool(self.throttle_every) and endpoint != "token" and self.request_count % self.throttle_every == 0
+            )
+            if throttle:
+                self.throttled_count += 1
+            return throttle
+
+    def next_report_id(self):
+        report_id = f"{self._report_id_prefix}.{next(self._report_ids)}"
+        self._created_at[report_id] = time.monotonic()
+        return report_id
+
+    def report_status(self, report_id):
+        created_at = self._created_at.get(report_id)
+        if created_at is not None and time.monotonic() - created_at < self.generation_seconds:
+            return "IN_PROGRESS"
+        return "SUCCESS"
+
+    def build_report(self, report_id):
+        # Every report has the same rows, compress them once
+        if self._report_payload is None:
+            rows = [
+                {
+                    "campaignId": 100000000000000 + i,
+                    "campaignName": f"Campaign {i}",
+                    "impressions": i * 3,
+                    "cost": i * 0.1,
+                }
+                for i in range(self.rows_per_report)
+            ]
+            self._report_payload = gzip.compress(json.dumps(rows).encode())
+        return self._report_payload
+
+
+def build_profiles(accounts):
+    """One profile per account of main.ACCOUNTS ({"country_code", "account_id"}), in the /profiles response format"""
+    return [
+        {
+            "profileId": 1000 + i,
+            "countryCode": account["country_code"],
+            "accountInfo": {"id": account["account_id"], "type": "seller"},
+        }
+        for i, account in enumerate(accounts)
+    ]
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count_connection()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.endswith("/profiles"):
+            if not self._accept("profiles"):
+                return
+            return self._send_json(200, self.server.profiles)
+
+        match = re.match(r".*/reports/([^/]+)/download$", path)
+        if match:
+            if not self._accept("download"):
+                return
+            return self._send(200, self.server.build_report(match.group(1)), "application/octet-stream")
+
+        match = re.match(r".*/reports/([^/]+)$", path)
+        if match:
+            if not self._accept("report_status"):
+                return
+            report_id = match.group(1)
+            return self._send_json(
+                200,
+                {
+                    "reportId": report_id,
+                    "status": self.server.report_status(report_id),
+                    "location": f"{self.server.base_url}/v2/reports/{report_id}/download",
+                },
+            )
+        self.server.count_request()
+        return self._send_json(404, {"code": "NOT_FOUND"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.rfile.read(length)
+        path = self.path.split("?")[0]
+        if path.endswith("/auth/o2/token"):
+            if not self._accept("token"):
+                return
+            return self._send_json(200, {"access_token": "stub-access-token", "expires_in": 3600})
+        if path.endswith("/report"):
+            if not self._accept("create_report"):
+                return
+            return self._send_json(202, {"reportId": self.server.next_report_id(), "status": "IN_PROGRESS"})
+        self.server.count_request()
+        return self._send_json(404, {"code": "NOT_FOUND"})
+
+    def _accept(self, endpoint):
+        """Counts the request and applies latency and throttling, False if it was answered with a 429"""
+        throttle = self.server.count_request(endpoint)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if throttle:
+            self._send(429, b'{"code": "THROTTLED"}', "application/json", {"Retry-After": str(self.server.retry_after)})
+            return False
+        return True
+
+    def _send_json(self, status, body):
+        return self._send(status, json.dumps(body).encode(), "application/json")
+
+    def _send(self, status, payload, content_type, headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
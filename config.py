@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 import yaml
 
@@ -36,3 +37,120 @@ GAE_SERVICE_PRECIS_CENTRAL_CLIENT_ID = PROJECT_CONFIG["GAE_SERVICE_PRECIS_CENTRA
 
 # Other project constants below
 ROLLBAR_TOKEN = PROJECT_CONFIG["ROLLBAR_TOKEN"]
+
+# Amazon Advertising API HTTP client, shared connection pools per region
+AMZ_HTTP_POOL_SIZE = int(os.environ.get("AMZ_HTTP_POOL_SIZE", 20))
+AMZ_HTTP_CONNECT_TIMEOUT = float(os.environ.get("AMZ_HTTP_CONNECT_TIMEOUT", 10))
+AMZ_HTTP_READ_TIMEOUT = float(os.environ.get("AMZ_HTTP_READ_TIMEOUT", 300))
+
+# GET dispatcher fan-out, total worker threads and maximum concurrent report creations per Amazon region
+DISPATCH_MAX_WORKERS = int(os.environ.get("DISPATCH_MAX_WORKERS", 16))
+DISPATCH_REGION_CONCURRENCY = int(os.environ.get("DISPATCH_REGION_CONCURRENCY", 4))
+# Share of the dispatcher's report creations each region gets when several have reports pending ("EU=2,NA=1"),
+# regions not listed weigh 1
+DISPATCH_REGION_WEIGHTS = {
+    region.strip(): float(weight)
+    for region, weight in (
+        item.split("=") for item in os.environ.get("DISPATCH_REGION_WEIGHTS", "").split(",") if item.strip()
+    )
+}
+
+# Maximum concurrent create_task RPCs when enqueuing Cloud Tasks in bulk
+TASKS_MAX_IN_FLIGHT = int(os.environ.get("TASKS_MAX_IN_FLIGHT", 32))
+
+# Amazon Advertising API rate limiting, token bucket per region/profile and backoff on 429s
+AMZ_RATE_LIMIT_RPS = float(os.environ.get("AMZ_RATE_LIMIT_RPS", 5))
+AMZ_RATE_LIMIT_BURST = float(os.environ.get("AMZ_RATE_LIMIT_BURST", 10))
+AMZ_BACKOFF_BASE_SECONDS = float(os.environ.get("AMZ_BACKOFF_BASE_SECONDS", 2))
+AMZ_BACKOFF_CAP_SECONDS = float(os.environ.get("AMZ_BACKOFF_CAP_SECONDS", 60))
+AMZ_MAX_ATTEMPTS = int(os.environ.get("AMZ_MAX_ATTEMPTS", 10))
+
+# Amazon Advertising API and token endpoints, overridable (e.g. with a local stub API for offline benchmarks)
+AMZ_API_URLS = {
+    "EU": os.environ.get("AMZ_API_URL_EU", "https://advertising-api-eu.amazon.com/v2"),
+    "NA": os.environ.get("AMZ_API_URL_NA", "https://advertising-api.amazon.com/v2"),
+    "FE": os.environ.get("AMZ_API_URL_FE", "https://advertising-api-fe.amazon.com/v2"),
+}
+AMZ_AUTH_URL = os.environ.get("AMZ_AUTH_URL", "https://api.amazon.com/auth/o2/token")
+
+# Amazon access tokens are cached process wide and refreshed this many seconds before they expire
+AMZ_ACCESS_TOKEN_REFRESH_MARGIN_SECONDS = float(os.environ.get("AMZ_ACCESS_TOKEN_REFRESH_MARGIN_SECONDS", 300))
+
+# Amazon Advertising API credentials, loaded lazily from Secret Manager (or AMZ_ADS_CREDENTIALS_FILE/_JSON locally)
+AMZ_CREDENTIALS_SECRET = os.environ.get("AMZ_CREDENTIALS_SECRET", "projects/269322900495/secrets/lo-az-ads/versions/1")
+AMZ_CREDENTIALS_TTL_SECONDS = float(os.environ.get("AMZ_CREDENTIALS_TTL_SECONDS", 3600))
+
+# Reports are downloaded and decompressed in chunks of this many bytes
+AMZ_REPORT_DOWNLOAD_CHUNK_SIZE = int(os.environ.get("AMZ_REPORT_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))
+
+# Reports are decompressed, parsed and normalized on this many worker processes fed through `slots` shared memory
+# chunks per report, so concurrent reports use several cores (0 parses in the downloading thread, as on 1 vCPU)
+REPORT_PARSE_PROCESSES = int(os.environ.get("REPORT_PARSE_PROCESSES", 0))
+REPORT_PARSE_SLOTS = int(os.environ.get("REPORT_PARSE_SLOTS", 4))
+
+# Default BigQuery load format for reports, "json" or "parquet" (requires pyarrow), overridable per task payload
+BQ_LOAD_FORMAT = os.environ.get("BQ_LOAD_FORMAT", "json")
+
+# Rows of a report sampled to infer the BigQuery schema of report types without one in reports_fields_bq_schema.json
+BQ_SCHEMA_SAMPLE_ROWS = int(os.environ.get("BQ_SCHEMA_SAMPLE_ROWS", 1000))
+
+# BigQuery table metadata (existence, schema) is cached per process for this many seconds
+BQ_TABLE_CACHE_TTL_SECONDS = float(os.environ.get("BQ_TABLE_CACHE_TTL_SECONDS", 3600))
+
+# Report readiness: generation time assumed before any is observed, status poll spacing, Cloud Task delay bounds,
+# how long one invocation polls before re-enqueuing itself, and how many times a report task may be re-enqueued
+AMZ_REPORT_DEFAULT_GENERATION_SECONDS = float(os.environ.get("AMZ_REPORT_DEFAULT_GENERATION_SECONDS", 300))
+AMZ_REPORT_MIN_POLL_SECONDS = float(os.environ.get("AMZ_REPORT_MIN_POLL_SECONDS", 5))
+AMZ_REPORT_MAX_POLL_SECONDS = float(os.environ.get("AMZ_REPORT_MAX_POLL_SECONDS", 60))
+AMZ_REPORT_MIN_TASK_DELAY_SECONDS = float(os.environ.get("AMZ_REPORT_MIN_TASK_DELAY_SECONDS", 60))
+AMZ_REPORT_MAX_TASK_DELAY_SECONDS = float(os.environ.get("AMZ_REPORT_MAX_TASK_DELAY_SECONDS", 1800))
+AMZ_REPORT_POLL_DEADLINE_SECONDS = float(os.environ.get("AMZ_REPORT_POLL_DEADLINE_SECONDS", 240))
+AMZ_REPORT_MAX_REENQUEUES = int(os.environ.get("AMZ_REPORT_MAX_REENQUEUES", 48))
+
+# Generation times learned by the report tasks are shared with the dispatcher through the load ledger (without a
+# ledger the Cloud Task delay stays at the default), report tasks read them at most this often
+AMZ_REPORT_READINESS_SYNC_SECONDS = float(os.environ.get("AMZ_REPORT_READINESS_SYNC_SECONDS", 600))
+
+# Collector tasks (GET ?collect=true) wait for up to this many reports of one region with a single polling loop
+AMZ_COLLECTOR_MAX_REPORTS_PER_TASK = int(os.environ.get("AMZ_COLLECTOR_MAX_REPORTS_PER_TASK", 200))
+
+# Load ledger: "" (disabled), "sqlite" (local file) or "bigquery" (LEDGER_BQ_TABLE in the target dataset).
+# The GET dispatcher skips partitions last loaded after they settled: after the longest attribution window of the
+# report's metrics (at least AMZ_MIN_LOOKBACK_DAYS) plus AMZ_LOOKBACK_MARGIN_DAYS for Amazon's late restatements.
+# Without a ledger every date is dispatched, unless GET ?skip_settled=true skips the dates that settled by date alone
+LEDGER_BACKEND = os.environ.get("LEDGER_BACKEND", "")
+LEDGER_SQLITE_PATH = os.environ.get("LEDGER_SQLITE_PATH", "amz_ads_load_ledger.sqlite")
+LEDGER_BQ_TABLE = os.environ.get("LEDGER_BQ_TABLE", "amz_ads_load_ledger")
+AMZ_MIN_LOOKBACK_DAYS = int(os.environ.get("AMZ_MIN_LOOKBACK_DAYS", 3))
+AMZ_LOOKBACK_MARGIN_DAYS = int(os.environ.get("AMZ_LOOKBACK_MARGIN_DAYS", 2))
+
+# Identical report requests share one report_id for this many seconds, and downloaded report payloads can be kept in
+# a size bounded LRU cache on local disk. Disabled (0 bytes) by default: on Cloud Functions /tmp is memory, so it is
+# only enabled by the long running report worker (WORKER_REPORT_CACHE_MAX_BYTES)
+AMZ_REPORT_ID_TTL_SECONDS = float(os.environ.get("AMZ_REPORT_ID_TTL_SECONDS", 3600))
+AMZ_REPORT_CACHE_DIR = os.environ.get("AMZ_REPORT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "amz_ads_reports"))
+AMZ_REPORT_CACHE_MAX_BYTES = int(os.environ.get("AMZ_REPORT_CACHE_MAX_BYTES", 0))
+
+# Amazon Advertising profiles are indexed per region and reused for this many seconds, optionally persisted to a
+# json file (e.g. on /tmp or a mounted volume) so new processes start with a warm index. A profile missing from the
+# index refetches it, at most once per AMZ_PROFILE_REFRESH_COOLDOWN_SECONDS per region
+AMZ_PROFILE_INDEX_TTL_SECONDS = float(os.environ.get("AMZ_PROFILE_INDEX_TTL_SECONDS", 6 * 3600))
+AMZ_PROFILE_INDEX_FILE = os.environ.get("AMZ_PROFILE_INDEX_FILE", "")
+AMZ_PROFILE_REFRESH_COOLDOWN_SECONDS = float(os.environ.get("AMZ_PROFILE_REFRESH_COOLDOWN_SECONDS", 300))
+
+# Pipeline stages (Amazon requests, report wait, download, decompress, parse, normalize, BigQuery load) are logged
+# as structured "metrics {json}" lines tagged with the trace id, and served in the OpenMetrics format by worker.py
+# on METRICS_PORT (0 disables the endpoint)
+METRICS_LOG_EVENTS = os.environ.get("METRICS_LOG_EVENTS", "true").lower() == "true"
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))
+
+# Report workers (worker.py / the `worker` function target): concurrent jobs per process, Pub/Sub topic the GET
+# dispatcher publishes to with ?dispatch=worker and subscription the workers pull from, how long a job waits for
+# its reports, idle seconds before a standalone worker exits (0 runs until stopped) and the size of the disk report
+# cache of a standalone worker (see AMZ_REPORT_CACHE_MAX_BYTES)
+WORKER_CONCURRENCY = int(os.environ.get("WORKER_CONCURRENCY", 8))
+WORKER_TOPIC = os.environ.get("WORKER_TOPIC", "")
+WORKER_SUBSCRIPTION = os.environ.get("WORKER_SUBSCRIPTION", "")
+WORKER_REPORT_DEADLINE_SECONDS = float(os.environ.get("WORKER_REPORT_DEADLINE_SECONDS", 3600))
+WORKER_IDLE_TIMEOUT_SECONDS = float(os.environ.get("WORKER_IDLE_TIMEOUT_SECONDS", 0))
+WORKER_REPORT_CACHE_MAX_BYTES = int(os.environ.get("WORKER_REPORT_CACHE_MAX_BYTES", 256 * 1024 * 1024))
@@ -1,18 +1,30 @@
 import logging
 import datetime
-from flask import Request, Response, escape, make_response
-from google.cloud import tasks_v2
-
-tasks_client = tasks_v2.CloudTasksClient()
-from google.protobuf import duration_pb2, timestamp_pb2
+from flask import Request, make_response
 
 import json
 import re
+import time
 
 import config
-from utils.bq import bq_load_json_list, format_list_of_dicts_for_bq, get_schema_from_json_list
+from utils.bq import (
+    LOAD_SOURCE_FORMATS,
+    bq_load_file,
+    bq_load_json_list,
+    bq_load_partitions,
+    get_load_schema,
+)
+from utils.dispatch import StreamBatcher, run_concurrently
+from utils.ledger import CREATED, FAILED, LOADED, LedgerKey, get_load_ledger, is_in_flight
+from utils.metrics import breakdown, get_trace_id, timed, trace_context, traced
+from utils.parse_pool import get_report_parse_pool
+from utils.tasks import build_http_task, create_tasks, get_tasks_client
+from utils.worker import LocalJobQueue, ReportWorker, publish_jobs
 from pd_utils import logging_utils, monitoring_utils
 from services.amz_advertising.amz_advertising import AmazonAdvertisingApiService
+from services.amz_advertising.date_planner import partition_needs_refresh, partition_settled, report_lookback_days
+from services.amz_advertising.readiness import ReportNotReadyError, report_readiness
+from services.amz_advertising.report_collector import ReportCollector
 
 
 logging_utils.set_up_logging()
@@ -47,6 +59,7 @@ REPORT_COMBINATIONS = {
 # 'sd': ['campaigns', 'adGroups', 'productAds', 'asins', 'targets']
 
 
+@traced
 def main(request: Request):
     """HTTP Cloud Function.
     Args:
@@ -77,18 +90,28 @@ def main(request: Request):
             target_project = args.get("target_project")
             target_dataset = args.get("target_dataset")
             backfill_days = int(args.get("backfill_days"))
+            # Number of consecutive dates of the same table fetched and loaded by one task (one BigQuery load)
+            batch_days = int(args.get("batch_days", 1))
+            # Whether reports are waited for by one collector task per region instead of one task per batch
+            collect = args.get("collect", "false").lower() == "true"
+            # "tasks" (one Cloud Task per batch) or "worker" (jobs published to WORKER_TOPIC for the report workers)
+            dispatch = args.get("dispatch", "tasks")
+            # Recreate partitions even when the load ledger says they are loaded and settled, with new reports
+            force = args.get("force", "false").lower() == "true"
+            # Without a load ledger, opt in to skipping the dates that settled, when earlier runs are known to have
+            # loaded them (e.g. a daily run with a wide backfill_days). Backfills into new tables must not set it
+            skip_settled = args.get("skip_settled", "false").lower() == "true"
 
-            report_counter = 0
             dates = []
             today = datetime.date.today()
-            tasks_client = tasks_v2.CloudTasksClient()
-            tasks_parent = tasks_client.queue_path("precis-aarhus-internal", "europe-west1", "lastobject-amz-api-queue")
+            tasks_parent = get_tasks_parent()
 
             now_str = datetime.datetime.now().strftime("%m/%d/%Y-%H:%M:%S")
 
             for i in range(1, backfill_days + 1):
                 dates.append((today - datetime.timedelta(days=i)).strftime("%Y%m%d"))
 
+            report_jobs = []
             for account in ACCOUNTS:
                 amz_api_service = AmazonAdvertisingApiService(region=account["region"])
                 for ad_type, record_types in REPORT_COMBINATIONS.items():
@@ -102,84 +125,115 @@ def main(request: Request):
 
                         for element in list_to_iterate_over:
                             for report_date in dates:
-                                logging.info(
-                                    f"Initiating report for: target_dataset:{target_dataset}, target_project:{target_project}, country_code:{account['country_code']}, region:{account['region']}, ad_type:{ad_type}, record_type:{record_type}, report_date:{report_date}"
-                                )
-                                tactic = element if ad_type == "sd" else None
-                                creativeType = element if ad_type == "hsa" else None
-
-                                try:
-                                    report_id = amz_api_service.create_new_report(
-                                        ad_type,
-                                        record_type,
-                                        report_date,
-                                        account["country_code"],
-                                        account["account_id"],
-                                        tactic,
-                                        creativeType,
-                                    )
-                                except Exception as e:
-                                    logging.exception(e)
-                                    logging.exception(
-                                        f"{ad_type=},{record_type=},{report_date=},{account=},{tactic=},{creativeType=},"
-                                    )
-                                    report_id = None
-                                if report_id == None:
-                                    continue
-
-                                task_config = {
-                                    "target_dataset": target_dataset,
-                                    "target_project": target_project,
-                                    "specific_request": {
-                                        "country_code": account["country_code"],
-                                        "region": account["region"],
-                                        "account_id": account["account_id"],
+                                report_jobs.append(
+                                    {
+                                        "amz_api_service": amz_api_service,
+                                        "account": account,
                                         "ad_type": ad_type,
                                         "record_type": record_type,
-                                        "reportDate": report_date,
-                                        "report_id": report_id,
+                                        "report_date": report_date,
                                         "tactic": element if ad_type == "sd" else None,
                                         "creativeType": element if ad_type == "hsa" else None,
-                                    },
-                                }
-
-                                dispatch_standard_task(
-                                    tasks_parent,
-                                    tasks_v2.HttpMethod.GET,
-                                    "https://europe-west1-precis-aarhus-internal.cloudfunctions.net/amz-advertising-api-lastobject",
-                                    "amz-advertising-api-lastobject@precis-aarhus-internal.iam.gserviceaccount.com",
-                                    tasks_parent
-                                    + f"/tasks/"
-                                    + re.sub(
-                                        r"[^0-9a-zA-Z]+",
-                                        "-",
-                                        f"adhoc_amz_ads_{ad_type}_{record_type}_{tactic}_{creativeType}_{account['account_id']}_{account['country_code']}${report_date}_{now_str}",
-                                    ),
-                                    1800,
-                                    task_config,
-                                    delay=1800,
+                                    }
                                 )
 
-                                """
-                                report_dict = amz_api_service.get_report(report_id,ad_type,record_type,report_date,account['country_code'],account['account_id'],tactic,creativeType)
-
-                                report_to_upload_with_dates = []
-                                reformatted_date = report_date[0:4]+"-"+report_date[4:6]+"-"+report_date[6:8]
-                                for row in report_dict['report']:
-                                    row['date'] = reformatted_date
-                                    report_to_upload_with_dates.append(row)
-
-                                reformatted_report = format_list_of_dicts_for_bq(report_to_upload_with_dates)
+            planned_jobs = report_jobs
+            ledger = get_load_ledger(target_project, target_dataset)
+            # Task delays use the generation times learned by the report tasks
+            sync_report_readiness(ledger, max_age=0)
+            if ledger is not None and not force:
+                entries = ledger.get_many(job_ledger_key(job) for job in report_jobs)
+                now = time.time()
+                pending_jobs = [
+                    job
+                    for job in report_jobs
+                    if partition_needs_refresh(entries.get(job_ledger_key(job)), job_lookback_days(job))
+                    and not is_in_flight(entries.get(job_ledger_key(job)), now, config.AMZ_REPORT_ID_TTL_SECONDS)
+                ]
+                logging.info(
+                    f"Skipping {len(report_jobs) - len(pending_jobs)} of {len(report_jobs)} reports loaded after "
+                    f"their attribution lookback window closed, or being loaded by another run"
+                )
+                report_jobs = pending_jobs
+            elif skip_settled and not force:
+                pending_jobs = [
+                    job
+                    for job in report_jobs
+                    if not partition_settled(job["report_date"], job_lookback_days(job), today)
+                ]
+                logging.info(
+                    f"Skipping {len(report_jobs) - len(pending_jobs)} of {len(report_jobs)} reports whose attribution "
+                    f"lookback window closed (skip_settled without a load ledger)"
+                )
+                report_jobs = pending_jobs
+            pending_job_ids = {id(job) for job in report_jobs}
+            skipped_dates = sorted({job["report_date"] for job in planned_jobs if id(job) not in pending_job_ids})
+            skipped_count = len(planned_jobs) - len(report_jobs)
+
+            if collect:
+                # Reports of any tables of a region are waited for by one collector task
+                batch_key, batch_size = report_region_key, config.AMZ_COLLECTOR_MAX_REPORTS_PER_TASK
+            else:
+                batch_key, batch_size = report_table_key, batch_days
+
+            dispatched_requests = []
+            dispatch_errors = []
+
+            def dispatch_batches(batches):
+                task_specific_requests = [
+                    [build_specific_request(job) for job in sorted(batch, key=lambda job: job["report_date"])]
+                    for batch in batches
+                ]
+                errors = dispatch_report_tasks(
+                    task_specific_requests,
+                    target_project,
+                    target_dataset,
+                    tasks_parent,
+                    dispatch,
+                    collect,
+                    f"{now_str}_collect" if collect else now_str,
+                    ledger,
+                )
+                dispatched_requests.extend(
+                    specific_requests
+                    for specific_requests, error in zip(task_specific_requests, errors)
+                    if error is None
+                )
+                dispatch_errors.extend(error for error in errors if error is not None)
+
+            # Each batch is dispatched as soon as its reports were created, so the reports created before a GET
+            # times out or fails still get their tasks, and the most recent dates (created first) are fetched first
+            batcher = StreamBatcher(batch_key, batch_size, dispatch_batches)
+
+            def on_report_created(job, report_id, error):
+                if report_id is not None:
+                    batcher.add(dict(job, report_id=report_id, created_at=time.time()))
+
+            run_concurrently(
+                report_jobs,
+                lambda job: create_report_for_job(job, target_project, target_dataset, force=force),
+                key_func=report_region_key,
+                max_workers=config.DISPATCH_MAX_WORKERS,
+                per_key_limit=config.DISPATCH_REGION_CONCURRENCY,
+                # Marketplaces of a region share its slots fairly, the most recent dates are created first
+                sub_key_func=lambda job: (job["account"]["country_code"], job["account"]["account_id"]),
+                priority_func=lambda job: -int(job["report_date"]),
+                weights=config.DISPATCH_REGION_WEIGHTS,
+                on_done=on_report_created,
+            )
+            batcher.close()
 
-                                table_name = f"amz_ads_{ad_type}_{record_type}_{account['account_id']}_{account['country_code']}"
+            if dispatch_errors:
+                raise Exception(
+                    f"Error while creating {len(dispatch_errors)} of {len(dispatched_requests) + len(dispatch_errors)} "
+                    f"tasks: {str(dispatch_errors[0])}"
+                )
 
-                                logging.info(f"Uploading report with the name: '{table_name}' for date: '{report_date}' to '{target_project}.{target_dataset}'")
-                                bq_load_json_list(target_project, target_dataset, table_name, reformatted_report,report_date,report_dict['bq_schema'])
-                                """
-                                
-                                report_counter += 1
+            report_counter = sum(len(specific_requests) for specific_requests in dispatched_requests)
 
             msg = f"Dispatched {report_counter} report tasks in total to '{target_project}.{target_dataset}'"
+            if skipped_count:
+                msg += f", skipped {skipped_count} settled or in flight reports of dates {', '.join(skipped_dates)}"
             logging.info(msg)
             return make_response(msg, 200)
 
@@ -187,93 +241,629 @@ def main(request: Request):
 
             # Else parse args and echo name from URL args
             request_json = request.get_json()
-            target_dataset = request_json.get("target_dataset")
-            target_project = request_json.get("target_project")
-            specific_request_metrics = request_json.get("specific_request")
-
-            country_code = specific_request_metrics["country_code"]
-            region = specific_request_metrics["region"]
-            account_id = specific_request_metrics["account_id"]
-            ad_type = specific_request_metrics["ad_type"]
-            record_type = specific_request_metrics["record_type"]
-            report_date = specific_request_metrics["reportDate"]
-            tactic = specific_request_metrics["tactic"]
-            creativeType = specific_request_metrics["creativeType"]
-
-            report_id = specific_request_metrics.get("report_id")
-
-            amz_api_service = AmazonAdvertisingApiService(region=region)
-            if report_id == None:
-                report_id = amz_api_service.create_new_report(
-                    ad_type, record_type, report_date, country_code, account_id, tactic, creativeType
+            # Reports still generating at the deadline are handed back to Cloud Tasks instead of holding the function
+            try:
+                msg = process_report_task(request_json, time.time() + config.AMZ_REPORT_POLL_DEADLINE_SECONDS)
+            except ReportNotReadyError as e:
+                msg = reenqueue_report_task(
+                    request_json, request_json.get("target_project"), request_json.get("target_dataset"), e
                 )
+            if msg is None:
+                return ""
+            logging.info(msg)
+
+        return make_response(msg, 200)
+    except Exception as e:
+        logging.exception(e)
+        msg = f"An error occured: {str(e)}"
+        logging.error(msg)
+        return make_response(msg, 500)
+
 
-            logging.info(
-                f"Fetching report for: target_dataset:{target_dataset}, target_project:{target_project}, country_code:{country_code}, region:{region}, ad_type:{ad_type}, record_type:{record_type}, report_date:{report_date}"
+@traced
+def worker(request: Request):
+    """HTTP Cloud Function processing a batch of report tasks in one invocation.
+    Args:
+        request (flask.Request): POST {"jobs": [report task payload, ...], "concurrency": optional int}
+    Returns:
+        Summary of the batch, 500 if any job failed (the failed payloads are logged)
+    """
+    try:
+        request_json = request.get_json()
+        job_queue = LocalJobQueue(request_json["jobs"])
+        stats = ReportWorker(
+            job_queue,
+            lambda payload: process_report_task(payload, time.time() + config.WORKER_REPORT_DEADLINE_SECONDS),
+            concurrency=int(request_json.get("concurrency", config.WORKER_CONCURRENCY)),
+        ).run(idle_timeout=0)
+
+        msg = f"Processed {stats.succeeded + stats.failed} report tasks in {stats.seconds:.1f}s, {stats.failed} failed"
+        logging.info(msg)
+        if job_queue.failed:
+            logging.error(f"Failed report tasks: {json.dumps(job_queue.failed)}")
+            return make_response(msg, 500)
+        return make_response(msg, 200)
+    except Exception as e:
+        logging.exception(e)
+        msg = f"An error occured: {str(e)}"
+        logging.error(msg)
+        return make_response(msg, 500)
+
+
+def process_report_task(request_json, deadline):
+    """
+    Processes one report task payload (the body of a report Cloud Task or a worker job).
+    Returns the log message, or None if no report could be generated.
+    Raises ReportNotReadyError if a report is still generating at the deadline (epoch seconds).
+    """
+    ledger = get_load_ledger(request_json.get("target_project"), request_json.get("target_dataset"))
+    sync_report_readiness(ledger, max_age=config.AMZ_REPORT_READINESS_SYNC_SECONDS)
+    with trace_context(get_trace_id() or request_json.get("trace_id")):
+        try:
+            return load_reports(
+                request_json,
+                request_json.get("target_project"),
+                request_json.get("target_dataset"),
+                request_json.get("load_format", config.BQ_LOAD_FORMAT),
+                deadline,
             )
+        finally:
+            share_report_readiness(ledger)
+
 
-            report_dict = amz_api_service.get_report(
-                report_id, ad_type, record_type, report_date, country_code, account_id, tactic, creativeType
+def load_reports(request_json, target_project, target_dataset, load_format, deadline):
+    """
+    Fetches the report(s) of a task and loads them to BigQuery, recording the outcome in the load ledger.
+    Returns the log message, or None if no report could be generated.
+    Raises ReportNotReadyError if a report is still generating at the deadline.
+    """
+    specific_requests = request_json.get("specific_requests")
+    ledger = get_load_ledger(target_project, target_dataset)
+    row_counts = {}
+
+    if specific_requests is None:
+        specific_request_metrics = request_json.get("specific_request")
+        report_date = specific_request_metrics["reportDate"]
+
+        amz_api_service = AmazonAdvertisingApiService(region=specific_request_metrics["region"])
+        table_name = report_table_name(specific_request_metrics)
+        with breakdown("report", table=table_name, report_date=report_date) as report_fields:
+            report_dict = fetch_report(
+                amz_api_service, specific_request_metrics, target_project, target_dataset, deadline
             )
+            report_fields["report_id"] = specific_request_metrics["report_id"]
             if report_dict is None:
-                return ""
+                record_in_ledger(ledger, [specific_request_metrics], FAILED)
+                return None
+
+            load_result = load_report(
+                target_project,
+                target_dataset,
+                table_name,
+                report_dict,
+                specific_request_metrics,
+                row_counts,
+                load_format,
+            )
+            report_fields["rows"] = row_counts.get(specific_request_ledger_key(specific_request_metrics))
+        record_in_ledger(ledger, [specific_request_metrics], load_status(load_result), row_counts)
+
+        msg = f"Uploaded 1 report with the name: '{table_name}' for date: '{report_date}' to '{target_project}.{target_dataset}'"
+    else:
+        amz_api_service = AmazonAdvertisingApiService(region=specific_requests[0]["region"])
+
+        if request_json.get("collect"):
+            # Reports of any tables of the region, each one is loaded as soon as it is ready. On ReportNotReadyError
+            # specific_requests only holds the reports not loaded yet, so only those get re-enqueued
+            loaded = 0
+            for specific_request_metrics, report_dict in collect_reports(amz_api_service, specific_requests, deadline):
+                if report_dict is None:
+                    record_in_ledger(ledger, [specific_request_metrics], FAILED)
+                    continue
+                with breakdown(
+                    "report",
+                    table=report_table_name(specific_request_metrics),
+                    report_date=specific_request_metrics["reportDate"],
+                    report_id=specific_request_metrics["report_id"],
+                ) as report_fields:
+                    load_result = load_report(
+                        target_project,
+                        target_dataset,
+                        report_table_name(specific_request_metrics),
+                        report_dict,
+                        specific_request_metrics,
+                        row_counts,
+                        load_format,
+                    )
+                    report_fields["rows"] = row_counts.get(specific_request_ledger_key(specific_request_metrics))
+                record_in_ledger(ledger, [specific_request_metrics], load_status(load_result), row_counts)
+                loaded += 1
+            if not loaded:
+                return None
+
+            msg = f"Uploaded {loaded} collected reports to '{target_project}.{target_dataset}'"
+        else:
+            table_name = report_table_name(specific_requests[0])
+
+            rows_by_date = {}
+            bq_schema = None
+            loaded_requests = []
+            # All dates are loaded together, so a copy is collected and the whole batch is re-enqueued if not ready
+            for specific_request_metrics, report_dict in collect_reports(
+                amz_api_service, list(specific_requests), deadline
+            ):
+                if report_dict is None:
+                    record_in_ledger(ledger, [specific_request_metrics], FAILED)
+                    continue
+                report_rows, bq_schema = report_rows_with_date(report_dict, specific_request_metrics["reportDate"])
+                rows_by_date[specific_request_metrics["reportDate"]] = count_rows(
+                    report_rows, row_counts, specific_request_metrics
+                )
+                loaded_requests.append(specific_request_metrics)
+            if not rows_by_date:
+                return None
+
+            # The reports are downloaded and parsed while the load file is written, inside bq_load_partitions
+            with breakdown("report_batch", table=table_name, report_dates=sorted(rows_by_date)):
+                load_result = bq_load_partitions(
+                    target_project, target_dataset, table_name, rows_by_date, bq_schema, load_format=load_format
+                )
+            record_in_ledger(ledger, loaded_requests, load_status(load_result), row_counts)
 
-            report_to_upload_with_dates = []
-            for row in report_dict["report"]:
-                row["date"] = f"{report_date[0:4]}-{report_date[4:6]}-{report_date[6:8]}"
-                report_to_upload_with_dates.append(row)
+            msg = f"Uploaded {len(rows_by_date)} reports with the name: '{table_name}' for dates: '{sorted(rows_by_date)}' to '{target_project}.{target_dataset}'"
 
-            reformatted_report = format_list_of_dicts_for_bq(report_to_upload_with_dates)
+    return msg
 
-            if tactic is not None:
-                table_name = f"amz_ads_{ad_type}_{record_type}_{account_id}_{country_code}_{tactic}"
-            elif creativeType is not None:
-                table_name = f"amz_ads_{ad_type}_{record_type}_{account_id}_{country_code}_{creativeType}"
-            else:
-                table_name = f"amz_ads_{ad_type}_{record_type}_{account_id}_{country_code}"
 
-            bq_load_json_list(
-                target_project, target_dataset, table_name, reformatted_report, report_date, report_dict["bq_schema"]
+def load_report(
+    target_project, target_dataset, table_name, report_dict, specific_request_metrics, row_counts, load_format
+):
+    """
+    Loads one downloaded report into its date partition, counting its rows in row_counts. With REPORT_PARSE_PROCESSES
+    the report is parsed into the load file on the report parse pool while this thread only downloads it.
+    Returns the load result of the bq load helpers.
+    """
+    report_date = specific_request_metrics["reportDate"]
+    parse_pool = get_report_parse_pool()
+    # Reports without a known schema are typed from their first rows, on this thread
+    if parse_pool is None or not report_dict["bq_schema"]:
+        report_rows, bq_schema = report_rows_with_date(report_dict, report_date)
+        return bq_load_json_list(
+            target_project,
+            target_dataset,
+            table_name,
+            count_rows(report_rows, row_counts, specific_request_metrics),
+            report_date,
+            bq_schema,
+            load_format=load_format,
+        )
+
+    bq_schema = get_load_schema(target_project, target_dataset, table_name, report_dict["bq_schema"])
+    with timed("parse_pool", format=load_format) as timer:
+        parsed_report = parse_pool.parse(report_dict["report_chunks"], bq_schema, bq_date(report_date), load_format)
+        timer.rows = parsed_report.row_count
+    try:
+        row_counts[specific_request_ledger_key(specific_request_metrics)] = parsed_report.row_count
+        with open(parsed_report.path, "rb") as source_file:
+            return bq_load_file(
+                target_project,
+                target_dataset,
+                table_name,
+                source_file,
+                LOAD_SOURCE_FORMATS[parsed_report.load_format],
+                report_date,
+                bq_schema,
             )
+    finally:
+        parsed_report.discard()
 
-            msg = f"Uploaded 1 report with the name: '{table_name}' for date: '{report_date}' to '{target_project}.{target_dataset}'"
-            logging.info(msg)
 
-        return make_response(msg, 200)
+def count_rows(rows, row_counts, specific_request_metrics):
+    """Passes rows through, counting them in row_counts under the ledger key of the specific_request"""
+    key = specific_request_ledger_key(specific_request_metrics)
+    row_counts[key] = 0
+    for row in rows:
+        row_counts[key] += 1
+        yield row
+
+
+def load_status(load_result):
+    # The bq load helpers return the error messages as a string when BigQuery rejects the rows
+    return FAILED if isinstance(load_result, str) else LOADED
+
+
+def specific_request_ledger_key(specific_request_metrics):
+    return LedgerKey.for_report(
+        specific_request_metrics["account_id"],
+        specific_request_metrics["country_code"],
+        specific_request_metrics["ad_type"],
+        specific_request_metrics["record_type"],
+        specific_request_metrics["tactic"],
+        specific_request_metrics["creativeType"],
+        specific_request_metrics["reportDate"],
+    )
+
+
+def job_ledger_key(job):
+    return LedgerKey.for_report(
+        job["account"]["account_id"],
+        job["account"]["country_code"],
+        job["ad_type"],
+        job["record_type"],
+        job["tactic"],
+        job["creativeType"],
+        job["report_date"],
+    )
+
+
+def job_lookback_days(job):
+    return report_lookback_days(job["ad_type"], job["record_type"], job["tactic"], job["creativeType"])
+
+
+def sync_report_readiness(ledger, max_age):
+    """Loads the report generation times shared in the load ledger, unless they were loaded less than max_age ago"""
+    if ledger is None or time.monotonic() - report_readiness.synced_at < max_age:
+        return
+    try:
+        report_readiness.load(ledger.get_readiness())
+    except Exception as e:
+        logging.exception(f"Could not read the report generation times from the load ledger: {e}")
+
+
+def share_report_readiness(ledger):
+    """Records the report generation times learned by this process in the load ledger, for the dispatcher"""
+    if ledger is None:
+        return
+    updates = report_readiness.pop_updates()
+    if not updates:
+        return
+    try:
+        ledger.record_readiness(updates)
+    except Exception as e:
+        logging.exception(f"Could not record {len(updates)} report generation times in the load ledger: {e}")
+
+
+def record_in_ledger(ledger, specific_requests, status, row_counts=None):
+    """Records the status of the specific_requests' partitions, the ledger never fails a load"""
+    if ledger is None:
+        return
+    try:
+        ledger.record_status(
+            [
+                (specific_request_ledger_key(specific_request_metrics), specific_request_metrics.get("report_id"))
+                for specific_request_metrics in specific_requests
+            ],
+            status,
+            row_counts,
+        )
+    except Exception as e:
+        logging.exception(f"Could not record {status} for {len(specific_requests)} reports in the load ledger: {e}")
+
+
+def create_report_for_job(job, target_project, target_dataset, force=False):
+    """
+    Creates the Amazon report for one (account, ad_type, record_type, tactic/creativeType, date) job, a new one even
+    if an identical report was requested recently when force is set.
+    Returns the report_id, or None if the report is not available for the job or could not be created.
+    """
+    account = job["account"]
+    ad_type = job["ad_type"]
+    record_type = job["record_type"]
+    report_date = job["report_date"]
+    tactic = job["tactic"]
+    creativeType = job["creativeType"]
+
+    logging.info(
+        f"Initiating report for: target_dataset:{target_dataset}, target_project:{target_project}, country_code:{account['country_code']}, region:{account['region']}, ad_type:{ad_type}, record_type:{record_type}, report_date:{report_date}"
+    )
+
+    try:
+        return job["amz_api_service"].create_new_report(
+            ad_type,
+            record_type,
+            report_date,
+            account["country_code"],
+            account["account_id"],
+            tactic,
+            creativeType,
+            force=force,
+        )
     except Exception as e:
         logging.exception(e)
-        msg = f"An error occured: {str(e)}"
-        logging.error(msg)
-        return make_response(msg, 500)
+        logging.exception(f"{ad_type=},{record_type=},{report_date=},{account=},{tactic=},{creativeType=},")
+        return None
+
+
+def report_table_key(job):
+    """Report jobs loaded into the same table, batched by up to batch_days dates per task"""
+    return (
+        job["account"]["account_id"],
+        job["account"]["country_code"],
+        job["ad_type"],
+        job["record_type"],
+        job["tactic"],
+        job["creativeType"],
+    )
 
 
-def dispatch_standard_task(
-    tasks_parent, http_method, url, service_account, name, dispatch_deadline, task_config, delay=None
+def report_region_key(job):
+    return job["account"]["region"]
+
+
+def dispatch_report_tasks(
+    task_specific_requests, target_project, target_dataset, tasks_parent, dispatch, collect, name_suffix, ledger
+):
+    """
+    Dispatches one report task per list of specific_requests and records the reports of the dispatched tasks as
+    CREATED in the load ledger. Returns the dispatch error of each task, None for the ones dispatched.
+    """
+    errors = create_report_tasks(
+        task_specific_requests, target_project, target_dataset, tasks_parent, dispatch, collect, name_suffix
+    )
+    # Reports whose task could not be dispatched are not in flight, the next run must create them again
+    record_in_ledger(
+        ledger,
+        [request for requests, error in zip(task_specific_requests, errors) if error is None for request in requests],
+        CREATED,
+    )
+    return errors
+
+
+def create_report_tasks(
+    task_specific_requests, target_project, target_dataset, tasks_parent, dispatch, collect, name_suffix
 ):
-    dispatch_deadline_duration = duration_pb2.Duration()
-    dispatch_deadline_duration.seconds = dispatch_deadline
-
-    task = {
-        "http_request": {  # Specify the type of request.
-            "http_method": tasks_v2.HttpMethod.POST,
-            "url": url,
-            "headers": {"Content-Type": "application/json"},
-            "oidc_token": {"service_account_email": service_account},
-            "body": json.dumps(task_config).encode(),
-        },
-        "name": name,
-        "dispatch_deadline": dispatch_deadline_duration,
+    """
+    Creates one Cloud Task, or (dispatch="worker") publishes one job to WORKER_TOPIC, per list of specific_requests.
+    Returns the dispatch error of each task, None for the ones dispatched.
+    """
+    if dispatch == "worker":
+        # Long running workers pull the tasks from Pub/Sub and wait for the reports themselves, no delay
+        try:
+            publish_jobs(
+                config.WORKER_TOPIC,
+                [
+                    build_report_task_config(
+                        specific_requests,
+                        target_project,
+                        target_dataset,
+                        # Worker jobs have no request of their own, they are traced as part of this dispatch
+                        dict({"collect": True} if collect else {}, trace_id=get_trace_id()),
+                    )
+                    for specific_requests in task_specific_requests
+                ],
+            )
+        except Exception as e:
+            logging.exception(f"Error while publishing {len(task_specific_requests)} worker jobs: {e}")
+            return [e] * len(task_specific_requests)
+        return [None] * len(task_specific_requests)
+
+    outcomes = create_tasks(
+        tasks_parent,
+        [
+            build_report_task(
+                specific_requests,
+                target_project,
+                target_dataset,
+                tasks_parent,
+                name_suffix,
+                delay=report_task_delay(specific_requests),
+                extra_task_config={"collect": True} if collect else None,
+            )
+            for specific_requests in task_specific_requests
+        ],
+    )
+    return [outcome.error for outcome in outcomes]
+
+
+def build_specific_request(job):
+    return {
+        "country_code": job["account"]["country_code"],
+        "region": job["account"]["region"],
+        "account_id": job["account"]["account_id"],
+        "ad_type": job["ad_type"],
+        "record_type": job["record_type"],
+        "reportDate": job["report_date"],
+        "report_id": job["report_id"],
+        "created_at": job["created_at"],
+        "tactic": job["tactic"],
+        "creativeType": job["creativeType"],
     }
 
-    if delay is not None:
-        delayed_time = datetime.datetime.now() + datetime.timedelta(seconds=delay)
-        delayed_timestamp = timestamp_pb2.Timestamp().FromDatetime(delayed_time)
-        task["schedule_time"] = delayed_timestamp
 
+def report_task_delay(specific_requests):
+    """Seconds until the reports of a task are expected to be ready, learned from past generation times"""
+    return max(
+        report_readiness.initial_delay(
+            (specific_request["ad_type"], specific_request["record_type"], specific_request["country_code"])
+        )
+        for specific_request in specific_requests
+    )
+
+
+def build_report_task(
+    specific_requests, target_project, target_dataset, tasks_parent, name_suffix, delay, extra_task_config=None
+):
+    """Builds the Cloud Task that will fetch and upload a batch of created reports"""
+    if len(specific_requests) == 1:
+        report_dates = specific_requests[0]["reportDate"]
+    else:
+        report_dates = f"{specific_requests[0]['reportDate']}-{specific_requests[-1]['reportDate']}"
+
+    specific_request = specific_requests[0]
+    return build_http_task(
+        "https://europe-west1-precis-aarhus-internal.cloudfunctions.net/amz-advertising-api-lastobject",
+        "amz-advertising-api-lastobject@precis-aarhus-internal.iam.gserviceaccount.com",
+        tasks_parent
+        + f"/tasks/"
+        + re.sub(
+            r"[^0-9a-zA-Z]+",
+            "-",
+            f"adhoc_amz_ads_{specific_request['ad_type']}_{specific_request['record_type']}_{specific_request['tactic']}_{specific_request['creativeType']}_{specific_request['account_id']}_{specific_request['country_code']}${report_dates}_{name_suffix}",
+        ),
+        1800,
+        build_report_task_config(specific_requests, target_project, target_dataset, extra_task_config),
+        delay=int(delay),
+    )
+
+
+def build_report_task_config(specific_requests, target_project, target_dataset, extra_task_config=None):
+    """The payload of a report task, handled by process_report_task"""
+    task_config = {"target_dataset": target_dataset, "target_project": target_project, **(extra_task_config or {})}
+    if len(specific_requests) == 1:
+        task_config["specific_request"] = specific_requests[0]
+    else:
+        task_config["specific_requests"] = specific_requests
+    return task_config
+
+
+def fetch_report(amz_api_service, specific_request_metrics, target_project, target_dataset, deadline=None):
+    """
+    Waits for and downloads the report of a task's specific_request, creating it first if it has no report_id.
+    Returns the report dict of get_report, or None if generating the report did not succeed.
+    Raises ReportNotReadyError if the report is still generating at the deadline (epoch seconds).
+    """
+    ensure_report_created(amz_api_service, specific_request_metrics)
+
+    logging.info(
+        f"Fetching report for: target_dataset:{target_dataset}, target_project:{target_project}, country_code:{specific_request_metrics['country_code']}, region:{specific_request_metrics['region']}, ad_type:{specific_request_metrics['ad_type']}, record_type:{specific_request_metrics['record_type']}, report_date:{specific_request_metrics['reportDate']}"
+    )
+
+    report_dict = amz_api_service.get_report(
+        specific_request_metrics["report_id"],
+        specific_request_metrics["ad_type"],
+        specific_request_metrics["record_type"],
+        specific_request_metrics["reportDate"],
+        specific_request_metrics["country_code"],
+        specific_request_metrics["account_id"],
+        specific_request_metrics["tactic"],
+        specific_request_metrics["creativeType"],
+        created_at=specific_request_metrics.get("created_at"),
+        deadline=deadline,
+    )
+    return report_dict
+
+
+def collect_reports(amz_api_service, specific_requests, deadline=None):
+    """
+    Waits for the reports of many specific_requests with one ReportCollector polling loop, creating missing reports.
+    Yields (specific_request, report dict of get_report or None) as soon as each report is ready.
+    Raises ReportNotReadyError if reports are still generating at the deadline, after pointing the
+    specific_requests list at the pending ones only
+    """
+    collector = ReportCollector(amz_api_service, deadline)
+    for i, specific_request_metrics in enumerate(specific_requests):
+        ensure_report_created(amz_api_service, specific_request_metrics)
+        collector.add(
+            i,
+            specific_request_metrics["report_id"],
+            specific_request_metrics["ad_type"],
+            specific_request_metrics["record_type"],
+            specific_request_metrics["country_code"],
+            specific_request_metrics["account_id"],
+            specific_request_metrics["tactic"],
+            specific_request_metrics["creativeType"],
+            created_at=specific_request_metrics.get("created_at"),
+        )
+
+    logging.info(f"Collecting {len(collector)} reports")
     try:
-        response = tasks_client.create_task(parent=tasks_parent, task=task)
-        logging.info(f"Created task {response.name}")
-    except Exception as e:
-        msg = f"Error while creating task: {name} - {str(e)}"
-        logging.exception(msg)
+        for i, report_dict in collector.collect():
+            yield specific_requests[i], report_dict
+    except ReportNotReadyError:
+        specific_requests[:] = [specific_requests[i] for i in collector.pending()]
+        raise
+
+
+def ensure_report_created(amz_api_service, specific_request_metrics):
+    if specific_request_metrics.get("report_id") is None:
+        specific_request_metrics["report_id"] = amz_api_service.create_new_report(
+            specific_request_metrics["ad_type"],
+            specific_request_metrics["record_type"],
+            specific_request_metrics["reportDate"],
+            specific_request_metrics["country_code"],
+            specific_request_metrics["account_id"],
+            specific_request_metrics["tactic"],
+            specific_request_metrics["creativeType"],
+        )
+        # Keep the report if the task gets re-enqueued because it is not ready yet
+        specific_request_metrics["created_at"] = time.time()
+
+
+def report_rows_with_date(report_dict, report_date):
+    if report_dict is None:
+        return None
+
+    reformatted_date = bq_date(report_date)
+    return (dict(row, date=reformatted_date) for row in report_dict["report"]), report_dict["bq_schema"]
+
+
+def bq_date(report_date):
+    """YYYYMMDD report date as the YYYY-MM-DD value of the date column"""
+    return f"{report_date[0:4]}-{report_date[4:6]}-{report_date[6:8]}"
+
+
+def reenqueue_report_task(request_json, target_project, target_dataset, not_ready_error):
+    """
+    Dispatches the task again for when its report is expected to be ready, keeping the created report ids.
+    Returns the log message.
+    """
+    attempt = request_json.get("reenqueue_attempt", 0) + 1
+    if attempt > config.AMZ_REPORT_MAX_REENQUEUES:
+        raise Exception(f"Giving up after {attempt - 1} re-enqueues: {not_ready_error}")
+
+    specific_requests = request_json.get("specific_requests") or [request_json["specific_request"]]
+    extra_task_config = {
+        key: value
+        for key, value in request_json.items()
+        if key not in ("specific_request", "specific_requests", "target_project", "target_dataset")
+    }
+    extra_task_config["reenqueue_attempt"] = attempt
+    tasks_parent = get_tasks_parent()
+    (outcome,) = create_tasks(
+        tasks_parent,
+        [
+            build_report_task(
+                specific_requests,
+                target_project,
+                target_dataset,
+                tasks_parent,
+                f"{datetime.datetime.now().strftime('%m/%d/%Y-%H:%M:%S')}_requeue{attempt}",
+                delay=not_ready_error.retry_after,
+                extra_task_config=extra_task_config,
+            )
+        ],
+    )
+    if not outcome.ok:
+        raise Exception(f"Error while creating task: {outcome.name} - {str(outcome.error)}")
+    return f"{not_ready_error}, re-enqueued the task (attempt {attempt})"
+
+
+def report_table_name(specific_request_metrics):
+    ad_type = specific_request_metrics["ad_type"]
+    record_type = specific_request_metrics["record_type"]
+    account_id = specific_request_metrics["account_id"]
+    country_code = specific_request_metrics["country_code"]
+    tactic = specific_request_metrics["tactic"]
+    creativeType = specific_request_metrics["creativeType"]
+
+    if tactic is not None:
+        return f"amz_ads_{ad_type}_{record_type}_{account_id}_{country_code}_{tactic}"
+    elif creativeType is not None:
+        return f"amz_ads_{ad_type}_{record_type}_{account_id}_{country_code}_{creativeType}"
+    else:
+        return f"amz_ads_{ad_type}_{record_type}_{account_id}_{country_code}"
+
+
+def get_tasks_parent():
+    return get_tasks_client().queue_path("precis-aarhus-internal", "europe-west1", "lastobject-amz-api-queue")
+
+
+def dispatch_standard_task(
+    tasks_parent, http_method, url, service_account, name, dispatch_deadline, task_config, delay=None
+):
+    task = build_http_task(url, service_account, name, dispatch_deadline, task_config, delay=delay)
+    (outcome,) = create_tasks(tasks_parent, [task])
+    if not outcome.ok:
+        msg = f"Error while creating task: {name} - {str(outcome.error)}"
+        logging.error(msg)
         raise Exception(msg)
@@ -7,23 +7,26 @@ import json
 import os
 import copy
 import time
-from gzip import decompress
 import io
 import csv
 
-# Load this from Secrets Manager instead when deployed
-from google.cloud import secretmanager
-from pd_utils.service_to_service.service_account import ServiceAccountCredentials
+import config
+from services.amz_advertising.credentials import amz_credentials_provider
+from services.amz_advertising.profiles import profile_index
+from services.amz_advertising.rate_limit import backoff_delay, get_rate_limiter, parse_retry_after
+from services.amz_advertising.readiness import ReportNotReadyError, report_readiness
+from services.amz_advertising.report_cache import disk_report_cache, report_request_coalescer
+from services.amz_advertising.report_registry import get_report_definition
+from services.amz_advertising.report_stream import iter_gunzip, iter_json_array
+from services.amz_advertising.sessions import get_session, get_timeout
+from services.amz_advertising.token_cache import access_token_cache
+from utils.metrics import metrics, timed, timed_iter
 
-secretmanager_client = secretmanager.SecretManagerServiceClient(credentials=ServiceAccountCredentials().get_credentials())
-andreas_amz_credentials = json.loads(
-secretmanager_client.access_secret_version(
-        name="projects/269322900495/secrets/lo-az-ads/versions/1"
-    ).payload.data.decode("UTF-8")
-)
 
 class AmazonAdvertisingApiService:
-    def __init__(self, region, credentials=andreas_amz_credentials):
+    def __init__(self, region, credentials=None):
+        if credentials is None:
+            credentials = amz_credentials_provider.get()
         if "refresh_token" not in credentials:
             raise Exception("Malformed Credentials - 'refresh_token' not found in the credentials.")
 
@@ -33,66 +36,116 @@ class AmazonAdvertisingApiService:
             "Content-Type": "application/json",
         }
 
-        self._profiles = []
+        self._region = region
+        self._session = get_session(region)
+        self._auth_session = get_session("AUTH")
+        if region not in config.AMZ_API_URLS:
+            raise Exception(f"Invalid value: region '{region}'")
+        self._base_url = config.AMZ_API_URLS[region]
 
-        self._pre_request_sleep_time = 0
-        if region == "EU":
-            self._base_url = "https://advertising-api-eu.amazon.com/v2"
-        elif region == "NA":
-            self._base_url = "https://advertising-api.amazon.com/v2"
-        elif region == "FE":
-            self._base_url = "https://advertising-api-fe.amazon.com/v2"
-
-        self._auth_url = "https://api.amazon.com/auth/o2/token"
-
-        with open("./services/amz_advertising/reports_fields.json") as reports_fields_file:
-            self._reports_fields = json.load(reports_fields_file)
-
-        with open("./services/amz_advertising/reports_fields_bq_schema.json") as reports_fields_bq_schema_file:
-            self._reports_fields_bq_schema = json.load(reports_fields_bq_schema_file)
+        self._auth_url = config.AMZ_AUTH_URL
 
         self._refresh_access_token()
 
-    def _make_request(self, url, method, headers=None, json_body=None, params=None, attempt=1):
-        initial_pre_request_sleep_time = 0
-        while initial_pre_request_sleep_time != self._pre_request_sleep_time:
-            initial_pre_request_sleep_time = self._pre_request_sleep_time
-            if initial_pre_request_sleep_time != 0:
-                logging.info(f"Sleeping for {initial_pre_request_sleep_time} second before making request to: {url}")
-                time.sleep(initial_pre_request_sleep_time)
-
-        if method == "POST":
-            res = requests.post(url, headers=headers, json=json_body, params=params)
-        elif method == "GET":
-            res = requests.get(url, headers=headers, params=params)
-
-        if res.status_code == 200:
-            self._pre_request_sleep_time = 0
-            return res
-        elif res.status_code == 202:
-            self._pre_request_sleep_time = 0
-            return res
-        elif res.status_code == 404:
-            raise Exception(
-                f"Requested ressource not found at URL: {url} with parameters: {params} and json_body: {json_body}"
+    def _make_request(self, url, method, headers=None, json_body=None, params=None, stream=False):
+        endpoint = self._endpoint(url, method)
+        with timed("amz_request", level=logging.DEBUG, endpoint=endpoint) as timer:
+            res = self._send_request(url, method, headers, json_body, params, stream, timer)
+            timer.fields["status"] = res.status_code
+        metrics.inc("amz_ads_requests", endpoint=endpoint, status=res.status_code)
+        return res
+
+    def _send_request(self, url, method, headers, json_body, params, stream, timer):
+        """Sends the request, retrying 429s and a rejected access token. Retries and sleeps are counted on timer"""
+        endpoint = timer.labels["endpoint"]
+        if url == self._auth_url:
+            session = self._auth_session
+            rate_limiter = None
+        else:
+            session = self._session
+            rate_limiter = get_rate_limiter(self._region, (headers or {}).get("Amazon-Advertising-API-Scope"))
+
+        token_refreshed = False
+        for attempt in range(1, config.AMZ_MAX_ATTEMPTS + 1):
+            if attempt > 1:
+                timer.fields["retries"] = attempt - 1
+                timer.level = logging.INFO
+                metrics.inc("amz_ads_request_retries", endpoint=endpoint)
+            if rate_limiter is not None:
+                waited = rate_limiter.acquire()
+                if waited:
+                    timer.fields["rate_limit_sleep"] = timer.fields.get("rate_limit_sleep", 0) + waited
+                    metrics.inc("amz_ads_rate_limit_sleep_seconds", waited, endpoint=endpoint)
+                if waited >= 1:
+                    logging.info(f"Waited {waited:.1f} seconds for rate limit before making request to: {url}")
+
+            if method == "POST":
+                res = session.post(url, headers=headers, json=json_body, params=params, timeout=get_timeout())
+            elif method == "GET":
+                res = session.get(url, headers=headers, params=params, timeout=get_timeout(), stream=stream)
+
+            if res.status_code == 200:
+                return res
+            elif res.status_code == 202:
+                return res
+            elif res.status_code == 401 and url != self._auth_url and not token_refreshed:
+                logging.info(f"Access token rejected by {url}, refreshing it and retrying once.")
+                token_refreshed = True
+                authorization = self._refresh_access_token(force=True)
+                if headers is not None and "Authorization" in headers:
+                    headers["Authorization"] = authorization
+            elif res.status_code == 404:
+                raise Exception(
+                    f"Requested ressource not found at URL: {url} with parameters: {params} and json_body: {json_body}"
+                )
+            elif res.status_code == 429 or "Retry-After" in res.headers:
+                delay = backoff_delay(attempt, parse_retry_after(res.headers.get("Retry-After")))
+                logging.info(f"Rate Limit hit. Attempt:{attempt}. Backing off for {delay:.1f} seconds.")
+                if rate_limiter is not None:
+                    rate_limiter.penalize(delay)
+                else:
+                    timer.fields["rate_limit_sleep"] = timer.fields.get("rate_limit_sleep", 0) + delay
+                    metrics.inc("amz_ads_rate_limit_sleep_seconds", delay, endpoint=endpoint)
+                    time.sleep(delay)
+            else:
+                raise Exception(f"Unhandled API {res.status_code} Error:\n{res.text}")
+
+        raise Exception(f"Attempts exceeded {config.AMZ_MAX_ATTEMPTS}. API {res.status_code} Error:\n{res.text}")
+
+    def _endpoint(self, url, method):
+        """Low cardinality name of the API endpoint of url, for metrics"""
+        if url == self._auth_url:
+            return "token"
+        elif "/download" in url or not url.startswith(self._base_url):
+            return "download"
+        elif url.endswith("/profiles"):
+            return "profiles"
+        elif "/reports/" in url:
+            return "report_status"
+        elif method == "POST" and url.endswith("/report"):
+            return "create_report"
+        return "other"
+
+    def _refresh_access_token(self, force=False):
+        if force:
+            stale_token = self._headers.get("Authorization", "").replace("Bearer ", "")
+            access_token_cache.invalidate(
+                self._credentials["client_id"], self._credentials["refresh_token"], stale_token or None
             )
-        elif res.status_code == 429 or "Retry-After" in res.headers:
-            self._pre_request_sleep_time = max(10 ** attempt * 2, self._pre_request_sleep_time)
 
-            logging.info(f"Rate Limit hit. Attempt:{attempt}.")
+        access_token = access_token_cache.get(
+            self._credentials["client_id"], self._credentials["refresh_token"], self._request_access_token
+        )
 
-            attempt = attempt + 1
-            if attempt > 10:
-                raise Exception(f"Attempts exceeded 10. API {res.status_code} Error:\n{res.text}")
-            return self._make_request(url, method, headers, json_body, params, attempt)
-        else:
-            raise Exception(f"Unhandled API {res.status_code} Error:\n{res.text}")
+        self._headers["Authorization"] = f"Bearer {access_token}"
+        return f"Bearer {access_token}"
 
-    def _refresh_access_token(self):
+    def _request_access_token(self):
+        headers = {k: v for k, v in self._headers.items() if k != "Authorization"}
         res = self._make_request(
             url=self._auth_url,
             method="POST",
-            headers=self._headers,
+            headers=headers,
             json_body={
                 "grant_type": "refresh_token",
                 "refresh_token": self._credentials["refresh_token"],
@@ -100,68 +153,152 @@ class AmazonAdvertisingApiService:
                 "client_secret": self._credentials["client_secret"],
             },
         )
-
-        access_token = res.json()["access_token"]
-
-        self._headers["Authorization"] = f"Bearer {access_token}"
-        return f"Bearer {access_token}"
-
-    def _download_report(self, link, headers):
-        report_res = self._make_request(url=link, method="GET", headers=headers)
-
-        decompressed_file = decompress(report_res.content)
-        return json.loads(decompressed_file)
+        return res.json()
+
+    def _download_report(self, report_id, link, headers):
+        """Streams the gzip report and yields its rows one at a time instead of holding the whole file in memory"""
+        payload = timed_iter(iter_gunzip(self._download_report_chunks(report_id, link, headers)), "decompress", len)
+        return timed_iter(iter_json_array(payload), "parse")
+
+    def _download_report_chunks(self, report_id, link, headers):
+        """
+        Yields the gzip payload of the report in chunks as it is downloaded.
+        Payloads go through the disk report cache, so downloading the same report again is read from disk.
+        """
+        cached_payload = disk_report_cache.open(report_id) if report_id else None
+        if cached_payload is not None:
+            logging.info(f"Reading report {report_id} from the disk report cache")
+            with cached_payload:
+                chunk_size = config.AMZ_REPORT_DOWNLOAD_CHUNK_SIZE
+                yield from timed_iter(
+                    iter(lambda: cached_payload.read(chunk_size), b""), "download", len, source="cache"
+                )
+            return
+
+        report_res = self._make_request(url=link, method="GET", headers=headers, stream=True)
+        try:
+            chunks = timed_iter(
+                report_res.iter_content(chunk_size=config.AMZ_REPORT_DOWNLOAD_CHUNK_SIZE),
+                "download",
+                len,
+                source="amazon",
+            )
+            yield from disk_report_cache.tee(report_id, chunks) if report_id else chunks
+        finally:
+            report_res.close()
 
     def list_profiles(self):
-        if self._profiles == []:
-            res = self._make_request(url=f"{self._base_url}/profiles", method="GET", headers=self._headers)
-
-            self._profiles = res.json()
-
-        return self._profiles
+        return self._get_profile_index().profiles
 
     def get_profile_id(self, country_code, account_id):
-        all_profiles = self.list_profiles()
-
-        for profile in all_profiles:
-            if profile.get("countryCode") == country_code and profile.get("accountInfo").get("id") == account_id:
-                return profile.get("profileId")
-
-        raise Exception(f"Couldn't find profile with country_code '{country_code}' & account_id '{account_id}'")
-
-    def get_report(self, report_id, ad_type, record_type, report_date, country_code, account_id, tactic, creativeType):
-        profile_id = self.get_profile_id(country_code, account_id)
-
-        headers = copy.deepcopy(self._headers)
-        headers["Amazon-Advertising-API-Scope"] = str(profile_id)
-
-        report_status = "IN_PROGRESS"
-
-        while report_status == "IN_PROGRESS":
-            time.sleep(5)
-            report_fetch_res = self._make_request(
-                url=f"{self._base_url}/reports/{report_id}", method="GET", headers=headers
+        profile = self._get_profile_index().by_marketplace.get((country_code, account_id))
+        if profile is None:
+            # The profile may have been added since the index was fetched: refetch it (unless it was just fetched)
+            entry = profile_index.refresh(self._region, self._credentials["client_id"], self._request_profiles)
+            profile = entry.by_marketplace.get((country_code, account_id))
+        if profile is None:
+            raise Exception(f"Couldn't find profile with country_code '{country_code}' & account_id '{account_id}'")
+        return profile.get("profileId")
+
+    def _get_profile_index(self):
+        return profile_index.get(self._region, self._credentials["client_id"], self._request_profiles)
+
+    def _request_profiles(self):
+        res = self._make_request(url=f"{self._base_url}/profiles", method="GET", headers=self._headers)
+        return res.json()
+
+    def get_report(
+        self,
+        report_id,
+        ad_type,
+        record_type,
+        report_date,
+        country_code,
+        account_id,
+        tactic,
+        creativeType,
+        created_at=None,
+        deadline=None,
+    ):
+        """
+        Waits for the report to leave IN_PROGRESS, then returns its streamed rows and bq schema (None if it failed).
+        Polls are spaced by report_readiness, learned from past generation times of the same report kind.
+        created_at: epoch seconds the report was created, if known (used for poll spacing and learning)
+        deadline: epoch seconds after which ReportNotReadyError is raised instead of polling on,
+            defaults to AMZ_REPORT_POLL_DEADLINE_SECONDS from now
+        """
+        readiness_key = (ad_type, record_type, country_code)
+        started_at = time.time()
+        deadline = deadline or started_at + config.AMZ_REPORT_POLL_DEADLINE_SECONDS
+        overdue_polls = 0
+
+        with timed("wait_report", ad_type=ad_type, record_type=record_type) as timer:
+            timer.fields["report_id"] = report_id
+            while True:
+                report_status_json = self.get_report_status(report_id, country_code, account_id)
+                timer.fields["polls"] = timer.fields.get("polls", 0) + 1
+                if report_status_json.get("status") != "IN_PROGRESS":
+                    break
+
+                elapsed = time.time() - (created_at or started_at)
+                sleep_seconds = report_readiness.next_poll_in(readiness_key, elapsed, overdue_polls)
+                if elapsed >= report_readiness.expected_seconds(readiness_key):
+                    overdue_polls += 1
+                if time.time() + sleep_seconds > deadline:
+                    raise ReportNotReadyError(report_id, sleep_seconds)
+                time.sleep(sleep_seconds)
+
+        if report_status_json.get("status") == "SUCCESS" and created_at is not None:
+            report_readiness.record(readiness_key, time.time() - created_at)
+            metrics.observe(
+                "amz_ads_report_generation_seconds", time.time() - created_at, ad_type=ad_type, record_type=record_type
             )
 
-            report_fetch_json = report_fetch_res.json()
+        return self.download_ready_report(
+            report_status_json, ad_type, record_type, country_code, account_id, tactic, creativeType
+        )
 
-            report_status = report_fetch_json.get("status")
+    def get_report_status(self, report_id, country_code, account_id):
+        """Polls the report once, returns the status json (status IN_PROGRESS, SUCCESS or FAILURE)"""
+        report_fetch_res = self._make_request(
+            url=f"{self._base_url}/reports/{report_id}",
+            method="GET",
+            headers=self._profile_headers(country_code, account_id),
+        )
+        return report_fetch_res.json()
 
-        if report_status != "SUCCESS":
-            logging.warning(f"Generating report did not succeed: {report_fetch_res.text}")
+    def download_ready_report(
+        self, report_status_json, ad_type, record_type, country_code, account_id, tactic, creativeType
+    ):
+        """
+        Returns the streamed rows and bq schema of a report given its status json, None if it did not succeed.
+        "report_chunks" streams the raw gzip payload instead of the rows, only one of the two may be consumed.
+        """
+        if report_status_json.get("status") != "SUCCESS":
+            logging.warning(f"Generating report did not succeed: {json.dumps(report_status_json)}")
+            # Retries must request a new report instead of polling the failed one
+            report_request_coalescer.forget(report_status_json.get("reportId"))
             return None
 
-        report = self._download_report(report_fetch_json["location"], headers)
+        download_args = (
+            report_status_json.get("reportId"),
+            report_status_json["location"],
+            self._profile_headers(country_code, account_id),
+        )
+        report = self._download_report(*download_args)
+        report_chunks = self._download_report_chunks(*download_args)
 
-        if tactic is not None:
-            bq_schema = self._reports_fields_bq_schema[ad_type][record_type][tactic]
-        else:
-            bq_schema = self._reports_fields_bq_schema[ad_type][record_type]
+        bq_schema = get_report_definition(ad_type, record_type, tactic, creativeType).schema_fields
 
-        return {"report": report, "bq_schema": bq_schema}
+        return {"report": report, "report_chunks": report_chunks, "bq_schema": bq_schema}
+
+    def _profile_headers(self, country_code, account_id):
+        headers = copy.deepcopy(self._headers)
+        headers["Amazon-Advertising-API-Scope"] = str(self.get_profile_id(country_code, account_id))
+        return headers
 
     def create_new_report(
-        self, ad_type, record_type, report_date, country_code, account_id, tactic=None, creativeType=None
+        self, ad_type, record_type, report_date, country_code, account_id, tactic=None, creativeType=None, force=False
     ):
         if record_type not in ["campaigns", "adGroups", "keywords", "productAds", "asins", "targets"]:
             raise Exception("Invalid value: record_type")
@@ -174,6 +311,8 @@ class AmazonAdvertisingApiService:
         headers = copy.deepcopy(self._headers)
         headers["Amazon-Advertising-API-Scope"] = str(profile_id)
 
+        report_definition = get_report_definition(ad_type, record_type, tactic, creativeType)
+
         json_body = {}
         if ad_type == "hsa" and creativeType != None:
             json_body["creativeType"] = creativeType
@@ -194,26 +333,35 @@ class AmazonAdvertisingApiService:
             if tactic == "T00030" and country_code not in ["US", "CA", "UK", "DE", "FR", "IT", "ES", "AE", "JP", "IN"]:
                 return None
 
-            json_body["metrics"] = ",".join(self._reports_fields[ad_type][record_type][tactic])
-            if self._reports_fields[ad_type][record_type][tactic] == []:
+            if report_definition.metrics == ():
                 return None
-        elif ad_type == "hsa":
-            key = creativeType if creativeType != None else "none"
-            json_body["metrics"] = ",".join(self._reports_fields[ad_type][key][record_type])
-        else:
-            json_body["metrics"] = ",".join(self._reports_fields[ad_type][record_type])
+
+        json_body["metrics"] = report_definition.metrics_param
 
         json_body["reportDate"] = report_date
 
         if tactic is not None:
             json_body["tactic"] = tactic
 
-        report_init_res = self._make_request(
-            url=f"{self._base_url}/{ad_type}/{record_type}/report", method="POST", headers=headers, json_body=json_body
+        def request_report():
+            with timed("create_report", ad_type=ad_type, record_type=record_type) as timer:
+                report_init_res = self._make_request(
+                    url=f"{self._base_url}/{ad_type}/{record_type}/report",
+                    method="POST",
+                    headers=headers,
+                    json_body=json_body,
+                )
+                timer.fields["report_id"] = report_init_res.json().get("reportId")
+                return timer.fields["report_id"]
+
+        # The dispatcher and tasks creating the same report share one report_id instead of each requesting it,
+        # a forced rerun requests a new report
+        return report_request_coalescer.get_or_create(
+            (profile_id, ad_type, record_type, report_date, tactic, creativeType),
+            request_report,
+            reuse_recent=not force,
         )
 
-        return report_init_res.json().get("reportId")
-
         # return self.get_report(report_id,ad_type,record_type,report_date,country_code,account_id,tactic)
 
 
@@ -226,10 +374,10 @@ if __name__ == "__main__":
     #    report_id, "sd", "targets", "20210626", "US", "A2F1M85EMKLCHV", "remarketing", None
     # )
     # print(list(report["report"][0].keys()))
-    #print(amz_api_service.list_profiles())
+    # print(amz_api_service.list_profiles())
     # print(amz_api_service.create_new_report('sp','campaigns','20210407','US','A2F1M85EMKLCHV'))
 
-    '''
+    """
     ## Jhonys Code
     access_token = amz_api_service._headers['Authorization']
     from requests.structures import CaseInsensitiveDict
@@ -251,5 +399,4 @@ if __name__ == "__main__":
     
     fe_endpoint = "https://advertising-api.amazon.com/v2"
     print(get_profiles(fe_endpoint,access_token))
-    '''    
-
+    """
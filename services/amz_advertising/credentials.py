@@ -0,0 +1,75 @@
+import json
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+import config
+
+ENV_VAR_AMZ_CREDENTIALS_JSON = "AMZ_ADS_CREDENTIALS_JSON"
+ENV_VAR_AMZ_CREDENTIALS_FILE = "AMZ_ADS_CREDENTIALS_FILE"
+
+
+class AmazonCredentialsProvider:
+    """
+    Lazily loads the Amazon Advertising API credentials (client_id, client_secret, refresh_token) on first use and
+    caches them for `ttl` seconds.
+    Sources, in order:
+     - a json file, path given by credentials_file or the AMZ_ADS_CREDENTIALS_FILE env var (local dev / tests)
+     - a json string in the AMZ_ADS_CREDENTIALS_JSON env var (local dev / tests)
+     - the Secret Manager secret version `secret_name` (deployed)
+    """
+
+    def __init__(self, secret_name: str, ttl: float, credentials_file: Optional[str] = None):
+        self.secret_name = secret_name
+        self.ttl = ttl
+        self.credentials_file = credentials_file
+        self._credentials = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def get(self) -> dict:
+        with self._lock:
+            if self._credentials is None or time.monotonic() - self._loaded_at > self.ttl:
+                self._credentials = self._load()
+                self._loaded_at = time.monotonic()
+            return self._credentials
+
+    def invalidate(self) -> None:
+        with self._lock:
+            self._credentials = None
+
+    def _load(self) -> dict:
+        credentials_file = self.credentials_file or os.environ.get(ENV_VAR_AMZ_CREDENTIALS_FILE)
+        if credentials_file:
+            logging.info(f"Loading Amazon Advertising credentials from file {credentials_file}")
+            with open(credentials_file) as f:
+                return json.load(f)
+
+        credentials_json = os.environ.get(ENV_VAR_AMZ_CREDENTIALS_JSON)
+        if credentials_json:
+            logging.info(f"Loading Amazon Advertising credentials from env var {ENV_VAR_AMZ_CREDENTIALS_JSON}")
+            return json.loads(credentials_json)
+
+        return self._load_from_secret_manager()
+
+    def _load_from_secret_manager(self) -> dict:
+        # Imported here so importing the service (tests, local runs, cold starts) doesn't resolve GCP credentials
+        from google.cloud import secretmanager
+
+        from pd_utils.service_to_service.service_account import (
+            ServiceAccountCredentials,
+        )
+
+        logging.info(f"Loading Amazon Advertising credentials from Secret Manager {self.secret_name}")
+        secretmanager_client = secretmanager.SecretManagerServiceClient(
+            credentials=ServiceAccountCredentials().get_credentials()
+        )
+        secret = secretmanager_client.access_secret_version(name=self.secret_name)
+        return json.loads(secret.payload.data.decode("UTF-8"))
+
+
+amz_credentials_provider = AmazonCredentialsProvider(
+    secret_name=config.AMZ_CREDENTIALS_SECRET, ttl=config.AMZ_CREDENTIALS_TTL_SECONDS
+)
@@ -0,0 +1,42 @@
+import datetime
+from typing import Optional
+
+import config
+from services.amz_advertising.report_registry import get_report_definition
+from utils.ledger import LOADED, LedgerEntry
+
+
+def report_lookback_days(ad_type: str, record_type: str, tactic: Optional[str], creativeType: Optional[str]) -> int:
+    """
+    Days after a report date during which Amazon can still change the report's metrics: the longest attribution
+    window of its metrics in reports_fields.json (e.g. 30 for attributedSales30d), at least AMZ_MIN_LOOKBACK_DAYS
+    for unattributed metrics (impressions, clicks and cost are restated for invalid traffic too)
+    """
+    lookback_days = get_report_definition(ad_type, record_type, tactic, creativeType).lookback_days
+    return max(lookback_days, config.AMZ_MIN_LOOKBACK_DAYS)
+
+
+def settles_on(report_date: datetime.date, lookback_days: int) -> datetime.date:
+    """First day on which the partition of report_date can no longer change"""
+    return report_date + datetime.timedelta(days=lookback_days + config.AMZ_LOOKBACK_MARGIN_DAYS)
+
+
+def partition_settled(report_date: str, lookback_days: int, today: datetime.date) -> bool:
+    """
+    Whether the partition of a YYYYMMDD report_date can no longer change as of today. Used without a load ledger
+    (GET ?skip_settled=true), when the runs that loaded it while it could still change are known to have run.
+    """
+    return today >= settles_on(datetime.datetime.strptime(report_date, "%Y%m%d").date(), lookback_days)
+
+
+def partition_needs_refresh(entry: Optional[LedgerEntry], lookback_days: int) -> bool:
+    """
+    Whether the partition of a ledger entry's report must be (re)loaded: it was never loaded successfully, or its
+    last load happened before it settled, so Amazon may have changed its data since. A partition loaded on or after
+    the day it settles is final and never requested again.
+    """
+    if entry is None or entry.status != LOADED:
+        return True
+    report_date = datetime.datetime.strptime(entry.key.report_date, "%Y%m%d").date()
+    loaded_on = datetime.datetime.fromtimestamp(entry.updated_at, tz=datetime.timezone.utc).date()
+    return loaded_on < settles_on(report_date, lookback_days)
@@ -0,0 +1,136 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import config
+
+
+class ProfileIndexEntry(NamedTuple):
+    profiles: List[dict]
+    by_marketplace: Dict[Tuple[str, str], dict]
+    fetched_at: float
+
+
+class ProfileIndex:
+    """
+    Process wide index of Amazon Advertising profiles per (region, client_id), keyed by (country_code, account_id),
+    so resolving a profile is a dict lookup instead of a /profiles request per service instance and a scan per call.
+    Entries expire after `ttl` seconds. Concurrent callers missing the same region wait on a single /profiles
+    request. If persist_file is set, the index is also saved there and read back by fresh processes, as long as it
+    is younger than the ttl. refresh() refetches an entry before its ttl (e.g. a profile is missing from it), unless
+    it was fetched less than refresh_cooldown seconds ago.
+    """
+
+    def __init__(self, ttl: float, persist_file: Optional[str] = None, refresh_cooldown: float = 0.0):
+        self.ttl = ttl
+        self.persist_file = persist_file
+        self.refresh_cooldown = refresh_cooldown
+        self._entries: Dict[Tuple[str, str], ProfileIndexEntry] = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+        self._persisted_loaded = False
+
+    def get(self, region: str, client_id: str, fetch_profiles: Callable[[], List[dict]]) -> ProfileIndexEntry:
+        key = (region, client_id)
+        entry = self._get_valid(key)
+        if entry is not None:
+            return entry
+
+        with self._get_key_lock(key):
+            self._load_persisted()
+            entry = self._get_valid(key)
+            if entry is not None:
+                return entry
+            return self._fetch(key, fetch_profiles)
+
+    def refresh(self, region: str, client_id: str, fetch_profiles: Callable[[], List[dict]]) -> ProfileIndexEntry:
+        """
+        Refetches the profiles of a region, unless they were fetched less than refresh_cooldown seconds ago, so
+        lookups of a profile that doesn't exist (e.g. a misconfigured account) don't request /profiles every time
+        """
+        key = (region, client_id)
+        with self._get_key_lock(key):
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry.fetched_at < self.refresh_cooldown:
+                return entry
+            return self._fetch(key, fetch_profiles)
+
+    def _fetch(self, key, fetch_profiles: Callable[[], List[dict]]) -> ProfileIndexEntry:
+        entry = _index(fetch_profiles(), time.time())
+        self._entries[key] = entry
+        logging.info(f"Indexed {len(entry.profiles)} Amazon Advertising profiles of region {key[0]}")
+        self._persist()
+        return entry
+
+    def invalidate(self, region: str, client_id: str) -> None:
+        with self._lock:
+            self._entries.pop((region, client_id), None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _get_valid(self, key) -> Optional[ProfileIndexEntry]:
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry.fetched_at < self.ttl:
+            return entry
+        return None
+
+    def _get_key_lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _load_persisted(self) -> None:
+        if self._persisted_loaded or not self.persist_file:
+            return
+        self._persisted_loaded = True
+        try:
+            with open(self.persist_file) as f:
+                persisted = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable profile index file {self.persist_file}: {e}")
+            return
+        with self._lock:
+            for item in persisted:
+                key = (item["region"], item["client_id"])
+                if key not in self._entries:
+                    self._entries[key] = _index(item["profiles"], item["fetched_at"])
+
+    def _persist(self) -> None:
+        if not self.persist_file:
+            return
+        with self._lock:
+            persisted = [
+                {"region": region, "client_id": client_id, "profiles": entry.profiles, "fetched_at": entry.fetched_at}
+                for (region, client_id), entry in self._entries.items()
+            ]
+        try:
+            directory = os.path.dirname(os.path.abspath(self.persist_file))
+            fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".part")
+            with os.fdopen(fd, "w") as f:
+                json.dump(persisted, f)
+            os.replace(temp_path, self.persist_file)
+        except OSError as e:
+            logging.warning(f"Could not persist the profile index to {self.persist_file}: {e}")
+
+
+def _index(profiles: List[dict], fetched_at: float) -> ProfileIndexEntry:
+    by_marketplace = {}
+    for profile in profiles:
+        key = (profile.get("countryCode"), (profile.get("accountInfo") or {}).get("id"))
+        # Keep the first profile per marketplace, as the linear scan this replaces did
+        by_marketplace.setdefault(key, profile)
+    return ProfileIndexEntry(profiles, by_marketplace, fetched_at)
+
+
+profile_index = ProfileIndex(
+    ttl=config.AMZ_PROFILE_INDEX_TTL_SECONDS,
+    persist_file=config.AMZ_PROFILE_INDEX_FILE or None,
+    refresh_cooldown=config.AMZ_PROFILE_REFRESH_COOLDOWN_SECONDS,
+)
@@ -0,0 +1,98 @@
+import datetime
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Optional
+
+import config
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket, refilled continuously at `rate` tokens per second up to `capacity`.
+    A 429 from Amazon pauses the whole bucket via `penalize`, so every thread sharing it backs off together
+    instead of each one discovering the throttle on its own.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Blocks until a token is available, returns the number of seconds spent waiting"""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self._blocked_until - now
+                if wait <= 0:
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return waited
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def penalize(self, delay: float) -> None:
+        """Drains the bucket and blocks all acquirers for `delay` seconds"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._tokens = 0
+            self._blocked_until = max(self._blocked_until, now + delay)
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def get_rate_limiter(region: str, profile_id: Optional[str] = None) -> TokenBucket:
+    """Returns the process wide token bucket for a region/profile pair, shared by all service instances and threads"""
+    key = (region, profile_id)
+    bucket = _buckets.get(key)
+    if bucket is None:
+        with _buckets_lock:
+            bucket = _buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(rate=config.AMZ_RATE_LIMIT_RPS, capacity=config.AMZ_RATE_LIMIT_BURST)
+                _buckets[key] = bucket
+    return bucket
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Parses a Retry-After header given either as delay-seconds or as an HTTP date, returns seconds to wait"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """
+    Full jitter exponential backoff: uniform(0, min(cap, base * 2 ** (attempt - 1))).
+    A Retry-After sent by Amazon is honoured as a lower bound, but still capped.
+    """
+    ceiling = min(config.AMZ_BACKOFF_CAP_SECONDS, config.AMZ_BACKOFF_BASE_SECONDS * 2 ** (attempt - 1))
+    delay = random.uniform(0, ceiling)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, config.AMZ_BACKOFF_CAP_SECONDS))
+    return delay
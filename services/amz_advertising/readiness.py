@@ -0,0 +1,101 @@
+import threading
+import time
+from typing import Dict, Hashable, Tuple
+
+import config
+
+
+class ReportNotReadyError(Exception):
+    """Raised when a report is still IN_PROGRESS at the polling deadline, retry_after is the suggested wait in seconds"""
+
+    def __init__(self, report_id: str, retry_after: float):
+        super().__init__(f"Report {report_id} not ready, retry in {retry_after:.0f} seconds")
+        self.report_id = report_id
+        self.retry_after = retry_after
+
+
+class ReportReadinessScheduler:
+    """
+    Learns how long Amazon takes to generate reports per (ad_type, record_type, marketplace) as an exponentially
+    weighted mean/deviation of observed creation -> SUCCESS times, and uses it to
+     - pick the initial Cloud Task delay (mean + 2 deviations, instead of a fixed 30 minutes)
+     - space status polls: sleep until the report is expected, then back off exponentially
+    The instances dispatching tasks never poll reports, so the statistics learned by the report tasks are shared
+    through the load ledger (see pop_updates and load), without a ledger the initial delay stays at the default.
+    """
+
+    def __init__(
+        self,
+        default_seconds: float,
+        min_poll_seconds: float,
+        max_poll_seconds: float,
+        min_delay_seconds: float,
+        max_delay_seconds: float,
+        alpha: float = 0.3,
+    ):
+        self.default_seconds = default_seconds
+        self.min_poll_seconds = min_poll_seconds
+        self.max_poll_seconds = max_poll_seconds
+        self.min_delay_seconds = min_delay_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self.alpha = alpha
+        self._stats: Dict[Hashable, Tuple[float, float]] = {}
+        self._updates = set()
+        self.synced_at = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, key: Hashable, generation_seconds: float) -> None:
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                self._stats[key] = (generation_seconds, generation_seconds / 2)
+            else:
+                mean, deviation = stats
+                deviation = (1 - self.alpha) * deviation + self.alpha * abs(generation_seconds - mean)
+                mean = (1 - self.alpha) * mean + self.alpha * generation_seconds
+                self._stats[key] = (mean, deviation)
+            self._updates.add(key)
+
+    def pop_updates(self) -> Dict[Hashable, Tuple[float, float]]:
+        """(mean, deviation) of the keys recorded since the last call, to be shared with other instances"""
+        with self._lock:
+            updates = {key: self._stats[key] for key in self._updates}
+            self._updates.clear()
+            return updates
+
+    def load(self, stats: Dict[Hashable, Tuple[float, float]]) -> None:
+        """Replaces the statistics of keys with those shared by other instances, except keys with unshared updates"""
+        with self._lock:
+            for key, key_stats in stats.items():
+                if key not in self._updates:
+                    self._stats[key] = key_stats
+            self.synced_at = time.monotonic()
+
+    def expected_seconds(self, key: Hashable) -> float:
+        stats = self._stats.get(key)
+        return self.default_seconds if stats is None else stats[0]
+
+    def initial_delay(self, key: Hashable) -> float:
+        """Seconds to wait after creating a report before its Cloud Task first checks on it"""
+        stats = self._stats.get(key)
+        mean, deviation = (self.default_seconds, self.default_seconds / 2) if stats is None else stats
+        return min(self.max_delay_seconds, max(self.min_delay_seconds, mean + 2 * deviation))
+
+    def next_poll_in(self, key: Hashable, elapsed: float, overdue_polls: int) -> float:
+        """
+        Seconds until the next status poll, given the seconds elapsed since the report was created and the number of
+        polls already made after it was expected to be ready
+        """
+        remaining = self.expected_seconds(key) - elapsed
+        if remaining > self.min_poll_seconds:
+            return min(remaining, self.max_poll_seconds)
+        return min(self.max_poll_seconds, self.min_poll_seconds * 1.5 ** overdue_polls)
+
+
+report_readiness = ReportReadinessScheduler(
+    default_seconds=config.AMZ_REPORT_DEFAULT_GENERATION_SECONDS,
+    min_poll_seconds=config.AMZ_REPORT_MIN_POLL_SECONDS,
+    max_poll_seconds=config.AMZ_REPORT_MAX_POLL_SECONDS,
+    min_delay_seconds=config.AMZ_REPORT_MIN_TASK_DELAY_SECONDS,
+    max_delay_seconds=config.AMZ_REPORT_MAX_TASK_DELAY_SECONDS,
+)
@@ -0,0 +1,200 @@
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import BinaryIO, Callable, Hashable, Iterable, Iterator, Optional
+
+import config
+
+_SAFE_FILENAME_REGEX = re.compile(r"[^0-9a-zA-Z._-]+")
+
+
+class ReportRequestCoalescer:
+    """
+    Process wide dedupe of report creation keyed by the report parameters (profile, ad_type, record_type, date,
+    tactic, creativeType). Concurrent identical requests wait on the single in-flight create call and share its
+    report_id, and the report_id is reused for `ttl` seconds afterwards instead of creating the same report again,
+    unless the report is forgotten once it failed. Expired report_ids are evicted when new ones are added.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._recent = {}
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_or_create(self, key: Hashable, create: Callable[[], str], reuse_recent: bool = True) -> str:
+        """
+        report_id of the in-flight or recent create call of key, else of create().
+        reuse_recent=False skips the recent report_id (a forced rerun), the new report_id replaces it.
+        """
+        with self._lock:
+            recent = self._recent.get(key)
+            if reuse_recent and recent is not None and time.monotonic() - recent[1] < self.ttl:
+                logging.info(f"Reusing report {recent[0]} created {time.monotonic() - recent[1]:.0f}s ago for {key}")
+                return recent[0]
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._in_flight[key] = Future()
+
+        if not is_owner:
+            logging.info(f"Waiting for the identical in-flight report request for {key}")
+            return future.result()
+
+        try:
+            report_id = create()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(report_id)
+            if report_id is not None:
+                with self._lock:
+                    self._evict_expired()
+                    self._recent[key] = (report_id, time.monotonic())
+            return report_id
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def forget(self, report_id: str) -> None:
+        """Stops reusing report_id, e.g. its report ended FAILURE or CANCELLED, so the next request creates it again"""
+        with self._lock:
+            for key in [key for key, recent in self._recent.items() if recent[0] == report_id]:
+                del self._recent[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._recent.clear()
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        for key in [key for key, recent in self._recent.items() if now - recent[1] >= self.ttl]:
+            del self._recent[key]
+
+
+class DiskReportCache:
+    """
+    Size bounded LRU cache of downloaded report payloads (the raw gzip bytes) on local disk, keyed by report_id, so a
+    report downloaded again (task retry, re-enqueue, overlapping runs) is read from disk instead of from Amazon.
+    Entries surviving in the directory from earlier processes are picked up oldest first. max_bytes=0 disables it.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    def open(self, report_id: str) -> Optional[BinaryIO]:
+        """The cached payload of report_id opened for reading, None if it is not cached"""
+        if not self.max_bytes:
+            return None
+        report_id = _file_key(report_id)
+        with self._lock:
+            self._load_index()
+            if report_id not in self._entries:
+                return None
+            self._entries.move_to_end(report_id)
+        try:
+            payload = open(self._path(report_id), "rb")
+            os.utime(self._path(report_id))
+            return payload
+        except FileNotFoundError:
+            self._forget(report_id)
+            return None
+
+    def tee(self, report_id: str, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        Passes chunks through while writing them to the cache. The payload is only added once all chunks were
+        consumed, a download that fails or is abandoned half way leaves nothing behind.
+        """
+        if not self.max_bytes:
+            yield from chunks
+            return
+
+        report_id = _file_key(report_id)
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+        temp_file = os.fdopen(fd, "wb")
+        size = 0
+        completed = False
+        try:
+            for chunk in chunks:
+                if temp_file is not None:
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        # Larger than the whole cache, stop spending disk (memory on Cloud Functions) on it
+                        temp_file.close()
+                        temp_file = None
+                    else:
+                        temp_file.write(chunk)
+                yield chunk
+            completed = temp_file is not None
+        finally:
+            if temp_file is not None:
+                temp_file.close()
+            if completed:
+                os.replace(temp_path, self._path(report_id))
+                self._add(report_id, size)
+            else:
+                os.remove(temp_path)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._load_index()
+            for report_id in list(self._entries):
+                self._evict(report_id)
+
+    def _add(self, report_id: str, size: int) -> None:
+        with self._lock:
+            self._load_index()
+            self._size += size - self._entries.pop(report_id, 0)
+            self._entries[report_id] = size
+            while self._size > self.max_bytes and len(self._entries) > 1:
+                self._evict(next(iter(self._entries)))
+
+    def _forget(self, report_id: str) -> None:
+        with self._lock:
+            self._size -= self._entries.pop(report_id, 0)
+
+    def _evict(self, report_id: str) -> None:
+        self._size -= self._entries.pop(report_id)
+        try:
+            os.remove(self._path(report_id))
+        except FileNotFoundError:
+            pass
+        logging.info(f"Evicted report {report_id} from the disk report cache")
+
+    def _load_index(self) -> None:
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.isdir(self.directory):
+            return
+        cached = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".gz") and entry.is_file():
+                stat = entry.stat()
+                cached.append((stat.st_mtime, entry.name[: -len(".gz")], stat.st_size))
+        for _, report_id, size in sorted(cached):
+            self._entries[report_id] = size
+            self._size += size
+
+    def _path(self, report_id: str) -> str:
+        return os.path.join(self.directory, f"{report_id}.gz")
+
+
+def _file_key(report_id: str) -> str:
+    return _SAFE_FILENAME_REGEX.sub("_", report_id)
+
+
+report_request_coalescer = ReportRequestCoalescer(ttl=config.AMZ_REPORT_ID_TTL_SECONDS)
+disk_report_cache = DiskReportCache(config.AMZ_REPORT_CACHE_DIR, config.AMZ_REPORT_CACHE_MAX_BYTES)
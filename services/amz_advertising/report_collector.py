@@ -0,0 +1,146 @@
+import logging
+import time
+from typing import Dict, Hashable, Iterator, List, NamedTuple, Optional, Tuple
+
+import config
+from services.amz_advertising.readiness import ReportNotReadyError, report_readiness
+from utils.metrics import log_event, metrics
+
+
+class OutstandingReport(NamedTuple):
+    report_id: str
+    ad_type: str
+    record_type: str
+    country_code: str
+    account_id: str
+    tactic: Optional[str]
+    creativeType: Optional[str]
+    created_at: Optional[float]
+    added_at: float
+
+    @property
+    def elapsed(self) -> float:
+        return time.time() - (self.created_at or self.added_at)
+
+
+class ReportCollector:
+    """
+    Waits for many created reports at once with a single polling loop, instead of one loop per report.
+
+    Outstanding reports are kept per profile and polled round-robin across profiles, every poll going through the
+    service's per profile rate limiter, so all reports share one rate budget. A report is handed off for download
+    as soon as it leaves IN_PROGRESS: collect() yields (key, report_dict) with report_dict as returned by
+    AmazonAdvertisingApiService.get_report (None if generating the report failed).
+    """
+
+    def __init__(self, amz_api_service, deadline: Optional[float] = None):
+        self._service = amz_api_service
+        self._deadline = deadline
+        self._outstanding: Dict[Tuple[str, str], Dict[Hashable, OutstandingReport]] = {}
+        self._overdue_polls: Dict[Hashable, int] = {}
+
+    def add(
+        self,
+        key: Hashable,
+        report_id: str,
+        ad_type: str,
+        record_type: str,
+        country_code: str,
+        account_id: str,
+        tactic: Optional[str] = None,
+        creativeType: Optional[str] = None,
+        created_at: Optional[float] = None,
+    ) -> None:
+        report = OutstandingReport(
+            report_id, ad_type, record_type, country_code, account_id, tactic, creativeType, created_at, time.time()
+        )
+        self._outstanding.setdefault((country_code, account_id), {})[key] = report
+        self._overdue_polls[key] = 0
+
+    def pending(self) -> List[Hashable]:
+        """Keys of the reports not collected yet"""
+        return [key for reports in self._outstanding.values() for key in reports]
+
+    def __len__(self) -> int:
+        return sum(len(reports) for reports in self._outstanding.values())
+
+    def collect(self) -> Iterator[Tuple[Hashable, Optional[dict]]]:
+        """
+        Polls until every report is collected, yielding each one as soon as it is ready.
+        Raises ReportNotReadyError once the deadline passes, pending() lists the reports not collected yet. The
+        deadline is checked before every report, as the caller downloads and loads each yielded report before
+        resuming the loop, so a batch of ready reports can't hold the caller far past the deadline.
+        """
+        deadline = self._deadline or time.time() + config.AMZ_REPORT_POLL_DEADLINE_SECONDS
+
+        while len(self):
+            for key, report in self._round_robin():
+                if time.time() >= deadline:
+                    raise self._not_ready_error(self._next_round_in())
+                report_status_json = self._service.get_report_status(
+                    report.report_id, report.country_code, report.account_id
+                )
+                if report_status_json.get("status") == "IN_PROGRESS":
+                    if report.elapsed >= report_readiness.expected_seconds(_readiness_key(report)):
+                        self._overdue_polls[key] += 1
+                    continue
+
+                del self._outstanding[(report.country_code, report.account_id)][key]
+                if report_status_json.get("status") == "SUCCESS" and report.created_at is not None:
+                    report_readiness.record(_readiness_key(report), report.elapsed)
+                    metrics.observe(
+                        "amz_ads_report_generation_seconds",
+                        report.elapsed,
+                        ad_type=report.ad_type,
+                        record_type=report.record_type,
+                    )
+                log_event(
+                    "report_ready",
+                    report_id=report.report_id,
+                    status=report_status_json.get("status"),
+                    waited=round(report.elapsed, 1) if report.created_at is not None else None,
+                )
+                yield key, self._service.download_ready_report(
+                    report_status_json,
+                    report.ad_type,
+                    report.record_type,
+                    report.country_code,
+                    report.account_id,
+                    report.tactic,
+                    report.creativeType,
+                )
+
+            self._outstanding = {profile: reports for profile, reports in self._outstanding.items() if reports}
+            if not self._outstanding:
+                break
+
+            sleep_seconds = self._next_round_in()
+            if time.time() + sleep_seconds > deadline:
+                raise self._not_ready_error(sleep_seconds)
+            logging.info(f"{len(self)} reports still generating, polling again in {sleep_seconds:.0f} seconds")
+            time.sleep(sleep_seconds)
+
+    def _not_ready_error(self, retry_after: float) -> ReportNotReadyError:
+        return ReportNotReadyError(
+            ",".join(report.report_id for reports in self._outstanding.values() for report in reports.values()),
+            retry_after,
+        )
+
+    def _round_robin(self) -> Iterator[Tuple[Hashable, OutstandingReport]]:
+        # Interleave profiles so that one profile with many reports does not delay the others
+        queues = [list(reports.items()) for reports in self._outstanding.values()]
+        for i in range(max(len(queue) for queue in queues)):
+            for queue in queues:
+                if i < len(queue):
+                    yield queue[i]
+
+    def _next_round_in(self) -> float:
+        return min(
+            report_readiness.next_poll_in(_readiness_key(report), report.elapsed, self._overdue_polls[key])
+            for reports in self._outstanding.values()
+            for key, report in reports.items()
+        )
+
+
+def _readiness_key(report: OutstandingReport) -> Tuple[str, str, str]:
+    return report.ad_type, report.record_type, report.country_code
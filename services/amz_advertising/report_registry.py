@@ -0,0 +1,101 @@
+import json
+import os
+import re
+import threading
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+from google.cloud.bigquery import SchemaField
+
+REPORTS_FIELDS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports_fields.json")
+REPORTS_FIELDS_BQ_SCHEMA_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "reports_fields_bq_schema.json"
+)
+
+# Attributed metrics end with their attribution window, e.g. attributedSales14d, attributedConversions30dSameSKU
+_ATTRIBUTION_WINDOW_REGEX = re.compile(r"(\d+)d(?:SameSKU|OtherSKU)?$", re.IGNORECASE)
+
+
+class ReportDefinition(NamedTuple):
+    ad_type: str
+    record_type: str
+    variant: Optional[str]  # tactic for "sd", creativeType for "hsa", None otherwise
+    metrics: Tuple[str, ...]
+    metrics_param: str  # comma joined metrics, as sent in the report request body
+    bq_schema: Optional[List[dict]]  # raw json schema, None if no schema is defined for this report
+    schema_fields: Optional[List[SchemaField]]
+    lookback_days: int  # longest attribution window of the metrics, 0 if none are attributed
+
+
+_registry: Optional[Dict[Tuple[str, str, Optional[str]], ReportDefinition]] = None
+_registry_lock = threading.Lock()
+
+
+def get_report_definition(
+    ad_type: str, record_type: str, tactic: Optional[str] = None, creativeType: Optional[str] = None
+) -> ReportDefinition:
+    """
+    Returns the precomputed metrics and BigQuery schema of a report, loading reports_fields.json and
+    reports_fields_bq_schema.json once per process
+    """
+    variant = tactic if ad_type == "sd" else creativeType if ad_type == "hsa" else None
+    try:
+        return _get_registry()[(ad_type, record_type, variant)]
+    except KeyError:
+        raise Exception(f"Unknown report: {ad_type=}, {record_type=}, {tactic=}, {creativeType=}")
+
+
+def _get_registry() -> Dict[Tuple[str, str, Optional[str]], ReportDefinition]:
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = _build_registry()
+    return _registry
+
+
+def _build_registry() -> Dict[Tuple[str, str, Optional[str]], ReportDefinition]:
+    with open(REPORTS_FIELDS_PATH) as reports_fields_file:
+        reports_fields = json.load(reports_fields_file)
+
+    with open(REPORTS_FIELDS_BQ_SCHEMA_PATH) as reports_fields_bq_schema_file:
+        reports_fields_bq_schema = json.load(reports_fields_bq_schema_file)
+
+    registry = {}
+    for ad_type, ad_type_fields in reports_fields.items():
+        if ad_type == "sd":
+            # reports_fields: sd -> record_type -> tactic, schema: sd -> record_type -> tactic
+            for record_type, tactics in ad_type_fields.items():
+                for tactic, metrics in tactics.items():
+                    bq_schema = reports_fields_bq_schema[ad_type].get(record_type, {}).get(tactic)
+                    registry[(ad_type, record_type, tactic)] = _definition(
+                        ad_type, record_type, tactic, metrics, bq_schema
+                    )
+        elif ad_type == "hsa":
+            # reports_fields: hsa -> creativeType ("none" for default) -> record_type, schema: hsa -> record_type
+            for creative_type, record_types in ad_type_fields.items():
+                variant = None if creative_type == "none" else creative_type
+                for record_type, metrics in record_types.items():
+                    bq_schema = reports_fields_bq_schema[ad_type].get(record_type)
+                    registry[(ad_type, record_type, variant)] = _definition(
+                        ad_type, record_type, variant, metrics, bq_schema
+                    )
+        else:
+            for record_type, metrics in ad_type_fields.items():
+                bq_schema = reports_fields_bq_schema[ad_type].get(record_type)
+                registry[(ad_type, record_type, None)] = _definition(ad_type, record_type, None, metrics, bq_schema)
+    return registry
+
+
+def _definition(ad_type, record_type, variant, metrics, bq_schema) -> ReportDefinition:
+    return ReportDefinition(
+        ad_type=ad_type,
+        record_type=record_type,
+        variant=variant,
+        metrics=tuple(metrics),
+        metrics_param=",".join(metrics),
+        bq_schema=bq_schema,
+        schema_fields=None if bq_schema is None else [SchemaField.from_api_repr(field) for field in bq_schema],
+        lookback_days=max(
+            (int(match.group(1)) for match in map(_ATTRIBUTION_WINDOW_REGEX.search, metrics) if match), default=0
+        ),
+    )
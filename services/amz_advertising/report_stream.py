@@ -0,0 +1,83 @@
+import codecs
+import json
+import zlib
+from typing import Any, Iterable, Iterator
+
+_WHITESPACE = " \t\n\r"
+
+
+def iter_gunzip(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """Incrementally decompresses a gzip stream (including multi-member files) given as an iterable of byte chunks"""
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            if decompressor.eof:
+                # Start of a new gzip member
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            else:
+                chunk = b""
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def iter_json_array(chunks: Iterable[bytes]) -> Iterator[Any]:
+    """
+    Incrementally parses a top level json array given as an iterable of utf-8 byte chunks, yielding its elements one
+    at a time so only the current element (plus one chunk) is held in memory
+    """
+    decoder = json.JSONDecoder()
+    utf8_decoder = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
+    started = False
+    exhausted = False
+
+    while True:
+        # Skip whitespace and element separators
+        while pos < len(buffer) and (buffer[pos] in _WHITESPACE or (started and buffer[pos] == ",")):
+            pos += 1
+
+        if pos < len(buffer):
+            if not started:
+                if buffer[pos] != "[":
+                    raise ValueError(f"Expected a json array, found {buffer[pos:pos + 20]!r}")
+                started = True
+                pos += 1
+                continue
+            if buffer[pos] == "]":
+                # Read the stream to its end (gzip trailer) so wrapping iterators see a complete download
+                for _ in chunks:
+                    pass
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if exhausted:
+                    raise
+            else:
+                # A scalar ending exactly at the buffer end may be cut in two (e.g. 12|34), wait for more data
+                if end < len(buffer) or exhausted or isinstance(element, (dict, list)):
+                    yield element
+                    pos = end
+                    continue
+        elif exhausted:
+            raise ValueError("Unexpected end of json array")
+
+        chunk = next(chunks, None)
+        if chunk is None:
+            exhausted = True
+            buffer = buffer[pos:] + utf8_decoder.decode(b"", final=True)
+        else:
+            buffer = buffer[pos:] + utf8_decoder.decode(chunk)
+        pos = 0
+
+
+def iter_report_rows(chunks: Iterable[bytes]) -> Iterator[dict]:
+    """Yields the rows of a gzip compressed json array report (as downloaded from Amazon) one at a time"""
+    return iter_json_array(iter_gunzip(chunks))
@@ -0,0 +1,47 @@
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import config
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(region: str) -> requests.Session:
+    """
+    Returns the process wide keep-alive requests.Session for a region ("EU", "NA", "FE" or "AUTH" for the LWA token
+    endpoint), creating it on first use. Sessions are shared by every AmazonAdvertisingApiService instance so TLS
+    connections to advertising-api-*.amazon.com are reused across reports instead of being opened per request.
+    """
+    session = _sessions.get(region)
+    if session is None:
+        with _sessions_lock:
+            session = _sessions.get(region)
+            if session is None:
+                session = _create_session(config.AMZ_HTTP_POOL_SIZE)
+                _sessions[region] = session
+                logging.info(f"Created HTTP session for region {region} with pool size {config.AMZ_HTTP_POOL_SIZE}")
+    return session
+
+
+def get_timeout() -> tuple:
+    """(connect, read) timeout passed to every request made through the pooled sessions"""
+    return (config.AMZ_HTTP_CONNECT_TIMEOUT, config.AMZ_HTTP_READ_TIMEOUT)
+
+
+def close_sessions() -> None:
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _create_session(pool_size: int) -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
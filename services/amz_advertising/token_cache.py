@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import config
+
+
+class AccessTokenCache:
+    """
+    Process wide cache of Login with Amazon access tokens keyed by (client_id, refresh_token).
+    Tokens are reused until `refresh_margin` seconds before their `expires_in`, and concurrent callers needing a
+    refresh for the same key wait on a single in-flight token request instead of each doing their own.
+    """
+
+    def __init__(self, refresh_margin: float):
+        self.refresh_margin = refresh_margin
+        self._tokens = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, client_id: str, refresh_token: str, fetch_token: Callable[[], dict]) -> str:
+        """
+        Returns a valid access token, calling fetch_token() (which returns the LWA token response json) if the
+        cached one is missing or about to expire
+        """
+        key = (client_id, refresh_token)
+        access_token = self._get_valid(key)
+        if access_token is not None:
+            return access_token
+
+        with self._get_key_lock(key):
+            # Another thread may have refreshed while we waited for the lock
+            access_token = self._get_valid(key)
+            if access_token is not None:
+                return access_token
+
+            token_json = fetch_token()
+            access_token = token_json["access_token"]
+            expires_at = time.monotonic() + float(token_json.get("expires_in", 3600))
+            self._tokens[key] = (access_token, expires_at)
+            logging.info(
+                f"Refreshed Amazon access token for client {client_id}, expires in {token_json.get('expires_in')}s"
+            )
+            return access_token
+
+    def invalidate(self, client_id: str, refresh_token: str, access_token: Optional[str] = None) -> None:
+        """
+        Drops the cached token. If access_token is given, only drops it if it is still the cached one, so a token
+        another thread already refreshed is not thrown away
+        """
+        key = (client_id, refresh_token)
+        with self._lock:
+            cached = self._tokens.get(key)
+            if cached is not None and (access_token is None or cached[0] == access_token):
+                del self._tokens[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._tokens.clear()
+
+    def _get_valid(self, key) -> Optional[str]:
+        cached = self._tokens.get(key)
+        if cached is not None and cached[1] - self.refresh_margin > time.monotonic():
+            return cached[0]
+        return None
+
+    def _get_key_lock(self, key) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+
+access_token_cache = AccessTokenCache(refresh_margin=config.AMZ_ACCESS_TOKEN_REFRESH_MARGIN_SECONDS)
@@ -1,8 +1,15 @@
+import datetime
 import flask
 import unittest
+from unittest import mock
+
+from google.api_core import exceptions
 
 import config
 import main
+from utils import ledger
+from benchmarks.fake_gcp import FakeBigQueryClient, FakeCloudTasksClient, offline_services
+from benchmarks.stub_amz_server import StubAmazonAdsServer, build_profiles
 
 # Testing docs from Google
 # https://cloud.google.com/functions/docs/testing/test-http
@@ -12,26 +19,234 @@ import main
 
 
 class TestMainHTTPAPI(unittest.TestCase):
+    """main.main end to end against a local stub of the Amazon Advertising API and fake Cloud Tasks / BigQuery"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubAmazonAdsServer(rows_per_report=25, profiles=build_profiles(main.ACCOUNTS)).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
     def setUp(self) -> None:
         # Create a fake "app" for generating test request contexts.
         self.test_app = flask.Flask(__name__)
+        self.server.reset_counters()
+        self.server.throttle_every = 0
+        self.tasks_client = FakeCloudTasksClient()
+        self.bq_client = FakeBigQueryClient()
+        offline = offline_services(self.server, self.tasks_client, self.bq_client)
+        offline.__enter__()
+        self.addCleanup(offline.__exit__, None, None, None)
+
+    def dispatch(self, **args):
+        query_string = dict({"target_project": "offline", "target_dataset": "tests", "backfill_days": 1}, **args)
+        with self.test_app.test_request_context("/", method="GET", query_string=query_string):
+            return main.main(flask.request)
+
+    def post(self, payload):
+        with self.test_app.test_request_context("/", method="POST", json=payload):
+            return flask.make_response(main.main(flask.request))
 
-    def test_get_function_up(self):
+    def test_get_without_backfill_days_fails(self):
         with self.test_app.test_request_context("/", method="GET"):
             resp = main.main(flask.request)
-            self.assertIn(
-                "Service is up",
-                resp.data.decode("utf-8"),
-            )
+        self.assertEqual(resp.status_code, 500)
+        self.assertIn("An error occured", resp.data.decode("utf-8"))
 
-    def test_post_hello_name(self):
-        with self.test_app.test_request_context("/", method="POST", json={"name": "test"}):
-            resp = main.main(flask.request)
-            self.assertEqual(resp.data.decode("utf-8"), "Hello test!")
+    def test_get_dispatches_a_task_per_report(self):
+        resp = self.dispatch()
 
-    def test_post_hello_world(self):
-        with self.test_app.test_request_context("/", method="POST"):
-            resp = main.main(flask.request)
-            self.assertEqual(resp.data.decode("utf-8"), "Hello World!")
+        reports = self.server.request_counts["create_report"]
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data.decode("utf-8"), f"Dispatched {reports} report tasks in total to 'offline.tests'")
+        self.assertEqual(len(self.tasks_client.tasks), reports)
+        self.assertEqual(self.server.request_counts["token"], 1)
+        self.assertEqual(self.server.request_counts["profiles"], len({account["region"] for account in main.ACCOUNTS}))
+
+    def test_get_dispatches_tasks_while_reports_are_created(self):
+        tasks_seen = []
+        create_report_for_job = main.create_report_for_job
+
+        def create_report(job, target_project, target_dataset, **kwargs):
+            tasks_seen.append(len(self.tasks_client.tasks))
+            return create_report_for_job(job, target_project, target_dataset, **kwargs)
+
+        with mock.patch.object(main, "create_report_for_job", side_effect=create_report):
+            resp = self.dispatch(backfill_days=2)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(tasks_seen[0], 0)
+        self.assertGreater(tasks_seen[-1], 0)
+        self.assertEqual(len(self.tasks_client.tasks), self.server.request_counts["create_report"])
+
+    def test_get_skips_reports_that_could_not_be_created(self):
+        create_new_report = main.AmazonAdvertisingApiService.create_new_report
+
+        def create_report(service, ad_type, *args, **kwargs):
+            if ad_type == "sd":
+                raise Exception("Invalid value: sd report")
+            return create_new_report(service, ad_type, *args, **kwargs)
+
+        with mock.patch.object(main.AmazonAdvertisingApiService, "create_new_report", create_report):
+            resp = self.dispatch()
+
+        ad_types = {payload["specific_request"]["ad_type"] for payload in self.tasks_client.pop_payloads()}
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(ad_types, set(main.REPORT_COMBINATIONS) - {"sd"})
+        self.assertIn(f"Dispatched {self.server.request_counts['create_report']} report", resp.data.decode("utf-8"))
+
+    def test_reports_of_failed_tasks_are_not_recorded_in_flight(self):
+        with mock.patch.multiple(config, LEDGER_BACKEND="sqlite", LEDGER_SQLITE_PATH=":memory:"), mock.patch.dict(
+            ledger._ledgers, clear=True
+        ):
+            with mock.patch.object(self.tasks_client, "create_task", side_effect=exceptions.InternalServerError("")):
+                resp = self.dispatch()
+            self.assertEqual(resp.status_code, 500)
+
+            resp = self.dispatch()
+
+        self.assertEqual(resp.status_code, 200)
+        # Every report is dispatched again (the identical report requests reuse the reports of the first run)
+        self.assertEqual(len(self.tasks_client.tasks), self.server.request_counts["create_report"])
+
+    def test_get_without_ledger_dispatches_every_date(self):
+        self.dispatch(backfill_days=17)
+
+        hsa_dates = {
+            payload["specific_request"]["reportDate"]
+            for payload in self.tasks_client.pop_payloads()
+            if payload["specific_request"]["ad_type"] == "hsa"
+        }
+        self.assertEqual(len(hsa_dates), 17)
+
+    def test_get_without_ledger_skips_settled_dates_on_request(self):
+        # hsa reports settle 14 + 2 days after their date, sp and sd reports 30 + 2 days after
+        resp = self.dispatch(backfill_days=17, skip_settled="true")
+
+        dates_by_ad_type = {}
+        for payload in self.tasks_client.pop_payloads():
+            specific_request = payload["specific_request"]
+            dates_by_ad_type.setdefault(specific_request["ad_type"], set()).add(specific_request["reportDate"])
+        self.assertEqual(len(dates_by_ad_type["hsa"]), 15)
+        self.assertEqual(len(dates_by_ad_type["sp"]), 17)
+        settled_dates = sorted(set(dates_by_ad_type["sp"]) - dates_by_ad_type["hsa"])
+        self.assertIn(f"of dates {', '.join(settled_dates)}", resp.data.decode("utf-8"))
+
+        self.dispatch(backfill_days=17, skip_settled="true", force="true")
+        hsa_dates = {
+            payload["specific_request"]["reportDate"]
+            for payload in self.tasks_client.pop_payloads()
+            if payload["specific_request"]["ad_type"] == "hsa"
+        }
+        self.assertEqual(len(hsa_dates), 17)
+
+    def test_forced_get_requests_new_reports(self):
+        self.dispatch()
+        reports = self.server.request_counts["create_report"]
+        self.dispatch()
+        self.assertEqual(self.server.request_counts["create_report"], reports)
+
+        self.dispatch(force="true")
+
+        self.assertEqual(self.server.request_counts["create_report"], 2 * reports)
+
+    def test_post_loads_the_report_partition(self):
+        self.dispatch(batch_days=1)
+        payload = self.tasks_client.pop_payloads()[0]
+
+        resp = self.post(payload)
+
+        yesterday = (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y%m%d")
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(self.bq_client.loads), 1)
+        self.assertEqual(self.bq_client.loads[0].partition, yesterday)
+        self.assertEqual(self.bq_client.loads[0].rows, 25)
+        self.assertEqual(self.server.request_counts["download"], 1)
+
+    def test_post_loads_a_batch_of_dates_with_one_merge(self):
+        self.dispatch(backfill_days=2, batch_days=2)
+        payload = self.tasks_client.pop_payloads()[0]
+        report_dates = [specific_request["reportDate"] for specific_request in payload["specific_requests"]]
+
+        resp = self.post(payload)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(len(report_dates), 2)
+        (load,) = self.bq_client.loads
+        self.assertEqual(load.rows, 50)
+        (merge,) = self.bq_client.queries
+        (parameter,) = merge.job_config.query_parameters
+        self.assertEqual([date.strftime("%Y%m%d") for date in parameter.values], sorted(report_dates))
+        self.assertEqual(self.bq_client.deleted_tables, [load.table_id])
+
+    def test_generation_times_learned_by_report_tasks_reach_the_dispatcher(self):
+        with mock.patch.multiple(config, LEDGER_BACKEND="sqlite", LEDGER_SQLITE_PATH=":memory:"), mock.patch.dict(
+            ledger._ledgers, clear=True
+        ):
+            self.dispatch(batch_days=1)
+            payload = self.tasks_client.pop_payloads()[0]
+            self.assertEqual(self.post(payload).status_code, 200)
+            # The report task shared what it learned
+            self.assertEqual(main.report_readiness.pop_updates(), {})
+
+            # A fresh dispatcher instance, which never polled a report
+            with mock.patch.multiple(main.report_readiness, _stats={}, synced_at=0.0):
+                self.dispatch(force="true")
+                specific_request = payload["specific_request"]
+                key = (specific_request["ad_type"], specific_request["record_type"], specific_request["country_code"])
+                self.assertIn(key, main.report_readiness._stats)
+
+    def test_post_retries_throttled_requests(self):
+        self.dispatch()
+        payload = self.tasks_client.pop_payloads()[0]
+        self.server.reset_counters()
+        self.server.throttle_every = 2
+
+        with mock.patch.object(config, "AMZ_BACKOFF_BASE_SECONDS", 0.01):
+            resp = self.post(payload)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.bq_client.loads[0].rows, 25)
+        self.assertGreater(self.server.throttled_count, 0)
+
+    def test_post_reenqueues_reports_still_generating_at_the_deadline(self):
+        self.dispatch(batch_days=1)
+        payload = self.tasks_client.pop_payloads()[0]
+        self.server.reset_counters()
+        self.server.generation_seconds = 60
+        self.addCleanup(setattr, self.server, "generation_seconds", 0.0)
+
+        with mock.patch.object(config, "AMZ_REPORT_POLL_DEADLINE_SECONDS", 0.05):
+            resp = self.post(payload)
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("re-enqueued the task (attempt 1)", resp.data.decode("utf-8"))
+            (reenqueued,) = self.tasks_client.pop_payloads()
+            self.assertEqual(reenqueued["reenqueue_attempt"], 1)
+            self.assertEqual(reenqueued["specific_request"], payload["specific_request"])
+            self.assertEqual(self.bq_client.loads, [])
+
+            resp = self.post(reenqueued)
+            self.assertIn("attempt 2", resp.data.decode("utf-8"))
+            self.assertEqual(self.tasks_client.pop_payloads()[0]["reenqueue_attempt"], 2)
+
+        # The re-enqueued tasks keep polling the report created by the GET
+        self.assertEqual(self.server.request_counts["create_report"], 0)
+
+    def test_post_gives_up_after_the_max_reenqueues(self):
+        self.dispatch(batch_days=1)
+        payload = self.tasks_client.pop_payloads()[0]
+        self.server.generation_seconds = 60
+        self.addCleanup(setattr, self.server, "generation_seconds", 0.0)
+
+        with mock.patch.multiple(config, AMZ_REPORT_POLL_DEADLINE_SECONDS=0.05, AMZ_REPORT_MAX_REENQUEUES=2):
+            resp = self.post(dict(payload, reenqueue_attempt=2))
+
+        self.assertEqual(resp.status_code, 500)
+        self.assertIn("Giving up after 2 re-enqueues", resp.data.decode("utf-8"))
+        self.assertEqual(self.tasks_client.tasks, [])
 
 
+if __name__ == "__main__":
+    unittest.main()
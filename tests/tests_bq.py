@@ -0,0 +1,131 @@
+import datetime
+import gzip
+import json
+import unittest
+from unittest import mock
+
+from google.api_core.exceptions import BadRequest, NotFound
+from google.cloud import bigquery
+
+from benchmarks.fake_gcp import FakeBigQueryClient
+from services.amz_advertising.report_registry import get_report_definition
+from utils import bq
+
+PROJECT, DATASET, TABLE = "p", "d", "sp_targets"
+TABLE_ID = f"{PROJECT}.{DATASET}.{TABLE}"
+
+
+def report_rows(date, count=3):
+    return [{"date": date, "campaignId": i, "cost": 1.5} for i in range(count)]
+
+
+class BigQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.bq_client = FakeBigQueryClient()
+        patcher = mock.patch.object(bq, "get_bq_client", return_value=self.bq_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        bq.table_cache.clear()
+        self.addCleanup(bq.table_cache.clear)
+        self.schema = get_report_definition("sp", "targets").schema_fields
+
+
+class TestLoadFile(BigQueryTestCase):
+    def test_load_rejected_at_submission(self):
+        rejected = BadRequest("Invalid load", errors=[{"message": "Provided Schema does not match"}])
+
+        with mock.patch.object(self.bq_client, "load_table_from_file", side_effect=rejected):
+            bq.table_cache.set(TABLE_ID, self.bq_client.create_table(bigquery.Table(TABLE_ID)))
+            result = bq.bq_load_json_list(PROJECT, DATASET, TABLE, report_rows("2021-03-04"), "20210304", self.schema)
+
+        self.assertEqual(result, "ERROR: Provided Schema does not match\n")
+        self.assertIsNone(bq.table_cache.get(TABLE_ID))
+
+    def test_json_load_file_is_gzip_compressed(self):
+        load_file, source_format = bq.write_load_file(report_rows("2021-03-04"), self.schema, "json", TABLE)
+
+        with load_file:
+            rows = [json.loads(line) for line in gzip.decompress(load_file.read()).splitlines()]
+
+        self.assertEqual(source_format, bigquery.SourceFormat.NEWLINE_DELIMITED_JSON)
+        self.assertEqual(rows[1], {"date": "2021-03-04", "campaignid": 1, "cost": 1.5})
+        self.assertEqual(len(rows), 3)
+
+
+class TestLoadPartitions(BigQueryTestCase):
+    def test_partitions_are_replaced_by_one_load_and_one_merge(self):
+        rows_by_date = {"20210305": report_rows("2021-03-05", 2), "20210304": report_rows("2021-03-04")}
+
+        bq.bq_load_partitions(PROJECT, DATASET, TABLE, rows_by_date, self.schema)
+
+        (load,) = self.bq_client.loads
+        self.assertTrue(load.table_id.startswith(f"{TABLE_ID}__staging_"))
+        self.assertEqual(load.rows, 5)
+        (merge,) = self.bq_client.queries
+        self.assertIn(f"MERGE `{TABLE_ID}` T", merge.query)
+        self.assertIn(f"USING `{load.table_id}` S", merge.query)
+        self.assertIn("WHEN NOT MATCHED BY SOURCE AND T.date IN UNNEST(@partition_dates) THEN DELETE", merge.query)
+        columns = ", ".join(f"`{field.name}`" for field in self.schema)
+        self.assertIn(f"INSERT ({columns}) VALUES ({columns})", merge.query)
+        (parameter,) = merge.job_config.query_parameters
+        self.assertEqual(parameter.name, "partition_dates")
+        self.assertEqual(parameter.array_type, "DATE")
+        self.assertEqual(parameter.values, [datetime.date(2021, 3, 4), datetime.date(2021, 3, 5)])
+        self.assertEqual(self.bq_client.deleted_tables, [load.table_id])
+        self.assertEqual(list(self.bq_client.tables), [TABLE_ID])
+
+    def test_staging_table_is_deleted_when_the_merge_fails(self):
+        with mock.patch.object(self.bq_client, "query", side_effect=BadRequest("Invalid merge")):
+            with self.assertRaises(BadRequest):
+                bq.bq_load_partitions(PROJECT, DATASET, TABLE, {"20210304": report_rows("2021-03-04")}, self.schema)
+
+        (load,) = self.bq_client.loads
+        self.assertEqual(self.bq_client.deleted_tables, [load.table_id])
+        self.assertEqual(list(self.bq_client.tables), [TABLE_ID])
+        self.assertIsNone(bq.table_cache.get(TABLE_ID))
+
+    def test_load_rejected_at_submission(self):
+        rejected = BadRequest("Invalid load", errors=[{"message": "Provided Schema does not match"}])
+
+        with mock.patch.object(self.bq_client, "load_table_from_file", side_effect=rejected):
+            result = bq.bq_load_partitions(
+                PROJECT, DATASET, TABLE, {"20210304": report_rows("2021-03-04")}, self.schema
+            )
+
+        self.assertEqual(result, "ERROR: Provided Schema does not match\n")
+        self.assertEqual(self.bq_client.queries, [])
+        self.assertEqual(list(self.bq_client.tables), [TABLE_ID])
+
+
+class TestTableCache(unittest.TestCase):
+    def test_entries_expire_after_ttl(self):
+        cache = bq.TableCache(ttl=60)
+        with mock.patch.object(bq.time, "monotonic", return_value=1000.0):
+            cache.set(TABLE_ID, "table")
+        with mock.patch.object(bq.time, "monotonic", return_value=1060.0):
+            self.assertEqual(cache.get(TABLE_ID), "table")
+        with mock.patch.object(bq.time, "monotonic", return_value=1061.0):
+            self.assertIsNone(cache.get(TABLE_ID))
+
+
+class TestTableCacheInvalidation(BigQueryTestCase):
+    def test_missing_table_is_invalidated_and_created_again(self):
+        self.bq_client.create_table(bigquery.Table(TABLE_ID))
+        rows = report_rows("2021-03-04")
+        bq.bq_load_json_list(PROJECT, DATASET, TABLE, rows, "20210304", self.schema)
+        self.assertIsNotNone(bq.table_cache.get(TABLE_ID))
+
+        # The table was deleted while its metadata was cached
+        self.bq_client.delete_table(TABLE_ID)
+        with mock.patch.object(self.bq_client, "load_table_from_file", side_effect=NotFound("Not found: Table")):
+            with self.assertRaises(NotFound):
+                bq.bq_load_json_list(PROJECT, DATASET, TABLE, rows, "20210304", self.schema)
+        self.assertIsNone(bq.table_cache.get(TABLE_ID))
+
+        bq.bq_load_json_list(PROJECT, DATASET, TABLE, rows, "20210304", self.schema)
+        self.assertIn(TABLE_ID, self.bq_client.tables)
+        self.assertEqual(self.bq_client.loads[-1].partition, "20210304")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import datetime
+import io
+import unittest
+from unittest import mock
+
+import pyarrow.parquet
+
+from utils.bq_arrow import iter_record_batches, write_parquet
+
+SCHEMA = [
+    {"description": None, "mode": "NULLABLE", "name": "date", "type": "DATE"},
+    {"description": None, "mode": "NULLABLE", "name": "campaignid", "type": "INTEGER"},
+    {"description": None, "mode": "NULLABLE", "name": "cost", "type": "FLOAT"},
+    {"description": None, "mode": "NULLABLE", "name": "updated", "type": "TIMESTAMP"},
+]
+
+ROWS = [
+    {"date": "2021-03-04", "campaignId": "123456789012345678", "cost": "1.5", "updated": "2021-03-04T10:00:00Z"},
+    {"date": "2021-03-05", "campaignId": 2, "cost": None, "updated": "2021-03-05 11:30:00"},
+    {"date": None, "campaignId": None, "cost": 3, "updated": None},
+]
+
+
+class TestRecordBatches(unittest.TestCase):
+    def test_date_and_timestamp_strings_are_converted(self):
+        batches = list(iter_record_batches(ROWS, SCHEMA, batch_rows=2))
+
+        self.assertEqual([batch.num_rows for batch in batches], [2, 1])
+        columns = {
+            name: batches[0].column(i).to_pylist() + batches[1].column(i).to_pylist()
+            for i, name in enumerate(batches[0].schema.names)
+        }
+        self.assertEqual(columns["date"], [datetime.date(2021, 3, 4), datetime.date(2021, 3, 5), None])
+        self.assertEqual(columns["campaignid"], [123456789012345678, 2, None])
+        self.assertEqual(columns["cost"], [1.5, None, 3.0])
+        self.assertEqual(
+            columns["updated"],
+            [
+                datetime.datetime(2021, 3, 4, 10, tzinfo=datetime.timezone.utc),
+                datetime.datetime(2021, 3, 5, 11, 30, tzinfo=datetime.timezone.utc),
+                None,
+            ],
+        )
+
+    def test_parquet_file_round_trip(self):
+        parquet_file = io.BytesIO()
+
+        write_parquet(ROWS, SCHEMA, parquet_file)
+        parquet_file.seek(0)
+        table = pyarrow.parquet.read_table(parquet_file)
+
+        self.assertEqual(table.schema.field("date").type, pyarrow.date32())
+        self.assertEqual(table.column("date").to_pylist()[:2], [datetime.date(2021, 3, 4), datetime.date(2021, 3, 5)])
+        self.assertEqual(table.num_rows, 3)
+
+    def test_parquet_writer_api_of_pinned_pyarrow(self):
+        # pyarrow 3.0 (requirements.txt) has no ParquetWriter.write_batch
+        with mock.patch.object(
+            pyarrow.parquet.ParquetWriter, "write_batch", side_effect=AttributeError("write_batch"), create=True
+        ):
+            write_parquet(ROWS, SCHEMA, io.BytesIO())
+
+
+if __name__ == "__main__":
+    unittest.main()
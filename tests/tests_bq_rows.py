@@ -0,0 +1,92 @@
+import json
+import unittest
+
+from google.cloud import bigquery
+
+from services.amz_advertising.report_registry import get_report_definition
+from utils.bq import existing_column_types, format_list_of_dicts_for_bq
+from utils.bq_rows import RowNormalizer, clean_key, get_row_normalizer
+
+CAMPAIGN_ID = 123456789012345678
+
+
+class TestRowNormalizer(unittest.TestCase):
+    def test_keys_are_cleaned_and_values_cast_by_column_type(self):
+        schema = [
+            {"name": "cost", "type": "FLOAT"},
+            {"name": "campaign_name", "type": "STRING"},
+            {"name": "enabled", "type": "BOOLEAN"},
+            {"name": "date", "type": "DATE"},
+        ]
+        row = {"cost": "1.5", "campaign-Name": 42, "enabled": "True", "date": "2021-03-04", "clicks": "3"}
+
+        self.assertEqual(
+            RowNormalizer(schema).normalize(row),
+            {"cost": 1.5, "campaign_name": "42", "enabled": True, "date": "2021-03-04", "clicks": 3.0},
+        )
+        self.assertEqual(
+            RowNormalizer(schema).normalize({"cost": None, "campaign-Name": None}),
+            {"cost": None, "campaign_name": None},
+        )
+        self.assertEqual(clean_key("attributedSales14d.SameSKU"), "attributedsales14d_samesku")
+
+    def test_key_layout_is_compiled_once(self):
+        normalizer = RowNormalizer()
+
+        rows = list(normalizer.normalize_all({"clicks": i, "campaignName": "a"} for i in range(3)))
+        normalizer.normalize({"campaignName": "b", "clicks": 1})
+
+        self.assertEqual(rows[2], {"clicks": 2.0, "campaignname": "a"})
+        self.assertEqual(len(normalizer._plans), 2)
+
+    def test_normalizer_is_shared_per_schema(self):
+        schema = get_report_definition("sp", "targets").schema_fields
+
+        self.assertIs(get_row_normalizer(schema), get_row_normalizer(get_report_definition("sp", "targets").bq_schema))
+        self.assertIsNot(get_row_normalizer(schema), get_row_normalizer(None))
+
+    def test_format_list_of_dicts_for_bq_without_schema(self):
+        rows = format_list_of_dicts_for_bq([{"Cost": "1", "campaignName": "Campaign 1", "impressions": None}])
+
+        self.assertEqual(rows, [{"cost": 1.0, "campaignname": "Campaign 1", "impressions": None}])
+
+    def test_schema_ids_stay_exact_integers(self):
+        normalizer = RowNormalizer(get_report_definition("sp", "targets").schema_fields)
+
+        row = normalizer.normalize(
+            {"campaignId": CAMPAIGN_ID, "adGroupId": str(CAMPAIGN_ID + 1), "targetId": "1.5e3", "cost": 3}
+        )
+
+        self.assertEqual(row, {"campaignid": CAMPAIGN_ID, "adgroupid": CAMPAIGN_ID + 1, "targetid": 1500, "cost": 3.0})
+        self.assertIn('"campaignid": 123456789012345678,', json.dumps(row))
+
+    def test_fractional_ids_are_rejected(self):
+        normalizer = RowNormalizer(get_report_definition("sp", "targets").schema_fields)
+
+        for target_id in ["1.5", 1.5]:
+            with self.assertRaises(Exception):
+                normalizer.normalize({"targetId": target_id})
+
+    def test_columns_missing_from_the_schema(self):
+        row = RowNormalizer().normalize(
+            {"portfolioId": str(CAMPAIGN_ID), "clicks": "7", "keywordBid": "2", "campaignName": "Campaign"}
+        )
+
+        self.assertEqual(
+            row, {"portfolioid": CAMPAIGN_ID, "clicks": 7.0, "keywordbid": 2.0, "campaignname": "Campaign"}
+        )
+        self.assertEqual(RowNormalizer().normalize(row), row)
+
+    def test_existing_column_types_win(self):
+        schema = [bigquery.SchemaField("campaignid", "INTEGER"), bigquery.SchemaField("cost", "FLOAT")]
+        table = bigquery.Table("p.d.t", schema=[bigquery.SchemaField("campaignid", "FLOAT")])
+
+        self.assertEqual(
+            [(field.name, field.field_type) for field in existing_column_types(schema, table)],
+            [("campaignid", "FLOAT"), ("cost", "FLOAT")],
+        )
+        self.assertIs(existing_column_types(schema, bigquery.Table("p.d.t", schema=schema)), schema)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import unittest
+from unittest import mock
+
+from google.cloud.bigquery import SchemaField
+
+from benchmarks.bench_report_stream import synthetic_row
+from benchmarks.fake_gcp import FakeBigQueryClient
+from services.amz_advertising.report_registry import get_report_definition
+from utils import bq
+from utils.bq_schema import DATE_FIELD, infer_schema, infer_stream_schema, report_schema
+
+
+def types(schema):
+    return {field["name"]: field["type"] for field in schema}
+
+
+class TestSchemaInference(unittest.TestCase):
+    def test_widens_column_types(self):
+        rows = [
+            {
+                "campaignId": 1,
+                "clicks": 3,
+                "cost": 0,
+                "keywordBid": 1,
+                "status": None,
+                "flag": True,
+                "day": "2021-03-04",
+            },
+            {"campaignId": 2, "clicks": 2.5, "cost": 1, "status": "ENABLED", "flag": 1, "day": "2021-03-04 10:00:00"},
+            {"campaign-Name": "Campaign", "empty": None},
+        ]
+
+        self.assertEqual(
+            types(infer_schema(rows)),
+            {
+                "campaignid": "INTEGER",
+                "clicks": "FLOAT",
+                "cost": "FLOAT",
+                "keywordbid": "FLOAT",
+                "status": "STRING",
+                "flag": "STRING",
+                "day": "TIMESTAMP",
+                "campaign_name": "STRING",
+                "empty": "STRING",
+            },
+        )
+
+    def test_matches_the_registry_schema_of_a_report(self):
+        registry_schema = get_report_definition("sp", "targets").bq_schema
+
+        schema = report_schema(synthetic_row(i) for i in range(100))
+
+        self.assertEqual(schema[0], DATE_FIELD)
+        self.assertLessEqual(types(schema).items(), types(registry_schema).items())
+        self.assertEqual(set(schema[0]), set(registry_schema[0]))
+        SchemaField.from_api_repr(schema[1])
+
+    def test_stream_is_replayed_after_sampling(self):
+        rows, schema = infer_stream_schema(({"adId": i} for i in range(10)), sample_rows=3)
+
+        self.assertEqual([row["adId"] for row in rows], list(range(10)))
+        self.assertEqual(types(schema), {"adid": "INTEGER"})
+
+    def test_reports_without_schema_are_loaded_with_the_inferred_schema(self):
+        bq_client = FakeBigQueryClient()
+        rows = [dict(synthetic_row(i), date="2021-03-04") for i in range(10)]
+
+        with mock.patch.object(bq, "get_bq_client", return_value=bq_client):
+            bq.table_cache.clear()
+            bq.bq_load_json_list("p", "d", "t", iter(rows), "20210304", None, load_format="parquet")
+            bq.table_cache.clear()
+
+        table = bq_client.tables["p.d.t"]
+        self.assertEqual({field.name: field.field_type for field in table.schema}["campaignid"], "INTEGER")
+        self.assertEqual(table.time_partitioning.field, "date")
+        self.assertEqual(bq_client.loads[0].rows, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
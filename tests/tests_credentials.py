@@ -0,0 +1,80 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from services.amz_advertising.credentials import (
+    ENV_VAR_AMZ_CREDENTIALS_FILE,
+    ENV_VAR_AMZ_CREDENTIALS_JSON,
+    AmazonCredentialsProvider,
+)
+
+FILE_CREDENTIALS = {"client_id": "file", "client_secret": "secret", "refresh_token": "token"}
+ENV_CREDENTIALS = {"client_id": "env", "client_secret": "secret", "refresh_token": "token"}
+SECRET_CREDENTIALS = {"client_id": "secret-manager", "client_secret": "secret", "refresh_token": "token"}
+
+
+class TestAmazonCredentialsProvider(unittest.TestCase):
+    def setUp(self) -> None:
+        self.credentials_file = os.path.join(tempfile.mkdtemp(), "credentials.json")
+        with open(self.credentials_file, "w") as f:
+            json.dump(FILE_CREDENTIALS, f)
+        patcher = mock.patch.dict("os.environ")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        os.environ.pop(ENV_VAR_AMZ_CREDENTIALS_FILE, None)
+        os.environ.pop(ENV_VAR_AMZ_CREDENTIALS_JSON, None)
+
+    def provider(self, **kwargs):
+        provider = AmazonCredentialsProvider("projects/p/secrets/s/versions/latest", ttl=60, **kwargs)
+        secret_manager = mock.patch.object(provider, "_load_from_secret_manager", return_value=SECRET_CREDENTIALS)
+        self.load_from_secret_manager = secret_manager.start()
+        self.addCleanup(secret_manager.stop)
+        return provider
+
+    def test_file_from_argument_or_env_var(self):
+        self.assertEqual(self.provider(credentials_file=self.credentials_file).get(), FILE_CREDENTIALS)
+
+        os.environ[ENV_VAR_AMZ_CREDENTIALS_FILE] = self.credentials_file
+        self.assertEqual(self.provider().get(), FILE_CREDENTIALS)
+
+    def test_json_env_var(self):
+        os.environ[ENV_VAR_AMZ_CREDENTIALS_JSON] = json.dumps(ENV_CREDENTIALS)
+
+        self.assertEqual(self.provider().get(), ENV_CREDENTIALS)
+        self.load_from_secret_manager.assert_not_called()
+
+    def test_file_takes_precedence_over_json_env_var_and_secret_manager(self):
+        os.environ[ENV_VAR_AMZ_CREDENTIALS_JSON] = json.dumps(ENV_CREDENTIALS)
+        os.environ[ENV_VAR_AMZ_CREDENTIALS_FILE] = self.credentials_file
+
+        self.assertEqual(self.provider().get(), FILE_CREDENTIALS)
+        self.load_from_secret_manager.assert_not_called()
+
+    def test_secret_manager_is_loaded_lazily_and_cached(self):
+        provider = self.provider()
+        self.load_from_secret_manager.assert_not_called()
+
+        self.assertEqual(provider.get(), SECRET_CREDENTIALS)
+        provider.get()
+        self.assertEqual(self.load_from_secret_manager.call_count, 1)
+
+        provider.invalidate()
+        provider.get()
+        self.assertEqual(self.load_from_secret_manager.call_count, 2)
+
+    def test_reloaded_after_ttl(self):
+        provider = self.provider()
+        with mock.patch("services.amz_advertising.credentials.time.monotonic", return_value=1000.0):
+            provider.get()
+        with mock.patch("services.amz_advertising.credentials.time.monotonic", return_value=1060.0):
+            provider.get()
+        self.assertEqual(self.load_from_secret_manager.call_count, 1)
+        with mock.patch("services.amz_advertising.credentials.time.monotonic", return_value=1061.0):
+            provider.get()
+        self.assertEqual(self.load_from_secret_manager.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,42 @@
+import datetime
+import unittest
+
+from services.amz_advertising.date_planner import (
+    partition_needs_refresh,
+    partition_settled,
+    report_lookback_days,
+)
+from utils.ledger import CREATED, FAILED, LOADED, LedgerEntry, LedgerKey
+
+
+def loaded_on(report_date, day, status=LOADED):
+    updated_at = datetime.datetime.combine(day, datetime.time(6), tzinfo=datetime.timezone.utc).timestamp()
+    key = LedgerKey.for_report("A", "US", "sp", "campaigns", None, None, report_date)
+    return LedgerEntry(key, "r1", status, 10, updated_at)
+
+
+class TestDatePlanner(unittest.TestCase):
+    def test_lookback_is_the_longest_attribution_window(self):
+        self.assertEqual(report_lookback_days("sp", "campaigns", None, None), 30)
+        self.assertEqual(report_lookback_days("hsa", "keywords", None, "video"), 14)
+        # No attributed metrics, impressions/clicks/cost are still restated for AMZ_MIN_LOOKBACK_DAYS
+        self.assertEqual(report_lookback_days("sd", "targets", "T00001", None), 3)
+
+    def test_partitions_are_refreshed_until_loaded_after_they_settle(self):
+        # Settles 14 + AMZ_LOOKBACK_MARGIN_DAYS days after the report date
+        self.assertTrue(partition_needs_refresh(None, 14))
+        self.assertTrue(partition_needs_refresh(loaded_on("20210601", datetime.date(2021, 6, 2)), 14))
+        self.assertTrue(partition_needs_refresh(loaded_on("20210601", datetime.date(2021, 6, 16)), 14))
+        self.assertFalse(partition_needs_refresh(loaded_on("20210601", datetime.date(2021, 6, 17)), 14))
+        self.assertFalse(partition_needs_refresh(loaded_on("20210601", datetime.date(2021, 9, 1)), 14))
+        self.assertTrue(partition_needs_refresh(loaded_on("20210601", datetime.date(2021, 9, 1), FAILED), 14))
+        self.assertTrue(partition_needs_refresh(loaded_on("20210601", datetime.date(2021, 9, 1), CREATED), 14))
+
+    def test_partitions_settle_after_their_lookback_and_margin(self):
+        self.assertFalse(partition_settled("20210601", 14, datetime.date(2021, 6, 16)))
+        self.assertTrue(partition_settled("20210601", 14, datetime.date(2021, 6, 17)))
+        self.assertTrue(partition_settled("20210501", 14, datetime.date(2021, 6, 17)))
+
+
+if __name__ == "__main__":
+    unittest.main()
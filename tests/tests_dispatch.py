@@ -0,0 +1,152 @@
+import contextvars
+import threading
+import time
+import unittest
+
+from utils.dispatch import FairScheduler, StreamBatcher, run_concurrently
+
+
+def drain(scheduler):
+    """Order in which a single worker is handed the jobs of scheduler"""
+    order = []
+    while True:
+        taken = scheduler.take()
+        if taken is None:
+            return order
+        key, index = taken
+        order.append(scheduler.jobs[index])
+        scheduler.done(key)
+
+
+class TestFairScheduler(unittest.TestCase):
+    def test_regions_take_turns_with_recent_dates_first_within_each(self):
+        jobs = [
+            {"region": region, "country": country, "date": date}
+            for region, countries in (("EU", ("IT", "ES", "UK")), ("NA", ("US",)))
+            for country in countries
+            for date in ("20210301", "20210302")
+        ]
+        scheduler = FairScheduler(
+            jobs,
+            key_func=lambda job: job["region"],
+            per_key_limit=1,
+            sub_key_func=lambda job: job["country"],
+            priority_func=lambda job: -int(job["date"]),
+        )
+
+        order = [(job["region"], job["country"], job["date"]) for job in drain(scheduler)]
+
+        self.assertEqual(
+            order,
+            [
+                ("EU", "IT", "20210302"),
+                ("NA", "US", "20210302"),
+                ("EU", "ES", "20210302"),
+                ("NA", "US", "20210301"),
+                ("EU", "UK", "20210302"),
+                ("EU", "IT", "20210301"),
+                ("EU", "ES", "20210301"),
+                ("EU", "UK", "20210301"),
+            ],
+        )
+
+    def test_weights_share_the_workers(self):
+        jobs = [{"region": region} for region in ("EU", "NA") for _ in range(6)]
+        scheduler = FairScheduler(jobs, key_func=lambda job: job["region"], per_key_limit=1, weights={"EU": 2})
+
+        order = [job["region"] for job in drain(scheduler)]
+
+        self.assertEqual(order[:6], ["EU", "NA", "EU", "EU", "NA", "EU"])
+
+    def test_weights_apply_across_priorities(self):
+        # NA only has recent dates, EU only older ones, EU still gets twice NA's share
+        jobs = [{"region": "EU", "date": 20210301 + i} for i in range(6)]
+        jobs += [{"region": "NA", "date": 20210310 + i} for i in range(6)]
+        scheduler = FairScheduler(
+            jobs,
+            key_func=lambda job: job["region"],
+            per_key_limit=1,
+            priority_func=lambda job: -job["date"],
+            weights={"EU": 2},
+        )
+
+        order = [(job["region"], job["date"]) for job in drain(scheduler)]
+
+        self.assertEqual([region for region, _ in order[:6]], ["NA", "EU", "EU", "NA", "EU", "EU"])
+        self.assertEqual([date for region, date in order if region == "EU"], list(range(20210306, 20210300, -1)))
+
+
+class TestRunConcurrently(unittest.TestCase):
+    def test_saturated_region_does_not_hold_back_the_others(self):
+        running = {"EU": 0, "NA": 0}
+        peak = {"EU": 0, "NA": 0}
+        lock = threading.Lock()
+
+        def create_report(job):
+            with lock:
+                running[job["region"]] += 1
+                peak[job["region"]] = max(peak[job["region"]], running[job["region"]])
+            time.sleep(0.05 if job["region"] == "EU" else 0.01)
+            with lock:
+                running[job["region"]] -= 1
+            if job["id"] == 3:
+                raise Exception("Invalid value: 3")
+            return job["id"]
+
+        jobs = [{"region": "EU", "id": i} for i in range(8)] + [{"region": "NA", "id": i} for i in range(8, 12)]
+
+        results = run_concurrently(
+            jobs, create_report, key_func=lambda job: job["region"], max_workers=4, per_key_limit=2
+        )
+
+        self.assertEqual([job for job, _, _ in results], jobs)
+        self.assertEqual([result for _, result, _ in results], [0, 1, 2, None] + list(range(4, 12)))
+        self.assertIsInstance(results[3][2], Exception)
+        self.assertEqual(peak, {"EU": 2, "NA": 2})
+
+    def test_on_done_is_called_as_each_job_finishes(self):
+        finished = []
+
+        results = run_concurrently(
+            range(6),
+            lambda job: job * 10,
+            key_func=lambda job: job % 2,
+            max_workers=1,
+            per_key_limit=1,
+            on_done=lambda job, result, exception: finished.append((job, result, exception)),
+        )
+
+        self.assertEqual([result for _, result, _ in results], [0, 10, 20, 30, 40, 50])
+        self.assertEqual(finished, [(job, job * 10, None) for job in range(6)])
+
+    def test_jobs_run_in_the_callers_context(self):
+        trace_id = contextvars.ContextVar("trace_id", default=None)
+        trace_id.set("trace-1")
+
+        results = run_concurrently(
+            range(4), lambda job: trace_id.get(), key_func=lambda job: job % 2, max_workers=4, per_key_limit=1
+        )
+
+        self.assertEqual([result for _, result, _ in results], ["trace-1"] * 4)
+
+    def test_no_jobs(self):
+        self.assertEqual(
+            run_concurrently([], lambda job: job, key_func=lambda job: job, max_workers=4, per_key_limit=1), []
+        )
+
+
+class TestStreamBatcher(unittest.TestCase):
+    def test_full_batches_are_flushed_right_away(self):
+        flushed = []
+        batcher = StreamBatcher(lambda item: item[0], 2, flushed.append)
+
+        for item in ["a1", "b1", "a2", "a3", "b2", "c1"]:
+            batcher.add(item)
+        self.assertEqual(flushed, [[["a1", "a2"]], [["b1", "b2"]]])
+
+        batcher.close()
+        self.assertEqual(flushed[2:], [[["a3"], ["c1"]]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import unittest
+
+from utils.ledger import (
+    CREATED,
+    LOADED,
+    LedgerEntry,
+    LedgerKey,
+    LoadLedger,
+    SQLiteLoadLedger,
+    is_in_flight,
+)
+
+
+def key(report_date, tactic=None):
+    return LedgerKey.for_report("A", "US", "sd", "targets", tactic, None, report_date)
+
+
+class TestSQLiteLoadLedger(unittest.TestCase):
+    def setUp(self) -> None:
+        self.ledger = SQLiteLoadLedger(":memory:")
+
+    def test_latest_status_per_key(self):
+        self.ledger.record_status([(key("20210101"), "r1"), (key("20210102"), "r2")], CREATED)
+        self.ledger.record_status([(key("20210101"), "r1")], LOADED, {key("20210101"): 42})
+
+        entries = self.ledger.get_many([key("20210101"), key("20210102"), key("20210103")])
+
+        self.assertEqual(set(entries), {key("20210101"), key("20210102")})
+        self.assertEqual(entries[key("20210101")][1:4], ("r1", LOADED, 42))
+        self.assertEqual(entries[key("20210102")][1:4], ("r2", CREATED, None))
+
+    def test_backends_implement_get_many_and_record(self):
+        class IncompleteLedger(LoadLedger):
+            def record(self, entries):
+                pass
+
+        with self.assertRaises(TypeError):
+            IncompleteLedger()
+
+    def test_readiness_stats_replace_previous_ones(self):
+        self.ledger.record_readiness({("sp", "targets", "US"): (300.0, 60.0), ("sd", "campaigns", "US"): (90.0, 9.0)})
+        self.ledger.record_readiness({("sp", "targets", "US"): (240.0, 50.0)})
+
+        self.assertEqual(
+            self.ledger.get_readiness(),
+            {("sp", "targets", "US"): (240.0, 50.0), ("sd", "campaigns", "US"): (90.0, 9.0)},
+        )
+
+    def test_variant_is_part_of_the_key(self):
+        self.ledger.record_status([(key("20210101", tactic="T00030"), "r1")], LOADED)
+
+        self.assertEqual(self.ledger.get_many([key("20210101"), key("20210101", tactic="remarketing")]), {})
+
+
+class TestIsInFlight(unittest.TestCase):
+    def test_recently_created_reports_are_in_flight(self):
+        created = LedgerEntry(key("20210601"), "r1", CREATED, None, 1000.0)
+        self.assertTrue(is_in_flight(created, 1000.0 + 60, 3600))
+        self.assertFalse(is_in_flight(created, 1000.0 + 7200, 3600))
+        self.assertFalse(is_in_flight(created._replace(status=LOADED), 1000.0 + 60, 3600))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import json
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.metrics import (
+    MetricsRegistry,
+    breakdown,
+    metrics,
+    timed,
+    timed_iter,
+    trace_context,
+)
+
+
+def slow(items, seconds):
+    for item in items:
+        time.sleep(seconds)
+        yield item
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.clear()
+
+    def test_nested_stages_record_exclusive_time(self):
+        with self.assertLogs(level="INFO") as logs, breakdown("report", report_id="r1") as fields:
+            with timed("serialize") as timer:
+                chunks = timed_iter(slow([b"ab", b"cde"], 0.02), "download", len)
+                rows = timed_iter(slow(chunks, 0.01), "parse")
+                self.assertEqual(list(rows), [b"ab", b"cde"])
+                time.sleep(0.03)
+            fields["rows"] = 2
+
+        self.assertGreaterEqual(metrics.get("amz_ads_stage_seconds", stage="download")[0], 0.04)
+        self.assertLess(metrics.get("amz_ads_stage_seconds", stage="parse")[0], 0.035)
+        self.assertLess(metrics.get("amz_ads_stage_seconds", stage="serialize")[0], 0.045)
+        self.assertGreaterEqual(timer.total_seconds, 0.09)
+        self.assertEqual(metrics.get("amz_ads_stage_bytes", stage="download"), (5, 0))
+        self.assertEqual(metrics.get("amz_ads_stage_rows", stage="parse"), (2, 0))
+
+        events = [json.loads(line.split("metrics ", 1)[1]) for line in logs.output]
+        self.assertEqual([event["event"] for event in events], ["download", "parse", "serialize", "report"])
+        self.assertEqual(set(events[-1]["stages"]), {"download", "parse", "serialize"})
+        self.assertEqual(events[-1]["report_id"], "r1")
+        self.assertEqual(events[-1]["rows"], 2)
+
+    def test_trace_id_propagates_to_copied_contexts(self):
+        import contextvars
+
+        def record():
+            with timed("create_report"):
+                pass
+
+        with self.assertLogs(level="INFO") as logs, trace_context("task-123"):
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                executor.submit(contextvars.copy_context().run, record).result()
+        self.assertEqual(json.loads(logs.output[0].split("metrics ", 1)[1])["trace"], "task-123")
+
+    def test_renders_openmetrics(self):
+        registry = MetricsRegistry()
+        registry.inc("amz_ads_requests", endpoint="report_status", status=200)
+        registry.inc("amz_ads_requests", endpoint="report_status", status=200)
+        registry.observe("amz_ads_stage_seconds", 1.5, stage="download")
+        self.assertEqual(
+            registry.render(),
+            "# TYPE amz_ads_requests counter\n"
+            'amz_ads_requests_total{endpoint="report_status",status="200"} 2\n'
+            "# TYPE amz_ads_stage_seconds summary\n"
+            'amz_ads_stage_seconds_count{stage="download"} 1\n'
+            'amz_ads_stage_seconds_sum{stage="download"} 1.5\n'
+            "# EOF\n",
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import gzip
+import json
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.parse_pool import ReportParsePool
+
+SCHEMA = [
+    {"name": "campaignid", "type": "INTEGER"},
+    {"name": "cost", "type": "FLOAT"},
+    {"name": "date", "type": "DATE"},
+]
+
+
+def split(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def read_ndjson(parsed_report):
+    with gzip.open(parsed_report.path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestReportParsePool(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # Small slots, so reports span many more chunks than there are slots
+        cls.pool = ReportParsePool(processes=2, chunk_size=256, slots=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.pool.close()
+
+    def test_parses_and_normalizes_concurrent_reports(self):
+        def parse(n):
+            rows = [{"campaignId": str(i), "cost": i, "campaign-Name": f"Kampagne ☃ {n}"} for i in range(n)]
+            parsed_report = self.pool.parse(
+                split(gzip.compress(json.dumps(rows).encode()), 1000), SCHEMA, "2021-03-04", "json"
+            )
+            try:
+                return parsed_report.row_count, read_ndjson(parsed_report)
+            finally:
+                parsed_report.discard()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(executor.map(parse, [300, 0, 50, 1200]))
+
+        for n, (row_count, rows) in zip([300, 0, 50, 1200], results):
+            self.assertEqual(row_count, n)
+            self.assertEqual(
+                rows,
+                [
+                    {"campaignid": i, "cost": float(i), "campaign_name": f"Kampagne ☃ {n}", "date": "2021-03-04"}
+                    for i in range(n)
+                ],
+            )
+
+    def test_lane_is_reusable_after_errors(self):
+        with self.assertRaises(ValueError):
+            self.pool.parse([gzip.compress(b'{"not": "an array"}' * 1000)], SCHEMA, "2021-03-04", "json")
+
+        def failing_download():
+            yield gzip.compress(b'[{"campaignId": 1},' * 100)[:500]
+            raise IOError("connection reset")
+
+        with self.assertRaises(IOError):
+            self.pool.parse(failing_download(), SCHEMA, "2021-03-04", "json")
+
+        for _ in range(2):
+            parsed_report = self.pool.parse([gzip.compress(b'[{"campaignId": 1}]')], SCHEMA, "2021-03-04", "json")
+            parsed_report.discard()
+            self.assertEqual(parsed_report.row_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,102 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from services.amz_advertising import amz_advertising
+from services.amz_advertising.profiles import ProfileIndex
+
+PROFILES = [
+    {"profileId": 1, "countryCode": "US", "accountInfo": {"id": "A2F1M85EMKLCHV"}},
+    {"profileId": 2, "countryCode": "CA", "accountInfo": {"id": "A2F1M85EMKLCHV"}},
+    {"profileId": 3, "countryCode": "US", "accountInfo": {"id": "OTHER"}},
+]
+
+
+class TestProfileIndex(unittest.TestCase):
+    def setUp(self) -> None:
+        self.calls = 0
+
+    def fetch_profiles(self):
+        self.calls += 1
+        return PROFILES
+
+    def test_indexed_by_marketplace_and_fetched_once_per_region(self):
+        index = ProfileIndex(ttl=60)
+
+        by_marketplace = index.get("NA", "client", self.fetch_profiles).by_marketplace
+        index.get("NA", "client", self.fetch_profiles)
+
+        self.assertEqual(by_marketplace[("US", "A2F1M85EMKLCHV")]["profileId"], 1)
+        self.assertEqual(by_marketplace[("US", "OTHER")]["profileId"], 3)
+        self.assertNotIn(("UK", "A2F1M85EMKLCHV"), by_marketplace)
+        self.assertEqual(self.calls, 1)
+
+        index.get("EU", "client", self.fetch_profiles)
+        self.assertEqual(self.calls, 2)
+
+    def test_expires_after_ttl(self):
+        index = ProfileIndex(ttl=60)
+        with mock.patch("services.amz_advertising.profiles.time.time", return_value=1000.0):
+            index.get("NA", "client", self.fetch_profiles)
+        with mock.patch("services.amz_advertising.profiles.time.time", return_value=1059.0):
+            index.get("NA", "client", self.fetch_profiles)
+        with mock.patch("services.amz_advertising.profiles.time.time", return_value=1061.0):
+            index.get("NA", "client", self.fetch_profiles)
+        self.assertEqual(self.calls, 2)
+
+    def test_persisted_index_warms_new_processes(self):
+        persist_file = os.path.join(tempfile.mkdtemp(), "profiles.json")
+        ProfileIndex(ttl=60, persist_file=persist_file).get("NA", "client", self.fetch_profiles)
+
+        entry = ProfileIndex(ttl=60, persist_file=persist_file).get("NA", "client", self.fetch_profiles)
+
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(entry.by_marketplace[("CA", "A2F1M85EMKLCHV")]["profileId"], 2)
+
+
+class TestGetProfileId(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 1000.0
+        patchers = [
+            mock.patch.object(amz_advertising, "profile_index", ProfileIndex(ttl=3600, refresh_cooldown=300)),
+            mock.patch("services.amz_advertising.profiles.time.time", side_effect=lambda: self.now),
+            mock.patch.object(amz_advertising.AmazonAdvertisingApiService, "_refresh_access_token"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service = amz_advertising.AmazonAdvertisingApiService(
+            "NA", credentials={"client_id": "client", "refresh_token": "token"}
+        )
+
+    def test_missing_profile_refetches_the_index(self):
+        new_profile = {"profileId": 4, "countryCode": "MX", "accountInfo": {"id": "A2F1M85EMKLCHV"}}
+        responses = [PROFILES, PROFILES + [new_profile]]
+
+        with mock.patch.object(self.service, "_request_profiles", side_effect=responses) as request_profiles:
+            self.assertEqual(self.service.get_profile_id("US", "A2F1M85EMKLCHV"), 1)
+            self.now += 301
+            self.assertEqual(self.service.get_profile_id("MX", "A2F1M85EMKLCHV"), 4)
+
+        self.assertEqual(request_profiles.call_count, 2)
+
+    def test_missing_profile_refetches_at_most_once_per_cooldown(self):
+        with mock.patch.object(self.service, "_request_profiles", return_value=PROFILES) as request_profiles:
+            self.service.get_profile_id("US", "A2F1M85EMKLCHV")
+            for _ in range(3):
+                with self.assertRaises(Exception):
+                    self.service.get_profile_id("UK", "A2F1M85EMKLCHV")
+            self.assertEqual(request_profiles.call_count, 1)
+
+            self.now += 301
+            with self.assertRaises(Exception):
+                self.service.get_profile_id("UK", "A2F1M85EMKLCHV")
+            with self.assertRaises(Exception):
+                self.service.get_profile_id("UK", "A2F1M85EMKLCHV")
+
+        self.assertEqual(request_profiles.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
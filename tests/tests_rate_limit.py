@@ -0,0 +1,62 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from services.amz_advertising import rate_limit
+from services.amz_advertising.rate_limit import (
+    TokenBucket,
+    backoff_delay,
+    get_rate_limiter,
+    parse_retry_after,
+)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_burst_then_throttle(self):
+        bucket = TokenBucket(rate=20, capacity=5)
+        start = time.monotonic()
+        for _ in range(10):
+            bucket.acquire()
+        elapsed = time.monotonic() - start
+        # 5 tokens from the burst, the other 5 refill at 20/s
+        self.assertGreaterEqual(elapsed, 0.2)
+        self.assertLess(elapsed, 1)
+
+    def test_penalize_blocks_all_threads(self):
+        bucket = TokenBucket(rate=1000, capacity=1000)
+        bucket.penalize(0.2)
+        waits = []
+
+        def worker():
+            waits.append(bucket.acquire())
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(waits), 4)
+        self.assertTrue(all(wait >= 0.15 for wait in waits))
+
+    def test_shared_per_region_and_profile(self):
+        self.assertIs(get_rate_limiter("EU", "1"), get_rate_limiter("EU", "1"))
+        self.assertIsNot(get_rate_limiter("EU", "1"), get_rate_limiter("EU", "2"))
+        self.assertIsNot(get_rate_limiter("EU", "1"), get_rate_limiter("NA", "1"))
+
+
+class TestBackoff(unittest.TestCase):
+    def test_parse_retry_after(self):
+        self.assertEqual(parse_retry_after("3"), 3.0)
+        self.assertIsNone(parse_retry_after(None))
+        self.assertIsNone(parse_retry_after("not a date"))
+        self.assertEqual(parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0.0)
+
+    def test_backoff_is_capped(self):
+        with mock.patch.object(rate_limit.config, "AMZ_BACKOFF_CAP_SECONDS", 30):
+            for attempt in range(1, 20):
+                self.assertLessEqual(backoff_delay(attempt), 30)
+            self.assertEqual(backoff_delay(1, retry_after=1000), 30)
+
+    def test_retry_after_is_lower_bound(self):
+        self.assertGreaterEqual(backoff_delay(1, retry_after=5), 5)
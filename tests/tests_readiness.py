@@ -0,0 +1,133 @@
+import unittest
+from unittest import mock
+
+from services.amz_advertising import amz_advertising
+from services.amz_advertising.readiness import (
+    ReportNotReadyError,
+    ReportReadinessScheduler,
+)
+
+KEY = ("sp", "targets", "US")
+
+
+def build_scheduler():
+    return ReportReadinessScheduler(
+        default_seconds=10,
+        min_poll_seconds=1,
+        max_poll_seconds=5,
+        min_delay_seconds=2,
+        max_delay_seconds=30,
+        alpha=0.5,
+    )
+
+
+class TestReportReadinessScheduler(unittest.TestCase):
+    def test_unseen_keys_use_the_default(self):
+        scheduler = build_scheduler()
+
+        self.assertEqual(scheduler.expected_seconds(KEY), 10)
+        # default + 2 default deviations (half the default)
+        self.assertEqual(scheduler.initial_delay(KEY), 20)
+
+    def test_learns_an_exponentially_weighted_mean_and_deviation(self):
+        scheduler = build_scheduler()
+
+        scheduler.record(KEY, 8)
+        self.assertEqual(scheduler.expected_seconds(KEY), 8)
+        self.assertEqual(scheduler.initial_delay(KEY), 16)
+
+        scheduler.record(KEY, 4)
+        # deviation 0.5 * 4 + 0.5 * |4 - 8|, mean 0.5 * 8 + 0.5 * 4
+        self.assertEqual(scheduler.expected_seconds(KEY), 6)
+        self.assertEqual(scheduler.initial_delay(KEY), 14)
+        self.assertEqual(scheduler.expected_seconds(("sp", "targets", "CA")), 10)
+
+    def test_initial_delay_is_clamped(self):
+        scheduler = build_scheduler()
+
+        scheduler.record(KEY, 0.1)
+        scheduler.record(("sd", "campaigns", "US"), 100)
+
+        self.assertEqual(scheduler.initial_delay(KEY), 2)
+        self.assertEqual(scheduler.initial_delay(("sd", "campaigns", "US")), 30)
+
+    def test_updates_are_shared_and_loaded(self):
+        scheduler = build_scheduler()
+        scheduler.record(KEY, 8)
+
+        self.assertEqual(scheduler.pop_updates(), {KEY: (8, 4)})
+        self.assertEqual(scheduler.pop_updates(), {})
+
+        dispatcher = build_scheduler()
+        dispatcher.load({KEY: (8, 4)})
+        self.assertEqual(dispatcher.initial_delay(KEY), 16)
+
+    def test_load_keeps_unshared_updates(self):
+        scheduler = build_scheduler()
+        scheduler.record(KEY, 8)
+
+        scheduler.load({KEY: (20, 1), ("sp", "targets", "CA"): (12, 1)})
+
+        self.assertEqual(scheduler.expected_seconds(KEY), 8)
+        self.assertEqual(scheduler.expected_seconds(("sp", "targets", "CA")), 12)
+
+    def test_polls_wait_for_the_expected_time_then_back_off(self):
+        scheduler = build_scheduler()
+
+        self.assertEqual(scheduler.next_poll_in(KEY, elapsed=0, overdue_polls=0), 5)
+        self.assertEqual(scheduler.next_poll_in(KEY, elapsed=7, overdue_polls=0), 3)
+        self.assertEqual(scheduler.next_poll_in(KEY, elapsed=10, overdue_polls=0), 1)
+        self.assertEqual(scheduler.next_poll_in(KEY, elapsed=12, overdue_polls=2), 2.25)
+        self.assertEqual(scheduler.next_poll_in(KEY, elapsed=60, overdue_polls=10), 5)
+
+
+class TestGetReportPolling(unittest.TestCase):
+    def setUp(self) -> None:
+        self.now = 1000.0
+        self.sleeps = []
+        self.scheduler = build_scheduler()
+        patchers = [
+            mock.patch.object(amz_advertising, "report_readiness", self.scheduler),
+            mock.patch.object(amz_advertising.time, "time", side_effect=lambda: self.now),
+            mock.patch.object(amz_advertising.time, "sleep", side_effect=self.sleep),
+            mock.patch.object(amz_advertising.AmazonAdvertisingApiService, "_refresh_access_token"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.service = amz_advertising.AmazonAdvertisingApiService(
+            "NA", credentials={"client_id": "client", "refresh_token": "token"}
+        )
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def get_report(self, statuses, **kwargs):
+        with mock.patch.object(self.service, "get_report_status", side_effect=statuses), mock.patch.object(
+            self.service, "download_ready_report", return_value={"report": []}
+        ):
+            return self.service.get_report("1", "sp", "targets", "20210304", "US", "A1", None, None, **kwargs)
+
+    def test_raises_not_ready_instead_of_polling_past_the_deadline(self):
+        statuses = [{"status": "IN_PROGRESS"}] * 10
+
+        with self.assertRaises(ReportNotReadyError) as raised:
+            self.get_report(statuses, deadline=1012.0)
+
+        self.assertEqual(self.sleeps, [5, 5, 1])
+        self.assertEqual(raised.exception.retry_after, 1.5)
+        self.assertEqual(raised.exception.report_id, "1")
+
+    def test_generation_time_of_ready_reports_is_learned(self):
+        statuses = [{"status": "IN_PROGRESS"}, {"status": "SUCCESS"}]
+
+        report = self.get_report(statuses, created_at=997.0, deadline=1100.0)
+
+        self.assertEqual(report, {"report": []})
+        self.assertEqual(self.sleeps, [5])
+        self.assertEqual(self.scheduler.expected_seconds(KEY), 8)
+
+
+if __name__ == "__main__":
+    unittest.main()
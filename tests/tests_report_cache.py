@@ -0,0 +1,151 @@
+import gzip
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from services.amz_advertising import amz_advertising
+from services.amz_advertising.report_cache import (
+    DiskReportCache,
+    ReportRequestCoalescer,
+)
+from services.amz_advertising.report_stream import iter_report_rows
+
+
+class TestReportRequestCoalescer(unittest.TestCase):
+    def test_concurrent_identical_requests_share_one_create(self):
+        coalescer = ReportRequestCoalescer(ttl=60)
+        calls = []
+        release = threading.Event()
+
+        def create():
+            calls.append(1)
+            release.wait(5)
+            return f"report-{len(calls)}"
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(coalescer.get_or_create(("p", "sp", "20210101"), create)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.05)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ["report-1"] * 8)
+        # Completed requests are reused within the ttl, other keys are created
+        self.assertEqual(coalescer.get_or_create(("p", "sp", "20210101"), create), "report-1")
+        self.assertEqual(coalescer.get_or_create(("p", "sp", "20210102"), create), "report-2")
+
+    def test_recent_report_id_is_replaced_when_not_reused(self):
+        coalescer = ReportRequestCoalescer(ttl=60)
+        coalescer.get_or_create("key", lambda: "report-1")
+
+        self.assertEqual(coalescer.get_or_create("key", lambda: "report-2", reuse_recent=False), "report-2")
+        self.assertEqual(coalescer.get_or_create("key", lambda: "report-3"), "report-2")
+
+    def test_failed_create_is_not_cached(self):
+        coalescer = ReportRequestCoalescer(ttl=60)
+
+        def fail():
+            raise Exception("429")
+
+        with self.assertRaises(Exception):
+            coalescer.get_or_create("key", fail)
+        self.assertEqual(coalescer.get_or_create("key", lambda: "report-1"), "report-1")
+
+    def test_failed_report_is_not_reused(self):
+        coalescer = ReportRequestCoalescer(ttl=60)
+        coalescer.get_or_create("key", lambda: "report-1")
+        coalescer.get_or_create("other", lambda: "report-2")
+
+        coalescer.forget("report-1")
+
+        self.assertEqual(coalescer.get_or_create("key", lambda: "report-3"), "report-3")
+        self.assertEqual(coalescer.get_or_create("other", lambda: "report-4"), "report-2")
+
+    def test_expired_report_ids_are_evicted(self):
+        coalescer = ReportRequestCoalescer(ttl=60)
+        with mock.patch("services.amz_advertising.report_cache.time.monotonic", return_value=1000.0):
+            coalescer.get_or_create("old", lambda: "report-1")
+        with mock.patch("services.amz_advertising.report_cache.time.monotonic", return_value=1060.0):
+            coalescer.get_or_create("new", lambda: "report-2")
+
+        self.assertEqual(list(coalescer._recent), ["new"])
+
+    def test_report_seen_failing_is_created_again(self):
+        coalescer = ReportRequestCoalescer(ttl=60)
+        with mock.patch.object(amz_advertising, "report_request_coalescer", coalescer), mock.patch.object(
+            amz_advertising.AmazonAdvertisingApiService, "_refresh_access_token"
+        ):
+            service = amz_advertising.AmazonAdvertisingApiService(
+                "NA", credentials={"client_id": "client", "refresh_token": "token"}
+            )
+            coalescer.get_or_create("key", lambda: "report-1")
+
+            report = service.download_ready_report(
+                {"reportId": "report-1", "status": "FAILURE"}, "sp", "targets", "US", "A1", None, None
+            )
+
+        self.assertIsNone(report)
+        self.assertEqual(coalescer.get_or_create("key", lambda: "report-2"), "report-2")
+
+
+class TestDiskReportCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.mkdtemp()
+
+    def payload(self, rows):
+        return gzip.compress(json.dumps([{"id": i} for i in range(rows)]).encode())
+
+    def download(self, cache, report_id, payload, chunk_size=64):
+        chunks = [payload[i : i + chunk_size] for i in range(0, len(payload), chunk_size)]
+        return list(iter_report_rows(cache.tee(report_id, chunks)))
+
+    def test_payload_is_cached_once_fully_read(self):
+        cache = DiskReportCache(self.directory, max_bytes=1024 * 1024)
+        payload = self.payload(100)
+
+        rows = self.download(cache, "amzn1.report/1", payload)
+
+        with cache.open("amzn1.report/1") as cached:
+            self.assertEqual(cached.read(), payload)
+        self.assertEqual(len(rows), 100)
+        # A new process picks up the cached payloads
+        self.assertIsNotNone(DiskReportCache(self.directory, max_bytes=1024 * 1024).open("amzn1.report/1"))
+
+    def test_abandoned_download_is_not_cached(self):
+        cache = DiskReportCache(self.directory, max_bytes=1024 * 1024)
+        payload = self.payload(1000)
+        chunks = [payload[i : i + 64] for i in range(0, len(payload), 64)]
+
+        rows = iter_report_rows(cache.tee("report-1", chunks))
+        next(rows)
+        rows.close()
+
+        self.assertIsNone(cache.open("report-1"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_least_recently_used_payloads_are_evicted(self):
+        payload = self.payload(100)
+        cache = DiskReportCache(self.directory, max_bytes=len(payload) * 2)
+        self.download(cache, "report-1", payload)
+        self.download(cache, "report-2", payload)
+        cache.open("report-1").close()
+
+        self.download(cache, "report-3", payload)
+
+        self.assertIsNone(cache.open("report-2"))
+        self.assertIsNotNone(cache.open("report-1"))
+        self.assertIsNotNone(cache.open("report-3"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import time
+import unittest
+from unittest import mock
+
+from services.amz_advertising.readiness import ReportNotReadyError
+from services.amz_advertising.report_collector import ReportCollector
+
+
+class FakeAmazonAdvertisingApiService:
+    def __init__(self, statuses):
+        # report_id -> statuses returned by successive polls, the last one repeats
+        self.statuses = statuses
+        self.polls = []
+
+    def get_report_status(self, report_id, country_code, account_id):
+        self.polls.append(report_id)
+        statuses = self.statuses[report_id]
+        status = statuses.pop(0) if len(statuses) > 1 else statuses[0]
+        return {"reportId": report_id, "status": status, "location": f"https://reports/{report_id}"}
+
+    def download_ready_report(
+        self, report_status_json, ad_type, record_type, country_code, account_id, tactic, creativeType
+    ):
+        if report_status_json["status"] != "SUCCESS":
+            return None
+        return {"report": iter([{"id": report_status_json["reportId"]}]), "bq_schema": []}
+
+
+@mock.patch("services.amz_advertising.report_collector.time.sleep")
+class TestReportCollector(unittest.TestCase):
+    def add(self, collector, report_id, country_code="US"):
+        collector.add(report_id, report_id, "sp", "campaigns", country_code, "A", created_at=time.time())
+
+    def test_yields_reports_as_soon_as_they_are_ready(self, sleep):
+        service = FakeAmazonAdvertisingApiService(
+            {"slow": ["IN_PROGRESS", "IN_PROGRESS", "SUCCESS"], "fast": ["SUCCESS"], "failed": ["FAILURE"]}
+        )
+        collector = ReportCollector(service, deadline=time.time() + 3600)
+        for report_id in ["slow", "fast", "failed"]:
+            self.add(collector, report_id)
+
+        collected = [(key, report and list(report["report"])) for key, report in collector.collect()]
+
+        self.assertEqual(collected, [("fast", [{"id": "fast"}]), ("failed", None), ("slow", [{"id": "slow"}])])
+        self.assertEqual(service.polls, ["slow", "fast", "failed", "slow", "slow"])
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(len(collector), 0)
+
+    def test_polls_profiles_round_robin(self, sleep):
+        service = FakeAmazonAdvertisingApiService({"us-1": ["SUCCESS"], "us-2": ["SUCCESS"], "ca-1": ["SUCCESS"]})
+        collector = ReportCollector(service, deadline=time.time() + 3600)
+        self.add(collector, "us-1")
+        self.add(collector, "us-2")
+        self.add(collector, "ca-1", country_code="CA")
+
+        list(collector.collect())
+
+        self.assertEqual(service.polls, ["us-1", "ca-1", "us-2"])
+
+    def test_deadline_leaves_unready_reports_pending(self, sleep):
+        service = FakeAmazonAdvertisingApiService({"ready": ["SUCCESS"], "stuck": ["IN_PROGRESS"]})
+        collector = ReportCollector(service, deadline=time.time() + 1)
+        self.add(collector, "ready")
+        self.add(collector, "stuck")
+
+        collected = []
+        with self.assertRaises(ReportNotReadyError):
+            for key, _ in collector.collect():
+                collected.append(key)
+
+        self.assertEqual(collected, ["ready"])
+        self.assertEqual(collector.pending(), ["stuck"])
+        sleep.assert_not_called()
+
+    def test_deadline_is_checked_before_each_ready_report(self, sleep):
+        service = FakeAmazonAdvertisingApiService({"a": ["SUCCESS"], "b": ["SUCCESS"], "c": ["SUCCESS"]})
+        now = [1000.0]
+        with mock.patch("services.amz_advertising.report_collector.time.time", side_effect=lambda: now[0]):
+            collector = ReportCollector(service, deadline=1100)
+            for report_id in ["a", "b", "c"]:
+                self.add(collector, report_id)
+
+            collected = []
+            with self.assertRaises(ReportNotReadyError):
+                for key, _ in collector.collect():
+                    collected.append(key)
+                    # Downloading and loading the report takes past the deadline
+                    now[0] += 200
+
+        self.assertEqual(collected, ["a"])
+        self.assertEqual(collector.pending(), ["b", "c"])
+        self.assertEqual(service.polls, ["a"])
+
+
+if __name__ == "__main__":
+    unittest.main()
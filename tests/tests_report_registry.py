@@ -0,0 +1,56 @@
+import unittest
+
+from services.amz_advertising.report_registry import _definition, get_report_definition
+
+
+class TestReportDefinition(unittest.TestCase):
+    def test_lookback_is_the_longest_attribution_window(self):
+        metrics = ["campaignId", "clicks", "attributedSales14d", "attributedConversions30dSameSKU", "attributedSales7d"]
+
+        definition = _definition("sp", "campaigns", None, metrics, None)
+
+        self.assertEqual(definition.lookback_days, 30)
+        self.assertEqual(definition.metrics_param, ",".join(metrics))
+        self.assertEqual(_definition("sp", "campaigns", None, ["campaignId", "clicks"], None).lookback_days, 0)
+        self.assertEqual(_definition("sp", "campaigns", None, ["attributedSales1dOtherSKU"], None).lookback_days, 1)
+
+    def test_schema_fields_match_the_json_schema(self):
+        definition = get_report_definition("sp", "targets")
+
+        self.assertEqual(
+            [field.name for field in definition.schema_fields], [field["name"] for field in definition.bq_schema]
+        )
+        self.assertEqual(definition.lookback_days, 30)
+        self.assertIn("campaignId", definition.metrics)
+
+    def test_sd_reports_are_keyed_by_tactic(self):
+        remarketing = get_report_definition("sd", "campaigns", tactic="remarketing", creativeType="video")
+        t00030 = get_report_definition("sd", "campaigns", tactic="T00030")
+
+        self.assertEqual(remarketing.variant, "remarketing")
+        self.assertNotEqual(remarketing.metrics, t00030.metrics)
+        self.assertIsNone(get_report_definition("sd", "asins", tactic="T00020").bq_schema)
+
+    def test_hsa_reports_are_keyed_by_creative_type_and_share_the_schema(self):
+        default = get_report_definition("hsa", "campaigns")
+        video = get_report_definition("hsa", "campaigns", tactic="T00020", creativeType="video")
+
+        self.assertIsNone(default.variant)
+        self.assertEqual(video.variant, "video")
+        self.assertNotEqual(default.metrics, video.metrics)
+        self.assertIs(default.bq_schema, video.bq_schema)
+
+    def test_tactic_and_creative_type_are_ignored_for_sp(self):
+        self.assertIs(
+            get_report_definition("sp", "keywords", "T00020", "video"), get_report_definition("sp", "keywords")
+        )
+
+    def test_unknown_report_raises(self):
+        with self.assertRaises(Exception):
+            get_report_definition("sd", "campaigns", tactic="T99999")
+        with self.assertRaises(Exception):
+            get_report_definition("hsa", "campaigns", creativeType="audio")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,37 @@
+import gzip
+import json
+import unittest
+
+from services.amz_advertising.report_stream import (
+    iter_gunzip,
+    iter_json_array,
+    iter_report_rows,
+)
+
+
+def split(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+class TestReportStream(unittest.TestCase):
+    def test_rows_survive_any_chunking(self):
+        rows = [{"campaignId": i, "campaignName": f"Kampagne ☃ {i} ]}}", "cost": i * 0.5} for i in range(500)]
+        data = gzip.compress(json.dumps(rows).encode())
+        for chunk_size in (1, 3, 64, 4096, len(data)):
+            self.assertEqual(list(iter_report_rows(split(data, chunk_size))), rows)
+
+    def test_scalars_split_across_chunks(self):
+        self.assertEqual(list(iter_json_array([b"[1", b"23, 4", b"5]"])), [123, 45])
+
+    def test_empty_report(self):
+        self.assertEqual(list(iter_report_rows([gzip.compress(b" [ ] ")])), [])
+
+    def test_multi_member_gzip(self):
+        data = gzip.compress(b'[{"a": 1},') + gzip.compress(b'{"a": 2}]')
+        self.assertEqual(b"".join(iter_gunzip(split(data, 5))), b'[{"a": 1},{"a": 2}]')
+
+    def test_truncated_report_raises(self):
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'[{"a": 1}, {"a": ']))
+        with self.assertRaises(ValueError):
+            list(iter_json_array([b'{"a": 1}']))
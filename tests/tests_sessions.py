@@ -0,0 +1,49 @@
+import unittest
+from unittest import mock
+
+import config
+from services.amz_advertising import amz_advertising, sessions
+
+
+class TestSessions(unittest.TestCase):
+    def setUp(self) -> None:
+        patchers = [
+            mock.patch.dict(sessions._sessions, clear=True),
+            mock.patch.object(amz_advertising.AmazonAdvertisingApiService, "_refresh_access_token"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def service(self, region):
+        return amz_advertising.AmazonAdvertisingApiService(
+            region, credentials={"client_id": "client", "refresh_token": "token"}
+        )
+
+    def test_clients_of_a_region_share_its_session(self):
+        eu_1, eu_2, na = self.service("EU"), self.service("EU"), self.service("NA")
+
+        self.assertIs(eu_1._session, eu_2._session)
+        self.assertIsNot(eu_1._session, na._session)
+        # The token endpoint has its own session, shared by all regions
+        self.assertIs(eu_1._auth_session, na._auth_session)
+        self.assertNotIn(eu_1._auth_session, (eu_1._session, na._session))
+
+    def test_pool_size_and_timeouts_come_from_config(self):
+        with mock.patch.multiple(config, AMZ_HTTP_POOL_SIZE=7, AMZ_HTTP_CONNECT_TIMEOUT=3, AMZ_HTTP_READ_TIMEOUT=40):
+            adapter = sessions.get_session("FE").get_adapter("https://advertising-api-fe.amazon.com")
+
+            self.assertEqual(adapter._pool_maxsize, 7)
+            self.assertEqual(adapter._pool_connections, 7)
+            self.assertEqual(sessions.get_timeout(), (3, 40))
+
+    def test_closed_sessions_are_created_again(self):
+        session = sessions.get_session("EU")
+
+        sessions.close_sessions()
+
+        self.assertIsNot(sessions.get_session("EU"), session)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import time
+import unittest
+from unittest import mock
+
+from google.api_core import exceptions
+
+from benchmarks.fake_gcp import FakeCloudTasksClient
+from utils import tasks
+from utils.tasks import build_http_task, create_tasks
+
+
+def make_task(name):
+    return build_http_task("https://example.com", "sa@example.com", name, 1800, {"name": name}, delay=60)
+
+
+class TestCreateTasks(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeCloudTasksClient()
+        patcher = mock.patch.object(tasks, "_tasks_client", self.client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_already_exists_counts_as_created(self):
+        client = FakeCloudTasksClient(existing={"b"}, failing={"c"})
+
+        with mock.patch.object(tasks, "_tasks_client", client):
+            outcomes = create_tasks("queue", [make_task(name) for name in ["a", "b", "c"]])
+
+        self.assertEqual([outcome.name for outcome in outcomes], ["a", "b", "c"])
+        self.assertEqual([outcome.ok for outcome in outcomes], [True, True, False])
+        self.assertEqual([outcome.already_existed for outcome in outcomes], [False, True, False])
+        self.assertIsInstance(outcomes[2].error, exceptions.InternalServerError)
+        self.assertEqual([task["name"] for task in client.tasks], ["a"])
+
+    def test_bounded_concurrency(self):
+        self.client.latency = 0.01
+
+        outcomes = create_tasks("queue", [make_task(str(i)) for i in range(50)], max_in_flight=8)
+
+        self.assertTrue(all(outcome.ok for outcome in outcomes))
+        self.assertLessEqual(self.client.max_in_flight, 8)
+        self.assertGreater(self.client.max_in_flight, 1)
+
+    def test_build_http_task_schedule_time(self):
+        task = make_task("a")
+        self.assertAlmostEqual(task["schedule_time"].seconds, time.time() + 60, delta=5)
+        self.assertNotIn("schedule_time", build_http_task("https://example.com", "sa", "a", 1800, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import threading
+import time
+import unittest
+
+from services.amz_advertising.token_cache import AccessTokenCache
+
+
+class TestAccessTokenCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.calls = 0
+
+    def fetch_token(self, expires_in=3600):
+        def fetch():
+            self.calls += 1
+            return {"access_token": f"token-{self.calls}", "expires_in": expires_in}
+
+        return fetch
+
+    def test_reuses_token_until_expiry_margin(self):
+        cache = AccessTokenCache(refresh_margin=60)
+        self.assertEqual(cache.get("client", "refresh", self.fetch_token()), "token-1")
+        self.assertEqual(cache.get("client", "refresh", self.fetch_token()), "token-1")
+        self.assertEqual(self.calls, 1)
+
+        # expires_in inside the refresh margin is never served from cache
+        cache = AccessTokenCache(refresh_margin=60)
+        cache.get("client", "refresh", self.fetch_token(expires_in=30))
+        cache.get("client", "refresh", self.fetch_token(expires_in=30))
+        self.assertEqual(self.calls, 3)
+
+    def test_keyed_by_client_and_refresh_token(self):
+        cache = AccessTokenCache(refresh_margin=0)
+        cache.get("client", "refresh-a", self.fetch_token())
+        cache.get("client", "refresh-b", self.fetch_token())
+        self.assertEqual(self.calls, 2)
+
+    def test_invalidate_only_drops_matching_token(self):
+        cache = AccessTokenCache(refresh_margin=0)
+        cache.get("client", "refresh", self.fetch_token())
+        cache.invalidate("client", "refresh", "some-older-token")
+        self.assertEqual(cache.get("client", "refresh", self.fetch_token()), "token-1")
+        cache.invalidate("client", "refresh", "token-1")
+        self.assertEqual(cache.get("client", "refresh", self.fetch_token()), "token-2")
+
+    def test_concurrent_callers_share_one_refresh(self):
+        cache = AccessTokenCache(refresh_margin=0)
+
+        def slow_fetch():
+            time.sleep(0.1)
+            self.calls += 1
+            return {"access_token": "shared", "expires_in": 3600}
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cache.get("client", "refresh", slow_fetch)))
+            for _ in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["shared"] * 8)
+        self.assertEqual(self.calls, 1)
@@ -0,0 +1,67 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+from utils import worker
+from utils.worker import LocalJobQueue, ReportWorker, publish_jobs
+
+
+class TestReportWorker(unittest.TestCase):
+    def test_processes_jobs_concurrently(self):
+        in_flight = []
+        max_in_flight = []
+        lock = threading.Lock()
+
+        def process(payload):
+            with lock:
+                in_flight.append(payload)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.02)
+            with lock:
+                in_flight.remove(payload)
+            return f"processed {payload['i']}"
+
+        stats = ReportWorker(LocalJobQueue({"i": i} for i in range(40)), process, concurrency=4).run(idle_timeout=0)
+
+        self.assertEqual((stats.succeeded, stats.failed), (40, 0))
+        self.assertEqual(max(max_in_flight), 4)
+
+    def test_failed_jobs_are_nacked(self):
+        def process(payload):
+            if payload["i"] % 2:
+                raise Exception("report failed")
+
+        job_queue = LocalJobQueue({"i": i} for i in range(6))
+        stats = ReportWorker(job_queue, process, concurrency=2).run(idle_timeout=0)
+
+        self.assertEqual((stats.succeeded, stats.failed), (3, 3))
+        self.assertEqual(sorted(payload["i"] for payload in job_queue.failed), [1, 3, 5])
+
+    def test_waits_for_jobs_until_idle_timeout(self):
+        job_queue = LocalJobQueue()
+        threading.Timer(0.1, lambda: job_queue.put({"i": 0})).start()
+
+        stats = ReportWorker(job_queue, lambda payload: None, concurrency=2).run(idle_timeout=0.5)
+
+        self.assertEqual(stats.succeeded, 1)
+
+    def test_max_jobs(self):
+        job_queue = LocalJobQueue({"i": i} for i in range(10))
+        stats = ReportWorker(job_queue, lambda payload: None, concurrency=2).run(max_jobs=3)
+        self.assertEqual(stats.succeeded, 3)
+
+
+class TestPublishJobs(unittest.TestCase):
+    def test_publisher_is_shared_by_all_calls(self):
+        pubsub_v1 = mock.Mock()
+        with mock.patch.object(worker, "pubsub_v1", pubsub_v1), mock.patch.object(worker, "_publisher", None):
+            self.assertEqual(publish_jobs("topic", [{"i": 1}, {"i": 2}]), 2)
+            self.assertEqual(publish_jobs("topic", [{"i": 3}]), 1)
+
+        pubsub_v1.PublisherClient.assert_called_once_with()
+        self.assertEqual(pubsub_v1.PublisherClient.return_value.publish.call_count, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,105 +4,303 @@ from google.api_core.exceptions import BadRequest
 from google.cloud.bigquery.schema import SchemaField
 
 import datetime
+import itertools
+import json
 import logging
 logging.basicConfig(level='INFO')
-import re
+import tempfile
+import threading
+import time
+import uuid
 
-def get_schema_from_json_list(project_id, dataset, json_list):
-    json_list = format_list_of_dicts_for_bq(json_list)
-    bq_client = bigquery.Client(project=project_id)
-    table = "temp_table_for_schema_definition_xxx"
+import config
+from utils.bq_arrow import write_parquet_temp_file
+from utils.bq_rows import get_row_normalizer, write_ndjson_gzip
+from utils.bq_schema import infer_schema, infer_stream_schema
+from utils.metrics import timed, timed_iter
 
-    # Check if BQ Dataset exist for customer else create it
-    dataset_id_constructor = f"{project_id}.{dataset}"
-    try:
-        bq_client.get_dataset(dataset)
-    except NotFound:
-        logging.info(f"Dataset with id {dataset} not found - creating it.")
-        dataset = bigquery.Dataset(dataset_id_constructor)
-        dataset.location = "EU"
-        dataset = bq_client.create_dataset(dataset, timeout=30)
-    
-    table_id_constructor = f"{project_id}.{dataset}.{table}"
-    try:
-        bq_client.get_table(table_id_constructor)
-    except NotFound:
-        table = bigquery.Table(table_id_constructor)
-        table = bq_client.create_table(table)
-    
-    job_config = bigquery.LoadJobConfig()
-    job_config.write_disposition = bigquery.WriteDisposition.WRITE_TRUNCATE
+def get_schema_from_json_list(json_list, schema_file=None):
+    """
+    Infers the BigQuery schema of rows in process (see utils.bq_schema) from their first BQ_SCHEMA_SAMPLE_ROWS rows,
+    in the format of reports_fields_bq_schema.json. Written to schema_file as well if given.
+    """
+    schema = infer_schema(json_list)
+    if schema_file is not None:
+        with open(schema_file, "w") as f:
+            json.dump(schema, f, indent=2)
+    return schema
+
+def bq_load_json_list(project_id, dataset, table_name, json_list,partition_date,schema,load_format="json"):
+    """
+    Loads rows (any iterable of dicts, e.g. a streamed report) into the partition_date partition of table_name.
+    Rows are formatted and written one at a time to a temp file which is then uploaded, so the full report never has
+    to be held in memory as a list.
+    load_format: "json" uploads newline delimited json, "parquet" builds columnar arrow batches typed by the schema
+        and uploads snappy parquet (smaller uploads, exact numeric types, requires pyarrow)
+    """
+    if not schema:
+        json_list, schema = infer_load_schema(json_list, table_name)
+    schema = get_load_schema(project_id, dataset, table_name, schema)
+    source_file, source_format = write_load_file(json_list, schema, load_format, table_name)
+    with source_file:
+        return bq_load_file(project_id, dataset, table_name, source_file, source_format, partition_date, schema)
+
+def bq_load_file(project_id, dataset, table_name, source_file, source_format, partition_date, schema):
+    """
+    Loads a load file already written in source_format (e.g. by the report parse pool) into the partition_date
+    partition of table_name. Returns the load job result, or the error messages as a string if BigQuery rejected it.
+    """
+    bq_client = get_bq_client(project_id)
+
+    bq_dataset = bq_client.dataset(dataset)
+
+    table_id_constructor = f"{project_id}.{dataset}.{table_name}"
+    get_or_create_partitioned_table(bq_client, table_id_constructor, schema)
 
-    load_job = bq_client.load_table_from_json(json_list, table_id_constructor, job_config=job_config)
-    logging.info('Starting job {}'.format(load_job.job_id))
+    table = bq_dataset.table(f"{table_name}${partition_date}")
+
+    job_config = bigquery.LoadJobConfig(
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=source_format,
+        time_partitioning=bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY,
+            field="date"
+        )
+    )
 
+    load_job = None
     try:
-        load_job.result()
-        logging.info(f"Job {load_job.job_id} completed successfully!")
+        with timed("bq_load", table=table_name) as timer:
+            timer.bytes = file_size(source_file)
+            load_job = bq_client.load_table_from_file(source_file, table, job_config=job_config, rewind=True)
+            load_result = load_job.result()
+            timer.rows = load_job.output_rows or 0
+        return load_result
+    except NotFound:
+        table_cache.invalidate(table_id_constructor)
+        raise
     except BadRequest as e:
-        error_string = ""
-        for e in load_job.errors:
-            error_string += f"ERROR: {e['message']}\n"
-        logging.error(error_string)
-        raise Exception(error_string)
+        table_cache.invalidate(table_id_constructor)
+        return load_error_string(e, load_job)
 
-    table = bq_client.get_table(table_id_constructor)
-    schema = table.schema
+def bq_load_partitions(project_id, dataset, table_name, rows_by_date, schema, load_format="json"):
+    """
+    Replaces several day partitions of table_name with one load job and one query job, instead of one
+    WRITE_TRUNCATE load job per partition (which quickly exhausts BigQuery's per-table load job quota on backfills).
+    All rows are loaded into a temporary staging table, then a single MERGE deletes the target partitions and
+    inserts the staged rows.
+    rows_by_date: {"YYYYMMDD": iterable of rows}, rows must already carry their "date" column
+    """
+    bq_client = get_bq_client(project_id)
 
-    schema_json = bq_client.schema_to_json(schema,"./temp_json_schema.json")
+    table_id_constructor = f"{project_id}.{dataset}.{table_name}"
+    table = get_or_create_partitioned_table(bq_client, table_id_constructor, schema)
+    schema = existing_column_types(schema, table)
 
-    bq_client.delete_table(table_id_constructor)
-    return "Success"
+    staging_table_id = f"{table_id_constructor}__staging_{uuid.uuid4().hex[:12]}"
+    partition_dates = sorted(rows_by_date)
+    rows = itertools.chain.from_iterable(rows_by_date[partition_date] for partition_date in partition_dates)
+    if not schema:
+        rows, schema = infer_load_schema(rows, table_name)
+    source_file, source_format = write_load_file(rows, schema, load_format, table_name)
 
-def bq_load_json_list(project_id, dataset, table_name, json_list,partition_date,schema):
-    json_list = format_list_of_dicts_for_bq(json_list)
-    bq_client = bigquery.Client(project=project_id)
+    job_config = bigquery.LoadJobConfig(
+        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
+        source_format=source_format,
+    )
+    if schema:
+        job_config.schema = schema
+    else:
+        job_config.autodetect = True
 
-    bq_dataset = bq_client.dataset(dataset)
+    load_job = None
+    try:
+        try:
+            with source_file, timed("bq_load", table=table_name) as timer:
+                timer.bytes = file_size(source_file)
+                load_job = bq_client.load_table_from_file(source_file, staging_table_id, job_config=job_config, rewind=True)
+                load_job.result()
+                timer.rows = load_job.output_rows or 0
+        except BadRequest as e:
+            return load_error_string(e, load_job)
 
+        column_names = [field.name for field in (schema or bq_client.get_table(staging_table_id).schema)]
+        columns = ", ".join(f"`{column_name}`" for column_name in column_names)
+        merge_query = f"""
+            MERGE `{table_id_constructor}` T
+            USING `{staging_table_id}` S
+            ON FALSE
+            WHEN NOT MATCHED BY SOURCE AND T.date IN UNNEST(@partition_dates) THEN DELETE
+            WHEN NOT MATCHED THEN INSERT ({columns}) VALUES ({columns})
+        """
+        query_job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter(
+                    "partition_dates",
+                    "DATE",
+                    [datetime.datetime.strptime(partition_date, "%Y%m%d").date() for partition_date in partition_dates],
+                )
+            ]
+        )
+        logging.info(f"Replacing {len(partition_dates)} partitions of {table_id_constructor} from {staging_table_id}")
+        try:
+            with timed("bq_merge", table=table_name):
+                return bq_client.query(merge_query, job_config=query_job_config).result()
+        except (NotFound, BadRequest):
+            table_cache.invalidate(table_id_constructor)
+            raise
+    finally:
+        bq_client.delete_table(staging_table_id, not_found_ok=True)
+
+def load_error_string(error, load_job=None):
+    """
+    Error messages of a rejected load as a string: the job's errors, or those of the BadRequest when BigQuery
+    rejected the job at submission, before load_job was created
+    """
+    errors = (load_job.errors if load_job is not None else None) or error.errors or [{"message": str(error)}]
+    error_string = ""
+    for e in errors:
+        error_string += f"ERROR: {e['message']}\n"
+    logging.error(error_string)
+    return error_string
+
+def get_or_create_partitioned_table(bq_client, table_id_constructor, schema):
+    table = table_cache.get(table_id_constructor)
+    if table is not None:
+        return table
 
-    table_id_constructor = f"{project_id}.{dataset}.{table_name}"
     # Check if table exists for view ID else create it
     try:
         table = bq_client.get_table(table_id_constructor)
     except NotFound:
-        logging.info(f"Table with id {table_name} not found - creating it.")
+        logging.info(f"Table with id {table_id_constructor} not found - creating it.")
         table = bigquery.Table(table_id_constructor, schema=schema)
         table.time_partitioning = bigquery.TimePartitioning(type_=bigquery.TimePartitioningType.DAY,field="date")
         logging.info(f"Table partitioned by DAY")
-        table = bq_client.create_table(table)
+        table = bq_client.create_table(table, exists_ok=True)
+    table_cache.set(table_id_constructor, table)
+    return table
 
-    table = bq_dataset.table(f"{table_name}${partition_date}")
-    # Place data in table
-    job_config = bigquery.LoadJobConfig(
-        write_disposition=bigquery.WriteDisposition.WRITE_TRUNCATE,
-        time_partitioning=bigquery.TimePartitioning(
-            type_=bigquery.TimePartitioningType.DAY,
-            field="date"
-        )
-    )
+def infer_load_schema(rows, table_name):
+    """(rows, schema inferred from their first BQ_SCHEMA_SAMPLE_ROWS rows) for a report without a known schema"""
+    rows, schema_json = infer_stream_schema(rows)
+    logging.info(f"No schema known for {table_name}, inferred {len(schema_json)} columns from its first rows")
+    return rows, [SchemaField.from_api_repr(field) for field in schema_json]
 
-    load_job = bq_client.load_table_from_json(json_list, table, job_config=job_config)
+def get_load_schema(project_id, dataset, table_name, schema):
+    """Schema to type the load file of table_name with (see existing_column_types), creating the table if needed"""
+    if not schema:
+        return schema
+    table = get_or_create_partitioned_table(get_bq_client(project_id), f"{project_id}.{dataset}.{table_name}", schema)
+    return existing_column_types(schema, table)
 
-    try:
-        return load_job.result()
-    except BadRequest as e:
-        error_string = ""
-        for e in load_job.errors:
-            error_string += f"ERROR: {e['message']}\n"
-        logging.error(error_string)
-        return error_string
-
-def format_list_of_dicts_for_bq(list_of_dicts):
-    list_to_return = []
-    for dictionary in list_of_dicts:
-        new_dict = {}
-        for k,v in dictionary.items():
-            cleaned_key = re.sub(r"[^0-9a-zA-Z]+","_",k).lower()
-            try:
-                v = float(v)
-            except:
-                v = v
-            new_dict[cleaned_key] = v
-        list_to_return.append(new_dict)
-    return list_to_return
\ No newline at end of file
+def existing_column_types(schema, table):
+    """
+    schema with the column types of the existing table where they differ, e.g. id columns of tables created
+    while the report schemas had them as FLOAT, so typed (parquet) load files still match older tables
+    """
+    if not schema:
+        return schema
+    table_types = {field.name: field.field_type for field in table.schema or []}
+    fields = [field if isinstance(field, SchemaField) else SchemaField.from_api_repr(field) for field in schema]
+    if all(table_types.get(field.name, field.field_type) == field.field_type for field in fields):
+        return schema
+    logging.info(f"Typing the load file of {table.table_id} with the column types of the existing table")
+    return [
+        SchemaField(field.name, table_types.get(field.name, field.field_type), mode=field.mode) for field in fields
+    ]
+
+def get_bq_client(project_id):
+    """Process wide BigQuery client per project, so warm instances reuse its credentials and HTTP connections"""
+    bq_client = _bq_clients.get(project_id)
+    if bq_client is None:
+        with _bq_clients_lock:
+            bq_client = _bq_clients.get(project_id)
+            if bq_client is None:
+                bq_client = bigquery.Client(project=project_id)
+                _bq_clients[project_id] = bq_client
+    return bq_client
+
+class TableCache:
+    """
+    TTL cache of table metadata (including schema) keyed by "project.dataset.table", lets warm instances skip the
+    get_table/create_table round trips before a load. Entries are invalidated when a load reports a missing table
+    or a schema mismatch.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, table_id):
+        with self._lock:
+            cached = self._tables.get(table_id)
+            if cached is None:
+                return None
+            table, cached_at = cached
+            if time.monotonic() - cached_at > self.ttl:
+                del self._tables[table_id]
+                return None
+            return table
+
+    def set(self, table_id, table):
+        with self._lock:
+            self._tables[table_id] = (table, time.monotonic())
+
+    def invalidate(self, table_id):
+        with self._lock:
+            if self._tables.pop(table_id, None) is not None:
+                logging.info(f"Invalidated cached metadata of table {table_id}")
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+_bq_clients = {}
+_bq_clients_lock = threading.Lock()
+table_cache = TableCache(ttl=config.BQ_TABLE_CACHE_TTL_SECONDS)
+
+LOAD_SOURCE_FORMATS = {"json": bigquery.SourceFormat.NEWLINE_DELIMITED_JSON, "parquet": bigquery.SourceFormat.PARQUET}
+
+def write_load_file(rows, schema, load_format, table_name):
+    """Returns (temp file positioned at 0, bigquery.SourceFormat) holding rows in load_format"""
+    if load_format == "parquet" and not schema:
+        logging.warning(f"No schema known for {table_name}, falling back to a json load")
+        load_format = "json"
+
+    if load_format not in LOAD_SOURCE_FORMATS:
+        raise Exception(f"Invalid value: load_format '{load_format}'")
+
+    # For parquet, normalizing the rows is part of serializing them
+    with timed("serialize", format=load_format, table=table_name) as timer:
+        if load_format == "parquet":
+            load_file = write_parquet_temp_file(rows, schema)
+        else:
+            load_file = write_ndjson_temp_file(timed_iter(get_row_normalizer(schema).normalize_all(rows), "normalize"))
+        timer.bytes = file_size(load_file)
+    return load_file, LOAD_SOURCE_FORMATS[load_format]
+
+def file_size(source_file):
+    """Size in bytes of a file object, its position is left unchanged"""
+    position = source_file.tell()
+    size = source_file.seek(0, 2)
+    source_file.seek(position)
+    return size
+
+def write_ndjson_temp_file(rows):
+    """
+    Writes rows as gzip compressed newline delimited json to a temp file (in memory up to 64MB, then on disk),
+    positioned at 0. Compressed because on Cloud Functions the disk is memory as well.
+    """
+    ndjson_file = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, mode="w+b")
+    write_ndjson_gzip(rows, ndjson_file)
+    ndjson_file.seek(0)
+    return ndjson_file
+
+def format_list_of_dicts_for_bq(list_of_dicts, schema=None):
+    """Casts every column by its type in schema. Without a schema anything numeric becomes a float, except ids"""
+    return list(timed_iter(get_row_normalizer(schema).normalize_all(list_of_dicts), "normalize"))
+
+def format_dict_for_bq(dictionary, schema=None):
+    return get_row_normalizer(schema).normalize(dictionary)
\ No newline at end of file
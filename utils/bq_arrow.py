@@ -0,0 +1,115 @@
+import datetime
+import logging
+import tempfile
+from typing import Iterable, Iterator, List, Sequence
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover - optional dependency, only needed for load_format="parquet"
+    pyarrow = None
+
+from utils.bq_rows import get_row_normalizer
+
+PARQUET_BATCH_ROWS = 50000
+
+
+def _arrow_type(field_type: str):
+    return {
+        "FLOAT": pyarrow.float64(),
+        "FLOAT64": pyarrow.float64(),
+        "NUMERIC": pyarrow.float64(),
+        "INTEGER": pyarrow.int64(),
+        "INT64": pyarrow.int64(),
+        "STRING": pyarrow.string(),
+        "BOOLEAN": pyarrow.bool_(),
+        "BOOL": pyarrow.bool_(),
+        "DATE": pyarrow.date32(),
+        "TIMESTAMP": pyarrow.timestamp("us", tz="UTC"),
+    }.get(field_type.upper(), pyarrow.string())
+
+
+def arrow_schema_for(schema: Sequence):
+    """Arrow schema matching a BigQuery schema (list of SchemaField or their json representation)"""
+    if pyarrow is None:
+        raise Exception("pyarrow is required for columnar BigQuery loads - pip install pyarrow")
+
+    fields = []
+    for field in schema:
+        name, field_type = (field["name"], field["type"]) if isinstance(field, dict) else (field.name, field.field_type)
+        fields.append(pyarrow.field(name, _arrow_type(field_type)))
+    return pyarrow.schema(fields)
+
+
+def iter_record_batches(rows: Iterable[dict], schema: Sequence, batch_rows: int = PARQUET_BATCH_ROWS) -> Iterator:
+    """
+    Normalizes rows with the schema's RowNormalizer and yields them as arrow RecordBatches of batch_rows rows,
+    so only one batch of python objects is alive at a time. Columns not in the schema are dropped.
+    """
+    arrow_schema = arrow_schema_for(schema)
+    names = arrow_schema.names
+    known_names = set(names)
+    normalizer = get_row_normalizer(schema)
+    columns: List[list] = [[] for _ in names]
+    unknown_columns = set()
+    count = 0
+
+    for row in normalizer.normalize_all(rows):
+        for column, name in zip(columns, names):
+            column.append(row.get(name))
+        if not known_names.issuperset(row):
+            unknown_columns.update(set(row) - known_names)
+        count += 1
+        if count == batch_rows:
+            yield _record_batch(columns, arrow_schema)
+            columns = [[] for _ in names]
+            count = 0
+    if count:
+        yield _record_batch(columns, arrow_schema)
+
+    if unknown_columns:
+        logging.warning(f"Columns not in the BigQuery schema were dropped from the columnar load: {unknown_columns}")
+
+
+def _to_date(v):
+    return datetime.date.fromisoformat(v[:10]) if isinstance(v, str) else v
+
+
+def _to_timestamp(v):
+    if not isinstance(v, str):
+        return v
+    # fromisoformat doesn't accept the "Z" suffix before python 3.11
+    timestamp = datetime.datetime.fromisoformat(v[:-1] + "+00:00" if v.endswith("Z") else v)
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
+
+
+def _record_batch(columns: List[list], arrow_schema):
+    # Converted to python dates and datetimes first: pyarrow versions before 4.0 can't cast strings to date32
+    arrays = []
+    for column, field in zip(columns, arrow_schema):
+        if pyarrow.types.is_date32(field.type):
+            column = [_to_date(v) for v in column]
+        elif pyarrow.types.is_timestamp(field.type):
+            column = [_to_timestamp(v) for v in column]
+        arrays.append(pyarrow.array(column, type=field.type))
+    return pyarrow.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+
+def write_parquet_temp_file(rows: Iterable[dict], schema: Sequence):
+    """Writes rows as a snappy compressed parquet file to a temp file (in memory up to 64MB), positioned at 0"""
+    parquet_file = tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024, mode="w+b")
+    write_parquet(rows, schema, parquet_file)
+    parquet_file.seek(0)
+    return parquet_file
+
+
+def write_parquet(rows: Iterable[dict], schema: Sequence, parquet_file) -> None:
+    """Writes rows as snappy compressed parquet to a binary file object"""
+    arrow_schema = arrow_schema_for(schema)
+    writer = pyarrow.parquet.ParquetWriter(parquet_file, arrow_schema, compression="snappy")
+    try:
+        for batch in iter_record_batches(rows, schema):
+            # ParquetWriter.write_batch is not available in the pinned pyarrow 3.0, one row group per batch either way
+            writer.write_table(pyarrow.Table.from_batches([batch], schema=arrow_schema))
+    finally:
+        writer.close()
@@ -0,0 +1,182 @@
+import gzip
+import io
+import json
+import re
+import threading
+from functools import lru_cache
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+_KEY_CLEANING_REGEX = re.compile(r"[^0-9a-zA-Z]+")
+# camelCase (campaignId) or snake_case (campaign_id) id column names, not names that merely end in "id" (keywordBid)
+_ID_KEY_REGEX = re.compile(r"(?:[a-z0-9]Id|_id)$")
+# Cleaned names of the id columns of reports_fields.json, so rows normalized already are recognized as well
+ID_COLUMNS = frozenset(("campaignid", "adgroupid", "adid", "keywordid", "targetid", "portfolioid"))
+
+# Fastest gzip level: report rows still compress several times over, for a fraction of the default level's CPU
+NDJSON_GZIP_LEVEL = 1
+
+
+@lru_cache(maxsize=4096)
+def clean_key(key: str) -> str:
+    """BigQuery safe, lower case column name. Idempotent: clean_key(clean_key(k)) == clean_key(k)"""
+    return _KEY_CLEANING_REGEX.sub("_", key).lower()
+
+
+def is_id_column(key: str) -> bool:
+    """Whether a report column (raw or cleaned name) holds integer ids"""
+    return key in ID_COLUMNS or _ID_KEY_REGEX.search(key) is not None
+
+
+def _to_float(v):
+    return v if v is None or v.__class__ is float else float(v)
+
+
+def _to_int(v):
+    if v is None or v.__class__ is int:
+        return v
+    if isinstance(v, str):
+        try:
+            # Exact for digit strings, 64 bit ids must never go through a float
+            return int(v)
+        except ValueError:
+            pass
+    number = float(v)
+    if not number.is_integer():
+        raise Exception(f"Invalid value: {v!r} in an INTEGER column")
+    return int(number)
+
+
+def _to_str(v):
+    return v if v is None or v.__class__ is str else str(v)
+
+
+def _to_bool(v):
+    if v is None or v.__class__ is bool:
+        return v
+    if isinstance(v, str):
+        return v.strip().lower() in ("true", "1", "yes")
+    return bool(v)
+
+
+def _identity(v):
+    return v
+
+
+def _guess_number(v):
+    # Column not in the schema, keep the legacy behaviour of coercing anything numeric to float
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return v
+
+
+def _guess_id(v):
+    # Id column not in the schema: integers stay exact instead of becoming floats such as 1.234e+17
+    if v.__class__ is int:
+        return v
+    if isinstance(v, str) and v.isdigit():
+        return int(v)
+    return _guess_number(v)
+
+
+def _guess_caster(key: str) -> Callable[[Any], Any]:
+    return _guess_id if is_id_column(key) else _guess_number
+
+
+CASTERS_BY_BQ_TYPE: Dict[str, Callable[[Any], Any]] = {
+    "FLOAT": _to_float,
+    "FLOAT64": _to_float,
+    "NUMERIC": _to_float,
+    "INTEGER": _to_int,
+    "INT64": _to_int,
+    "STRING": _to_str,
+    "BOOLEAN": _to_bool,
+    "BOOL": _to_bool,
+    "DATE": _identity,
+    "DATETIME": _identity,
+    "TIMESTAMP": _identity,
+}
+
+
+class RowNormalizer:
+    """
+    Formats report rows for BigQuery: cleans keys and casts each value once by the column type of the table schema
+    (INTEGER ids stay exact ints). Columns missing from the schema are coerced to float when numeric, except id
+    columns, which keep integers exact.
+    The (raw key -> cleaned key, caster) plan is compiled once per distinct key layout, which for an Amazon report
+    is once per report, so per row work is a dict comprehension. Normalizing an already normalized row is a no-op.
+    """
+
+    def __init__(self, schema: Optional[Sequence] = None):
+        self._casters = {name: CASTERS_BY_BQ_TYPE.get(field_type, _identity) for name, field_type in _fields(schema)}
+        self._plans: Dict[Tuple[str, ...], List[Tuple[str, str, Callable]]] = {}
+
+    def normalize(self, row: dict) -> dict:
+        keys = tuple(row)
+        plan = self._plans.get(keys)
+        if plan is None:
+            plan = self._compile(keys)
+        return {cleaned_key: cast(row[key]) for key, cleaned_key, cast in plan}
+
+    def normalize_all(self, rows: Iterable[dict]) -> Iterator[dict]:
+        normalize = self.normalize
+        for row in rows:
+            yield normalize(row)
+
+    def _compile(self, keys: Tuple[str, ...]) -> List[Tuple[str, str, Callable]]:
+        plan = []
+        for key in keys:
+            cleaned_key = clean_key(key)
+            plan.append((key, cleaned_key, self._casters.get(cleaned_key) or _guess_caster(key)))
+        self._plans[keys] = plan
+        return plan
+
+
+_normalizers: Dict[Tuple[Tuple[str, str], ...], RowNormalizer] = {}
+_normalizers_lock = threading.Lock()
+
+
+def get_row_normalizer(schema: Optional[Sequence] = None) -> RowNormalizer:
+    """Returns the process wide RowNormalizer for a schema (list of SchemaField or their json representation)"""
+    key = tuple(_fields(schema))
+    normalizer = _normalizers.get(key)
+    if normalizer is None:
+        with _normalizers_lock:
+            normalizer = _normalizers.setdefault(key, RowNormalizer(schema))
+    return normalizer
+
+
+def _fields(schema: Optional[Sequence]) -> Iterator[Tuple[str, str]]:
+    for field in schema or []:
+        if isinstance(field, dict):
+            yield field["name"], field["type"].upper()
+        else:
+            yield field.name, field.field_type.upper()
+
+
+def write_ndjson(rows: Iterable[dict], ndjson_file) -> None:
+    """Writes rows as newline delimited json to a binary file object"""
+    for row in rows:
+        ndjson_file.write(json.dumps(row).encode())
+        ndjson_file.write(b"\n")
+
+
+def write_ndjson_gzip(rows: Iterable[dict], binary_file) -> None:
+    """
+    Writes rows as gzip compressed newline delimited json, which BigQuery loads as is, to a binary file object.
+    The file object is left open.
+    """
+    with gzip.GzipFile(fileobj=binary_file, mode="wb", compresslevel=NDJSON_GZIP_LEVEL, mtime=0) as gzip_file:
+        # Buffered, so zlib compresses large blocks instead of every row's few bytes
+        with io.BufferedWriter(gzip_file, buffer_size=1024 * 1024) as buffered_file:
+            write_ndjson(rows, buffered_file)
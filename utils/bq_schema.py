@@ -0,0 +1,143 @@
+"""
+In-process BigQuery schema inference for report rows, in the format of reports_fields_bq_schema.json. Reports without
+a schema in reports_fields_bq_schema.json are loaded with the schema inferred from their first rows.
+
+Onboard a new report type by inferring its schema from a downloaded report, then adding the output to
+reports_fields_bq_schema.json (from repo root):
+    python -m utils.bq_schema report.json.gz > schema.json
+"""
+
+import argparse
+import itertools
+import json
+import re
+import sys
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import config
+from utils.bq_rows import clean_key, is_id_column
+
+_DATE_REGEX = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_TIMESTAMP_REGEX = re.compile(r"^\d{4}-\d{2}-\d{2}[T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?$")
+
+# Types two values of a column widen to, any other mix widens to STRING
+_WIDENINGS = {
+    frozenset(("INTEGER", "FLOAT")): "FLOAT",
+    frozenset(("DATE", "TIMESTAMP")): "TIMESTAMP",
+}
+
+# Column added by the pipeline to every report row, it partitions the tables
+DATE_FIELD = {"description": None, "mode": "NULLABLE", "name": "date", "type": "DATE"}
+
+
+def value_type(value) -> Optional[str]:
+    """BigQuery type of one json value, None for null"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "BOOLEAN"
+    if isinstance(value, int):
+        return "INTEGER"
+    if isinstance(value, float):
+        return "FLOAT"
+    if isinstance(value, str):
+        if _DATE_REGEX.match(value):
+            return "DATE"
+        if _TIMESTAMP_REGEX.match(value):
+            return "TIMESTAMP"
+    return "STRING"
+
+
+def widen(field_type: Optional[str], other_type: Optional[str]) -> Optional[str]:
+    """Narrowest type holding values of both types (None is the type of a column only seen null)"""
+    if field_type is None or field_type == other_type:
+        return other_type
+    if other_type is None:
+        return field_type
+    return _WIDENINGS.get(frozenset((field_type, other_type)), "STRING")
+
+
+class SchemaInferencer:
+    """
+    Infers the column types of report rows as they are observed, widening a column's type when its values disagree
+    (INTEGER + FLOAT -> FLOAT, DATE + TIMESTAMP -> TIMESTAMP, anything else mixed -> STRING). Columns are named
+    like RowNormalizer names them and listed in the order they were first seen.
+    Whole numbers are only kept INTEGER in id columns (see is_id_column): a metric sampled as whole numbers (clicks,
+    cost 0, keywordBid 1) can be fractional in later rows, so like the existing report schemas, other numeric columns
+    are FLOAT.
+    """
+
+    def __init__(self):
+        self._types: Dict[str, Optional[str]] = {}
+        self._id_columns = set()
+        self.rows = 0
+
+    def observe(self, row: dict) -> None:
+        types = self._types
+        for key, value in row.items():
+            name = clean_key(key)
+            if name not in types and is_id_column(key):
+                self._id_columns.add(name)
+            types[name] = widen(types.get(name), value_type(value))
+        self.rows += 1
+
+    def observe_all(self, rows: Iterable[dict], sample_rows: Optional[int] = None) -> None:
+        """Observes up to sample_rows rows of rows (all of them if None)"""
+        for row in itertools.islice(rows, sample_rows):
+            self.observe(row)
+
+    def schema_json(self) -> List[dict]:
+        """The inferred schema in the format of reports_fields_bq_schema.json (SchemaField.from_api_repr compatible)"""
+        return [
+            {"description": None, "mode": "NULLABLE", "name": name, "type": self._final_type(name, field_type)}
+            for name, field_type in self._types.items()
+        ]
+
+    def _final_type(self, name: str, field_type: Optional[str]) -> str:
+        if field_type is None:
+            # Only nulls were seen, like BigQuery's autodetect
+            return "STRING"
+        if field_type == "INTEGER" and name not in self._id_columns:
+            return "FLOAT"
+        return field_type
+
+
+def infer_schema(rows: Iterable[dict], sample_rows: Optional[int] = config.BQ_SCHEMA_SAMPLE_ROWS) -> List[dict]:
+    """Infers the json BigQuery schema of rows (e.g. a streamed report) from their first sample_rows rows"""
+    inferencer = SchemaInferencer()
+    inferencer.observe_all(rows, sample_rows)
+    return inferencer.schema_json()
+
+
+def infer_stream_schema(
+    rows: Iterable[dict], sample_rows: Optional[int] = config.BQ_SCHEMA_SAMPLE_ROWS
+) -> Tuple[Iterator[dict], List[dict]]:
+    """
+    Infers the schema of a row stream from its first sample_rows rows without consuming it: returns (rows, schema),
+    rows replaying the buffered sample before the rest of the stream
+    """
+    rows = iter(rows)
+    sample = list(itertools.islice(rows, sample_rows))
+    return itertools.chain(sample, rows), infer_schema(sample, None)
+
+
+def report_schema(rows: Iterable[dict], sample_rows: Optional[int] = config.BQ_SCHEMA_SAMPLE_ROWS) -> List[dict]:
+    """Schema of the table of a report: the date partitioning column first, then the inferred report columns"""
+    return [DATE_FIELD] + [field for field in infer_schema(rows, sample_rows) if field["name"] != "date"]
+
+
+if __name__ == "__main__":
+    from services.amz_advertising.report_stream import iter_report_rows
+
+    parser = argparse.ArgumentParser(
+        description="Infers the BigQuery schema of a gzip json report downloaded from Amazon"
+    )
+    parser.add_argument("report_file")
+    parser.add_argument("--sample-rows", type=int, default=config.BQ_SCHEMA_SAMPLE_ROWS, help="0 for all rows")
+    args = parser.parse_args()
+
+    with open(args.report_file, "rb") as report_file:
+        chunks = iter(lambda: report_file.read(config.AMZ_REPORT_DOWNLOAD_CHUNK_SIZE), b"")
+        schema = report_schema(iter_report_rows(chunks), args.sample_rows or None)
+    json.dump(schema, sys.stdout, indent=2)
+    sys.stdout.write("\n")
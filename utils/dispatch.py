@@ -0,0 +1,193 @@
+import contextvars
+import heapq
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class _FairQueue:
+    """Pending jobs of one sub key, served in priority order, with the number of jobs it was served"""
+
+    def __init__(self):
+        self.served = 0
+        self.heap: List[Tuple[Any, int]] = []  # (priority, job index)
+
+    def best_priority(self):
+        return self.heap[0][0]
+
+
+class _KeyQueues:
+    """Sub key queues of one key, with the key's running jobs and virtual time of weighted fair queuing"""
+
+    def __init__(self, weight: float):
+        self.weight = weight
+        self.virtual_time = 0.0
+        self.running = 0
+        self.sub_queues: Dict[Hashable, _FairQueue] = {}
+
+    def pending_sub_queues(self) -> List[_FairQueue]:
+        return [sub_queue for sub_queue in self.sub_queues.values() if sub_queue.heap]
+
+
+class FairScheduler:
+    """
+    Hands out jobs grouped by key (e.g. the Amazon region) and sub key (e.g. the marketplace/profile) to worker
+    threads:
+     - a key never has more than per_key_limit jobs running, and a worker only takes a job of a key with a free slot
+       (it never holds a thread waiting on a saturated key), so every key's budget is used in parallel
+     - keys with a free slot share the workers by weighted fair queuing (start time fair queuing): the key that
+       received the least service relative to its weight goes first, so a key of weight 2 is handed twice as many
+       jobs as a key of weight 1 while both have jobs pending. Ties go to the key with the most urgent job
+     - within a key, jobs are handed out in priority order (lowest first, e.g. the most recent report date), and
+       sub keys with jobs of the same priority take turns, so one marketplace can't hold back the others
+    """
+
+    def __init__(
+        self,
+        jobs: Iterable[Any],
+        key_func: Callable[[Any], Hashable],
+        per_key_limit: int,
+        sub_key_func: Optional[Callable[[Any], Hashable]] = None,
+        priority_func: Optional[Callable[[Any], Any]] = None,
+        weights: Optional[Dict[Hashable, float]] = None,
+    ):
+        self.jobs = list(jobs)
+        self.per_key_limit = per_key_limit
+        self._queues: Dict[Hashable, _KeyQueues] = {}
+        self._pending = len(self.jobs)
+        self._condition = threading.Condition()
+
+        for index, job in enumerate(self.jobs):
+            key = key_func(job)
+            queue = self._queues.get(key)
+            if queue is None:
+                queue = self._queues[key] = _KeyQueues((weights or {}).get(key, 1.0))
+            sub_key = sub_key_func(job) if sub_key_func is not None else None
+            sub_queue = queue.sub_queues.get(sub_key)
+            if sub_queue is None:
+                sub_queue = queue.sub_queues[sub_key] = _FairQueue()
+            priority = priority_func(job) if priority_func is not None else 0
+            # Index breaks priority ties in submission order
+            heapq.heappush(sub_queue.heap, (priority, index))
+
+    def take(self) -> Optional[Tuple[Hashable, int]]:
+        """
+        Blocks until a job can run, returns (key, job index), or None once every job was handed out.
+        The caller must call done(key) when the job finished.
+        """
+        with self._condition:
+            while True:
+                if self._pending == 0:
+                    return None
+                taken = self._take_next()
+                if taken is not None:
+                    self._pending -= 1
+                    return taken
+                self._condition.wait()
+
+    def done(self, key: Hashable) -> None:
+        with self._condition:
+            self._queues[key].running -= 1
+            self._condition.notify_all()
+
+    def _take_next(self) -> Optional[Tuple[Hashable, int]]:
+        candidates = []
+        for key, queue in self._queues.items():
+            if queue.running >= self.per_key_limit:
+                continue
+            sub_queues = queue.pending_sub_queues()
+            if sub_queues:
+                best_priority = min(sub_queue.best_priority() for sub_queue in sub_queues)
+                candidates.append(((queue.virtual_time, best_priority), key, queue, sub_queues))
+        if not candidates:
+            return None
+        _, key, queue, sub_queues = min(candidates, key=lambda candidate: candidate[0])
+        sub_queue = min(sub_queues, key=lambda sub_queue: (sub_queue.best_priority(), sub_queue.served))
+        _, index = heapq.heappop(sub_queue.heap)
+        queue.running += 1
+        queue.virtual_time += 1 / queue.weight
+        sub_queue.served += 1
+        return key, index
+
+
+def run_concurrently(
+    jobs: Iterable[Any],
+    func: Callable[[Any], Any],
+    key_func: Callable[[Any], Hashable],
+    max_workers: int,
+    per_key_limit: int,
+    sub_key_func: Optional[Callable[[Any], Hashable]] = None,
+    priority_func: Optional[Callable[[Any], Any]] = None,
+    weights: Optional[Dict[Hashable, float]] = None,
+    on_done: Optional[Callable[[Any, Any, Optional[Exception]], None]] = None,
+) -> List[Tuple[Any, Any, Exception]]:
+    """
+    Runs func(job) for every job on max_workers threads, scheduled by a FairScheduler: at most per_key_limit jobs
+    with the same key_func(job) (e.g. the Amazon region) run at the same time, keys share the workers by weighted fair
+    queuing (weights per key, 1 if not listed), and within a key jobs with a lower priority_func(job) run first.
+    on_done(job, result, exception) is called on the worker thread as soon as each job finished, after its key's slot
+    was released (e.g. to dispatch its result right away), exceptions it raises are logged.
+    :return: list of (job, result, exception) tuples in the same order as jobs, exception is None on success
+    """
+    scheduler = FairScheduler(jobs, key_func, per_key_limit, sub_key_func, priority_func, weights)
+    outcomes: Dict[int, Tuple[Any, Exception]] = {}
+
+    def work():
+        while True:
+            taken = scheduler.take()
+            if taken is None:
+                return
+            key, index = taken
+            try:
+                outcomes[index] = (func(scheduler.jobs[index]), None)
+            except Exception as e:
+                logging.exception(e)
+                outcomes[index] = (None, e)
+            finally:
+                scheduler.done(key)
+            if on_done is not None:
+                try:
+                    on_done(scheduler.jobs[index], *outcomes[index])
+                except Exception as e:
+                    logging.exception(e)
+
+    workers = min(max_workers, len(scheduler.jobs))
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        # Workers run with a copy of the caller's context (e.g. its trace id)
+        futures = [executor.submit(contextvars.copy_context().run, work) for _ in range(workers)]
+        for future in futures:
+            future.result()
+    return [(job, *outcomes[index]) for index, job in enumerate(scheduler.jobs)]
+
+
+class StreamBatcher:
+    """
+    Groups items arriving from many threads into batches of up to batch_size items with the same key_func(item),
+    handing each batch to flush(batches) as soon as it is full, so work downstream of a batch starts before the
+    whole stream was seen. close() flushes the incomplete batches left at the end of the stream in one call.
+    flush runs on the thread that completed the batch, outside of the batcher's lock.
+    """
+
+    def __init__(self, key_func: Callable[[Any], Hashable], batch_size: int, flush: Callable[[List[List[Any]]], None]):
+        self._key_func = key_func
+        self._batch_size = max(batch_size, 1)
+        self._flush = flush
+        self._batches: Dict[Hashable, List[Any]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, item: Any) -> None:
+        key = self._key_func(item)
+        with self._lock:
+            batch = self._batches.setdefault(key, [])
+            batch.append(item)
+            if len(batch) < self._batch_size:
+                return
+            del self._batches[key]
+        self._flush([batch])
+
+    def close(self) -> None:
+        with self._lock:
+            batches, self._batches = list(self._batches.values()), {}
+        if batches:
+            self._flush(batches)
@@ -0,0 +1,276 @@
+import abc
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Iterable, NamedTuple, Optional, Tuple
+
+from google.cloud import bigquery
+
+import config
+from utils.bq import get_bq_client
+
+CREATED = "CREATED"
+LOADED = "LOADED"
+FAILED = "FAILED"
+
+
+class LedgerKey(NamedTuple):
+    """One BigQuery partition of one report table, report_date as YYYYMMDD"""
+
+    account_id: str
+    country_code: str
+    ad_type: str
+    record_type: str
+    variant: str  # tactic or creativeType, "" if neither
+    report_date: str
+
+    @classmethod
+    def for_report(cls, account_id, country_code, ad_type, record_type, tactic, creativeType, report_date):
+        return cls(account_id, country_code, ad_type, record_type, tactic or creativeType or "", report_date)
+
+
+class LedgerEntry(NamedTuple):
+    key: LedgerKey
+    report_id: Optional[str]
+    status: str
+    row_count: Optional[int]
+    updated_at: float
+
+
+# (ad_type, record_type, country_code) -> (mean, deviation) of report generation seconds, see ReportReadinessScheduler
+ReadinessStats = Dict[Tuple[str, str, str], Tuple[float, float]]
+
+
+class LoadLedger(abc.ABC):
+    """
+    Records what happened to each report partition across runs, so the dispatcher can skip partitions that were
+    already loaded, and the report generation times learned by the report tasks, so the dispatcher can schedule
+    new tasks for when their reports are expected to be ready. Backends implement get_many, record, get_readiness
+    and record_readiness.
+    """
+
+    @abc.abstractmethod
+    def get_many(self, keys: Iterable[LedgerKey]) -> Dict[LedgerKey, LedgerEntry]:
+        """Latest entry of each key, keys never recorded are left out"""
+
+    @abc.abstractmethod
+    def record(self, entries: Iterable[LedgerEntry]) -> None:
+        """Records entries, replacing the previous entry of their keys"""
+
+    @abc.abstractmethod
+    def get_readiness(self) -> ReadinessStats:
+        """Latest generation time statistics of each report kind"""
+
+    @abc.abstractmethod
+    def record_readiness(self, stats: ReadinessStats) -> None:
+        """Records generation time statistics, replacing the previous statistics of their report kinds"""
+
+    def record_status(self, keys_and_report_ids, status: str, row_counts: Optional[Dict[LedgerKey, int]] = None):
+        now = time.time()
+        self.record(
+            LedgerEntry(key, report_id, status, (row_counts or {}).get(key), now)
+            for key, report_id in keys_and_report_ids
+        )
+
+
+class SQLiteLoadLedger(LoadLedger):
+    """Ledger in a local SQLite file (or ":memory:"), for local runs and tests"""
+
+    def __init__(self, path: str):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS load_ledger (
+                    account_id TEXT, country_code TEXT, ad_type TEXT, record_type TEXT, variant TEXT,
+                    report_date TEXT, report_id TEXT, status TEXT, row_count INTEGER, updated_at REAL,
+                    PRIMARY KEY (account_id, country_code, ad_type, record_type, variant, report_date)
+                )
+                """
+            )
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS report_readiness (
+                    ad_type TEXT, record_type TEXT, country_code TEXT, mean REAL, deviation REAL, updated_at REAL,
+                    PRIMARY KEY (ad_type, record_type, country_code)
+                )
+                """
+            )
+
+    def get_many(self, keys: Iterable[LedgerKey]) -> Dict[LedgerKey, LedgerEntry]:
+        entries = {}
+        with self._lock:
+            for key in keys:
+                row = self._connection.execute(
+                    "SELECT report_id, status, row_count, updated_at FROM load_ledger WHERE account_id = ? AND "
+                    "country_code = ? AND ad_type = ? AND record_type = ? AND variant = ? AND report_date = ?",
+                    tuple(key),
+                ).fetchone()
+                if row is not None:
+                    entries[key] = LedgerEntry(key, *row)
+        return entries
+
+    def record(self, entries: Iterable[LedgerEntry]) -> None:
+        rows = [(*entry.key, entry.report_id, entry.status, entry.row_count, entry.updated_at) for entry in entries]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO load_ledger VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def get_readiness(self) -> ReadinessStats:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT ad_type, record_type, country_code, mean, deviation FROM report_readiness"
+            ).fetchall()
+        return {tuple(row[:3]): tuple(row[3:]) for row in rows}
+
+    def record_readiness(self, stats: ReadinessStats) -> None:
+        now = time.time()
+        rows = [(*key, mean, deviation, now) for key, (mean, deviation) in stats.items()]
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO report_readiness VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+class BigQueryLoadLedger(LoadLedger):
+    """
+    Append-only ledger table in BigQuery, next to the report tables, and its "_readiness" table of generation time
+    statistics. The latest row per key wins, so recording is a streaming insert and never a DML statement.
+    """
+
+    SCHEMA = [
+        ("account_id", "STRING"),
+        ("country_code", "STRING"),
+        ("ad_type", "STRING"),
+        ("record_type", "STRING"),
+        ("variant", "STRING"),
+        ("report_date", "STRING"),
+        ("report_id", "STRING"),
+        ("status", "STRING"),
+        ("row_count", "INTEGER"),
+        ("updated_at", "FLOAT"),
+    ]
+
+    READINESS_SCHEMA = [
+        ("ad_type", "STRING"),
+        ("record_type", "STRING"),
+        ("country_code", "STRING"),
+        ("mean", "FLOAT"),
+        ("deviation", "FLOAT"),
+        ("updated_at", "FLOAT"),
+    ]
+
+    def __init__(self, project_id: str, table_id: str):
+        self._bq_client = get_bq_client(project_id)
+        self._table_id = table_id
+        self._readiness_table_id = f"{table_id}_readiness"
+        for schema_table_id, schema in ((table_id, self.SCHEMA), (self._readiness_table_id, self.READINESS_SCHEMA)):
+            self._bq_client.create_table(
+                bigquery.Table(schema_table_id, schema=[bigquery.SchemaField(name, type_) for name, type_ in schema]),
+                exists_ok=True,
+            )
+
+    def get_many(self, keys: Iterable[LedgerKey]) -> Dict[LedgerKey, LedgerEntry]:
+        keys = set(keys)
+        if not keys:
+            return {}
+        query = f"""
+            SELECT * FROM `{self._table_id}`
+            WHERE report_date IN UNNEST(@report_dates)
+            QUALIFY ROW_NUMBER() OVER (
+                PARTITION BY account_id, country_code, ad_type, record_type, variant, report_date
+                ORDER BY updated_at DESC
+            ) = 1
+        """
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ArrayQueryParameter("report_dates", "STRING", sorted({key.report_date for key in keys}))
+            ]
+        )
+        entries = {}
+        for row in self._bq_client.query(query, job_config=job_config).result():
+            key = LedgerKey(*(row[name] for name in LedgerKey._fields))
+            if key in keys:
+                entries[key] = LedgerEntry(key, row["report_id"], row["status"], row["row_count"], row["updated_at"])
+        return entries
+
+    def record(self, entries: Iterable[LedgerEntry]) -> None:
+        rows = [
+            dict(
+                entry.key._asdict(),
+                report_id=entry.report_id,
+                status=entry.status,
+                row_count=entry.row_count,
+                updated_at=entry.updated_at,
+            )
+            for entry in entries
+        ]
+        if not rows:
+            return
+        errors = self._bq_client.insert_rows_json(self._table_id, rows)
+        if errors:
+            logging.error(f"Could not record {len(rows)} entries in the load ledger {self._table_id}: {errors}")
+
+    def get_readiness(self) -> ReadinessStats:
+        query = f"""
+            SELECT * FROM `{self._readiness_table_id}`
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY ad_type, record_type, country_code ORDER BY updated_at DESC) = 1
+        """
+        return {
+            (row["ad_type"], row["record_type"], row["country_code"]): (row["mean"], row["deviation"])
+            for row in self._bq_client.query(query).result()
+        }
+
+    def record_readiness(self, stats: ReadinessStats) -> None:
+        now = time.time()
+        rows = [
+            {
+                "ad_type": ad_type,
+                "record_type": record_type,
+                "country_code": country_code,
+                "mean": mean,
+                "deviation": deviation,
+                "updated_at": now,
+            }
+            for (ad_type, record_type, country_code), (mean, deviation) in stats.items()
+        ]
+        if not rows:
+            return
+        errors = self._bq_client.insert_rows_json(self._readiness_table_id, rows)
+        if errors:
+            logging.error(f"Could not record report generation times in {self._readiness_table_id}: {errors}")
+
+
+def is_in_flight(entry: Optional[LedgerEntry], now: float, ttl: float) -> bool:
+    """
+    Whether a partition's report was created less than ttl seconds ago and is not loaded yet (e.g. by an overlapping
+    run), creating it again would only duplicate the report and its load
+    """
+    return entry is not None and entry.status == CREATED and now - entry.updated_at < ttl
+
+
+_ledgers: Dict[str, LoadLedger] = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_load_ledger(target_project: str, target_dataset: str) -> Optional[LoadLedger]:
+    """The configured ledger (LEDGER_BACKEND "sqlite" or "bigquery"), None if ledger tracking is disabled"""
+    if config.LEDGER_BACKEND == "sqlite":
+        cache_key = config.LEDGER_SQLITE_PATH
+    elif config.LEDGER_BACKEND == "bigquery":
+        cache_key = f"{target_project}.{target_dataset}.{config.LEDGER_BQ_TABLE}"
+    elif not config.LEDGER_BACKEND:
+        return None
+    else:
+        raise Exception(f"Invalid value: LEDGER_BACKEND '{config.LEDGER_BACKEND}'")
+
+    with _ledgers_lock:
+        ledger = _ledgers.get(cache_key)
+        if ledger is None:
+            if config.LEDGER_BACKEND == "sqlite":
+                ledger = SQLiteLoadLedger(config.LEDGER_SQLITE_PATH)
+            else:
+                ledger = BigQueryLoadLedger(target_project, cache_key)
+            _ledgers[cache_key] = ledger
+    return ledger
@@ -0,0 +1,273 @@
+import contextvars
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from flask import has_request_context, request
+
+import config
+from pd_utils.logging_utils import get_request_id
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+_trace_id = contextvars.ContextVar("trace_id", default=None)
+_local = threading.local()
+
+
+class MetricsRegistry:
+    """
+    Process wide counters and summaries (count and sum) keyed by metric name and labels, rendered in the OpenMetrics
+    text format. Labels should have few distinct values (stage, endpoint, status, table), never ids.
+    """
+
+    def __init__(self):
+        self._types: Dict[str, str] = {}
+        self._values: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        self._add(name, "counter", labels, value, 0)
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        self._add(name, "summary", labels, value, 1)
+
+    def render(self) -> str:
+        with self._lock:
+            values = sorted(self._values.items())
+            types = dict(self._types)
+        lines = []
+        for name in sorted(types):
+            lines.append(f"# TYPE {name} {types[name]}")
+            for (value_name, labels), (total, count) in values:
+                if value_name != name:
+                    continue
+                label_str = "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}" if labels else ""
+                if types[name] == "counter":
+                    lines.append(f"{name}_total{label_str} {total:g}")
+                else:
+                    lines.append(f"{name}_count{label_str} {count:g}")
+                    lines.append(f"{name}_sum{label_str} {total:g}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def get(self, name: str, **labels) -> Tuple[float, float]:
+        """(sum, count) of a metric, (0, 0) if it was never recorded"""
+        with self._lock:
+            return tuple(self._values.get((name, _label_key(labels)), (0, 0)))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._types.clear()
+            self._values.clear()
+
+    def _add(self, name, metric_type, labels, value, count) -> None:
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._types.setdefault(name, metric_type)
+            totals = self._values.setdefault(key, [0.0, 0])
+            totals[0] += value
+            totals[1] += count
+
+
+def _label_key(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+metrics = MetricsRegistry()
+
+
+def get_trace_id() -> Optional[str]:
+    """Trace id of the current task: set by trace_context, else the Cloud Tasks / Cloud Trace header of the request"""
+    trace_id = _trace_id.get()
+    if trace_id is None and has_request_context():
+        trace_id = get_request_id(request=request)
+    return trace_id
+
+
+def traced(handler: Callable) -> Callable:
+    """Decorates an HTTP function so everything it records, on any thread it starts, is tagged with its trace id"""
+
+    @functools.wraps(handler)
+    def traced_handler(*args, **kwargs):
+        with trace_context(get_trace_id()):
+            return handler(*args, **kwargs)
+
+    return traced_handler
+
+
+@contextmanager
+def trace_context(trace_id: Optional[str]):
+    """Tags the stages recorded in this context (and threads started with a copy of it) with trace_id"""
+    token = _trace_id.set(trace_id)
+    try:
+        yield
+    finally:
+        _trace_id.reset(token)
+
+
+class StageTimer:
+    """
+    Wall time of one pipeline stage. Timers started while another one runs on the same thread (e.g. the download
+    iterator pulled by the decompress iterator) are nested: `seconds` is the exclusive time of the stage itself,
+    `total_seconds` includes the nested stages. Stages write bytes, rows and any other field to add to their log event.
+    """
+
+    def __init__(self, stage: str, level: int = logging.INFO, **labels):
+        self.stage = stage
+        self.level = level
+        self.labels = labels
+        self.fields = {}
+        self.bytes = 0
+        self.rows = 0
+        self.total_seconds = 0.0
+        self.nested_seconds = 0.0
+
+    @property
+    def seconds(self) -> float:
+        return self.total_seconds - self.nested_seconds
+
+    def run(self, func: Callable, *args, **kwargs):
+        """Calls func, counting the time towards this stage"""
+        stack = _stack()
+        parent = stack[-1] if stack else None
+        stack.append(self)
+        started_at = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started_at
+            stack.pop()
+            self.total_seconds += elapsed
+            if parent is not None:
+                parent.nested_seconds += elapsed
+
+    def finish(self) -> None:
+        """Records the stage in the registry, the enclosing breakdowns and the structured log"""
+        labels = dict(self.labels, stage=self.stage)
+        metrics.observe("amz_ads_stage_seconds", self.seconds, **labels)
+        if self.bytes:
+            metrics.inc("amz_ads_stage_bytes", self.bytes, **labels)
+        if self.rows:
+            metrics.inc("amz_ads_stage_rows", self.rows, **labels)
+        for breakdown in getattr(_local, "breakdowns", ()):
+            breakdown[self.stage] = breakdown.get(self.stage, 0.0) + self.seconds
+        log_event(
+            self.stage,
+            level=self.level,
+            seconds=round(self.seconds, 4),
+            bytes=self.bytes or None,
+            rows=self.rows or None,
+            **self.labels,
+            **self.fields,
+        )
+
+
+def _stack() -> List[StageTimer]:
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+@contextmanager
+def timed(stage: str, level: int = logging.INFO, **labels) -> Iterator[StageTimer]:
+    """Times the block as one stage, the yielded StageTimer takes bytes, rows and extra log fields"""
+    timer = StageTimer(stage, level, **labels)
+    stack = _stack()
+    parent = stack[-1] if stack else None
+    stack.append(timer)
+    started_at = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        elapsed = time.perf_counter() - started_at
+        stack.pop()
+        timer.total_seconds += elapsed
+        if parent is not None:
+            parent.nested_seconds += elapsed
+        timer.finish()
+
+
+def timed_iter(iterable: Iterable, stage: str, measure: Optional[Callable] = None, **labels) -> Iterator:
+    """
+    Passes the items of iterable through, timing the work done to produce them as one stage. Items are counted as
+    rows, or as bytes with measure (e.g. len for byte chunks). Recorded once the iterable is exhausted or closed.
+    """
+    timer = StageTimer(stage, **labels)
+    iterator = iter(iterable)
+    try:
+        while True:
+            try:
+                item = timer.run(next, iterator)
+            except StopIteration:
+                return
+            if measure is None:
+                timer.rows += 1
+            else:
+                timer.bytes += measure(item)
+            yield item
+    finally:
+        timer.finish()
+
+
+@contextmanager
+def breakdown(name: str, **fields) -> Iterator[dict]:
+    """
+    Logs one event with the exclusive seconds of every stage that finished on this thread inside the block, the
+    yielded fields dict takes more fields to log (e.g. ids only known inside the block)
+    """
+    stages = {}
+    breakdowns = getattr(_local, "breakdowns", None)
+    if breakdowns is None:
+        breakdowns = _local.breakdowns = []
+    breakdowns.append(stages)
+    started_at = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        breakdowns.remove(stages)
+        log_event(
+            name,
+            seconds=round(time.perf_counter() - started_at, 4),
+            stages={stage: round(seconds, 4) for stage, seconds in stages.items()},
+            **fields,
+        )
+
+
+def log_event(event: str, level: int = logging.INFO, **fields) -> None:
+    """Structured log line 'metrics {json}' tagged with the trace id, fields that are None are left out"""
+    if not config.METRICS_LOG_EVENTS:
+        return
+    payload = {"event": event, "trace": get_trace_id()}
+    payload.update((k, v) for k, v in fields.items() if v is not None)
+    logging.log(level, f"metrics {json.dumps(payload, default=str)}")
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int) -> ThreadingHTTPServer:
+    """Serves the registry in the OpenMetrics format on port (any path) from a daemon thread"""
+    server = ThreadingHTTPServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on port {port}")
+    return server
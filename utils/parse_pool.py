@@ -0,0 +1,221 @@
+import atexit
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+import config
+from services.amz_advertising.report_stream import iter_report_rows
+from utils.bq_arrow import write_parquet
+from utils.bq_rows import get_row_normalizer, write_ndjson_gzip
+
+# Slot numbers of the control messages sent after the chunks of a report
+_END = -1
+_ABORT = -2
+
+# Per process state of the parse workers, set by _init_worker
+_lanes = None
+
+
+class ParsedReport(NamedTuple):
+    """A report parsed into a load file on local disk, the caller removes it (discard) once it is loaded"""
+
+    path: str
+    load_format: str  # "json" (newline delimited) or "parquet"
+    row_count: int
+
+    def discard(self) -> None:
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class _Lane(NamedTuple):
+    """
+    The shared buffer of one report being parsed: `slots` chunk sized slots of shared memory, a queue of the slots
+    the reader may fill and a queue of the filled ones (parse_id, slot, length) the parse worker consumes.
+    """
+
+    shm: shared_memory.SharedMemory
+    free: multiprocessing.Queue
+    filled: multiprocessing.Queue
+
+
+class ReportParsePool:
+    """
+    Parses reports on `processes` worker processes while the calling threads keep doing the network I/O: the gzip
+    chunks of a report are copied into a lane of shared memory slots as they are downloaded, and a worker process
+    decompresses, parses, adds the date column, normalizes and writes them to a load file. Parsing is CPU bound and
+    holds the GIL, so on multi vCPU instances this is what lets concurrent reports (worker jobs, collected reports)
+    use more than one core. There is one lane per process, callers beyond that wait for a free lane.
+    """
+
+    def __init__(self, processes: int, chunk_size: int, slots: int):
+        self.chunk_size = chunk_size
+        self._context = multiprocessing.get_context("forkserver" if os.name == "posix" else "spawn")
+        self._lanes: List[_Lane] = []
+        for _ in range(processes):
+            free = self._context.Queue()
+            for slot in range(slots):
+                free.put(slot)
+            shm = shared_memory.SharedMemory(create=True, size=chunk_size * slots)
+            self._lanes.append(_Lane(shm, free, self._context.Queue()))
+        self._free_lanes = queue.Queue()
+        for lane_id in range(processes):
+            self._free_lanes.put(lane_id)
+        self._parse_ids = iter(range(1, 2 ** 62))
+        self._parse_ids_lock = threading.Lock()
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=self._context,
+            initializer=_init_worker,
+            initargs=([(lane.shm.name, lane.free, lane.filled) for lane in self._lanes],),
+        )
+
+    def parse(
+        self,
+        chunks: Iterable[bytes],
+        bq_schema: Optional[Sequence],
+        date: str,
+        load_format: str,
+        timeout: float = config.AMZ_HTTP_READ_TIMEOUT,
+    ) -> ParsedReport:
+        """
+        Streams the gzip chunks of a json array report to a parse worker and returns the load file it wrote.
+        date: value of the date column added to every row (YYYY-MM-DD)
+        timeout: seconds the worker waits for the next chunk before giving up
+        """
+        bq_schema = [field if isinstance(field, dict) else field.to_api_repr() for field in bq_schema or []]
+        lane_id = self._free_lanes.get()
+        lane = self._lanes[lane_id]
+        with self._parse_ids_lock:
+            parse_id = next(self._parse_ids)
+        try:
+            future = self._executor.submit(
+                _parse_lane, lane_id, parse_id, self.chunk_size, bq_schema, date, load_format, timeout
+            )
+            try:
+                for chunk in chunks:
+                    view = memoryview(chunk)
+                    for start in range(0, len(view), self.chunk_size):
+                        piece = view[start : start + self.chunk_size]
+                        slot = self._get_free_slot(lane, future)
+                        offset = slot * self.chunk_size
+                        lane.shm.buf[offset : offset + len(piece)] = piece
+                        lane.filled.put((parse_id, slot, len(piece)))
+            except BaseException:
+                lane.filled.put((parse_id, _ABORT, 0))
+                raise
+            lane.filled.put((parse_id, _END, 0))
+            return future.result()
+        finally:
+            self._free_lanes.put(lane_id)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=True)
+        for lane in self._lanes:
+            lane.shm.close()
+            lane.shm.unlink()
+        self._lanes = []
+
+    @staticmethod
+    def _get_free_slot(lane: _Lane, future) -> int:
+        while True:
+            try:
+                return lane.free.get(timeout=1)
+            except queue.Empty:
+                if future.done():
+                    # The worker stopped reading before the end of the report, raise its error
+                    future.result()
+                    raise Exception("Report parse worker stopped before the end of the report")
+
+
+def _init_worker(lanes) -> None:
+    global _lanes
+    _lanes = [(shared_memory.SharedMemory(name=name), free, filled) for name, free, filled in lanes]
+
+
+def _iter_lane_chunks(lane_id: int, parse_id: int, chunk_size: int, timeout: float, ended: list) -> Iterator[bytes]:
+    """Yields the chunks of parse_id from the lane, ended[0] is set once nothing more will come for it"""
+    shm, free, filled = _lanes[lane_id]
+    while True:
+        try:
+            message_parse_id, slot, length = filled.get(timeout=timeout)
+        except queue.Empty:
+            ended[0] = True
+            raise Exception(f"No report chunk received for {timeout:.0f}s")
+        if slot < 0:
+            if message_parse_id != parse_id:
+                continue  # Left behind by an earlier parse of this lane that failed
+            ended[0] = True
+            if slot == _ABORT:
+                raise Exception("Report download aborted")
+            return
+        if message_parse_id == parse_id:
+            offset = slot * chunk_size
+            chunk = bytes(shm.buf[offset : offset + length])
+        else:
+            chunk = None
+        free.put(slot)
+        if chunk is not None:
+            yield chunk
+
+
+def _parse_lane(lane_id, parse_id, chunk_size, bq_schema, date, load_format, timeout) -> ParsedReport:
+    if load_format == "parquet" and not bq_schema:
+        logging.warning("No schema known for the report, falling back to a json load")
+        load_format = "json"
+
+    row_count = 0
+    ended = [False]
+
+    def rows():
+        nonlocal row_count
+        for row in iter_report_rows(_iter_lane_chunks(lane_id, parse_id, chunk_size, timeout, ended)):
+            row_count += 1
+            row["date"] = date
+            yield row
+
+    fd, path = tempfile.mkstemp(prefix="amz_ads_load_", suffix=".parquet" if load_format == "parquet" else ".ndjson.gz")
+    try:
+        with os.fdopen(fd, "wb") as load_file:
+            if load_format == "parquet":
+                write_parquet(rows(), bq_schema, load_file)
+            elif load_format == "json":
+                write_ndjson_gzip(get_row_normalizer(bq_schema).normalize_all(rows()), load_file)
+            else:
+                raise Exception(f"Invalid value: load_format '{load_format}'")
+    except BaseException:
+        os.remove(path)
+        if not ended[0]:
+            # Consume what is left of this report so its slots go back to the reader
+            for _ in _iter_lane_chunks(lane_id, parse_id, chunk_size, timeout, ended):
+                pass
+        raise
+    return ParsedReport(path, load_format, row_count)
+
+
+_report_parse_pool = None
+_report_parse_pool_lock = threading.Lock()
+
+
+def get_report_parse_pool() -> Optional[ReportParsePool]:
+    """The process wide ReportParsePool, None if REPORT_PARSE_PROCESSES is 0 (reports are parsed in-thread)"""
+    global _report_parse_pool
+    if config.REPORT_PARSE_PROCESSES <= 0:
+        return None
+    if _report_parse_pool is None:
+        with _report_parse_pool_lock:
+            if _report_parse_pool is None:
+                _report_parse_pool = ReportParsePool(
+                    config.REPORT_PARSE_PROCESSES, config.AMZ_REPORT_DOWNLOAD_CHUNK_SIZE, config.REPORT_PARSE_SLOTS
+                )
+                atexit.register(_report_parse_pool.close)
+                logging.info(f"Started {config.REPORT_PARSE_PROCESSES} report parse processes")
+    return _report_parse_pool
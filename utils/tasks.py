@@ -0,0 +1,88 @@
+import datetime
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional
+
+from google.api_core import exceptions
+from google.cloud import tasks_v2
+from google.protobuf import duration_pb2, timestamp_pb2
+
+import config
+
+_tasks_client = None
+_tasks_client_lock = threading.Lock()
+
+
+class TaskOutcome(NamedTuple):
+    name: str
+    created: bool
+    already_existed: bool
+    error: Optional[Exception]
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def get_tasks_client() -> tasks_v2.CloudTasksClient:
+    """Process wide CloudTasksClient, its gRPC channel is thread safe and shared by all create_task calls"""
+    global _tasks_client
+    if _tasks_client is None:
+        with _tasks_client_lock:
+            if _tasks_client is None:
+                _tasks_client = tasks_v2.CloudTasksClient()
+    return _tasks_client
+
+
+def build_http_task(url, service_account, name, dispatch_deadline, task_config, delay=None) -> dict:
+    """Task POSTing task_config as json to url with an OIDC token, optionally scheduled delay seconds from now"""
+    dispatch_deadline_duration = duration_pb2.Duration()
+    dispatch_deadline_duration.seconds = dispatch_deadline
+
+    task = {
+        "http_request": {  # Specify the type of request.
+            "http_method": tasks_v2.HttpMethod.POST,
+            "url": url,
+            "headers": {"Content-Type": "application/json"},
+            "oidc_token": {"service_account_email": service_account},
+            "body": json.dumps(task_config).encode(),
+        },
+        "name": name,
+        "dispatch_deadline": dispatch_deadline_duration,
+    }
+
+    if delay is not None:
+        schedule_time = timestamp_pb2.Timestamp()
+        schedule_time.FromDatetime(datetime.datetime.utcnow() + datetime.timedelta(seconds=delay))
+        task["schedule_time"] = schedule_time
+
+    return task
+
+
+def create_tasks(tasks_parent: str, tasks: List[dict], max_in_flight: int = None) -> List[TaskOutcome]:
+    """
+    Creates tasks in the queue with up to max_in_flight concurrent create_task RPCs on the shared client.
+    A task whose name already exists counts as created (already_existed=True), so re-running a dispatch is
+    idempotent. Never raises for a single task, the outcome of each task is returned in the same order as tasks.
+    """
+    client = get_tasks_client()
+
+    def create(task):
+        try:
+            response = client.create_task(parent=tasks_parent, task=task)
+            logging.info(f"Created task {response.name}")
+            return TaskOutcome(task.get("name"), True, False, None)
+        except exceptions.AlreadyExists:
+            logging.info(f"Task already exists {task.get('name')}")
+            return TaskOutcome(task.get("name"), True, True, None)
+        except Exception as e:
+            logging.exception(f"Error while creating task: {task.get('name')} - {str(e)}")
+            return TaskOutcome(task.get("name"), False, False, e)
+
+    if len(tasks) <= 1:
+        return [create(task) for task in tasks]
+
+    with ThreadPoolExecutor(max_workers=min(max_in_flight or config.TASKS_MAX_IN_FLIGHT, len(tasks))) as executor:
+        return list(executor.map(create, tasks))
@@ -0,0 +1,175 @@
+import contextvars
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, NamedTuple, Optional
+
+try:
+    from google.cloud import pubsub_v1
+except ImportError:  # pragma: no cover - optional dependency, only needed for the Pub/Sub job queue
+    pubsub_v1 = None
+
+_publisher = None
+_publisher_lock = threading.Lock()
+
+
+class Job(NamedTuple):
+    payload: dict
+    ack: Callable[[], None]
+    nack: Callable[[], None]
+
+
+class LocalJobQueue:
+    """In memory job queue, for batches of jobs posted to the worker HTTP target, local runs and tests"""
+
+    def __init__(self, payloads: Iterable[dict] = ()):
+        self._queue = queue.Queue()
+        self.failed: List[dict] = []
+        for payload in payloads:
+            self.put(payload)
+
+    def put(self, payload: dict) -> None:
+        self._queue.put(payload)
+
+    def get(self, timeout: float) -> Optional[Job]:
+        try:
+            payload = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return Job(payload, lambda: None, lambda: self.failed.append(payload))
+
+
+class PubSubJobQueue:
+    """
+    Job queue on a Pub/Sub subscription, each message is the json of one job. Messages are streamed in with at most
+    max_outstanding unacknowledged at a time, the subscriber extends their leases while they are processed, and
+    nacked (failed) messages are redelivered.
+    """
+
+    def __init__(self, subscription: str, max_outstanding: int):
+        if pubsub_v1 is None:
+            raise Exception(
+                "google-cloud-pubsub is required for the Pub/Sub job queue - pip install google-cloud-pubsub"
+            )
+        self._jobs = queue.Queue()
+        self._subscriber = pubsub_v1.SubscriberClient()
+        self._streaming_pull = self._subscriber.subscribe(
+            subscription,
+            callback=self._on_message,
+            flow_control=pubsub_v1.types.FlowControl(max_messages=max_outstanding),
+        )
+        logging.info(f"Pulling jobs from {subscription}")
+
+    def get(self, timeout: float) -> Optional[Job]:
+        try:
+            return self._jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self) -> None:
+        self._streaming_pull.cancel()
+        self._subscriber.close()
+
+    def _on_message(self, message) -> None:
+        try:
+            payload = json.loads(message.data.decode("utf-8"))
+        except ValueError:
+            logging.exception(f"Dropping job message {message.message_id} that is not json")
+            message.ack()
+            return
+        self._jobs.put(Job(payload, message.ack, message.nack))
+
+
+def get_publisher():
+    """Process wide Pub/Sub PublisherClient, its gRPC channel and batching thread are shared by all publish_jobs calls"""
+    global _publisher
+    if pubsub_v1 is None:
+        raise Exception("google-cloud-pubsub is required for the Pub/Sub job queue - pip install google-cloud-pubsub")
+    if _publisher is None:
+        with _publisher_lock:
+            if _publisher is None:
+                _publisher = pubsub_v1.PublisherClient()
+    return _publisher
+
+
+def publish_jobs(topic: str, payloads: Iterable[dict]) -> int:
+    """Publishes job payloads to a Pub/Sub topic, returns the number of jobs published"""
+    publisher = get_publisher()
+    futures = [publisher.publish(topic, json.dumps(payload).encode()) for payload in payloads]
+    for future in futures:
+        future.result()
+    return len(futures)
+
+
+class WorkerStats(NamedTuple):
+    succeeded: int
+    failed: int
+    seconds: float
+
+
+class ReportWorker:
+    """
+    Runs jobs pulled from a job queue on `concurrency` threads of one long lived process, so the process wide
+    clients (HTTP sessions, access tokens, profile index, BigQuery clients, report definitions) are set up once and
+    reused by every job. A job is acked once process(payload) returns and nacked if it raises.
+    """
+
+    def __init__(self, job_queue, process: Callable[[dict], Optional[str]], concurrency: int):
+        self._job_queue = job_queue
+        self._process = process
+        self._concurrency = concurrency
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._succeeded = 0
+        self._failed = 0
+
+    def run(self, max_jobs: Optional[int] = None, idle_timeout: Optional[float] = None) -> WorkerStats:
+        """
+        Processes jobs until stop() is called, max_jobs were pulled, or no job arrived for idle_timeout seconds
+        (None waits forever). Waits for the jobs in progress before returning.
+        """
+        started_at = time.monotonic()
+        slots = threading.BoundedSemaphore(self._concurrency)
+        pulled = 0
+        idle_since = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=self._concurrency) as executor:
+            while not self._stop.is_set() and (max_jobs is None or pulled < max_jobs):
+                slots.acquire()
+                job = self._job_queue.get(timeout=1 if idle_timeout is None else min(1, idle_timeout))
+                if job is None:
+                    slots.release()
+                    if idle_timeout is not None and time.monotonic() - idle_since >= idle_timeout:
+                        break
+                    continue
+                pulled += 1
+                idle_since = time.monotonic()
+                executor.submit(contextvars.copy_context().run, self._run_job, job, slots)
+
+        stats = WorkerStats(self._succeeded, self._failed, time.monotonic() - started_at)
+        logging.info(
+            f"Worker processed {stats.succeeded + stats.failed} jobs ({stats.failed} failed) in {stats.seconds:.1f}s"
+        )
+        return stats
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run_job(self, job: Job, slots: threading.BoundedSemaphore) -> None:
+        try:
+            msg = self._process(job.payload)
+            if msg:
+                logging.info(msg)
+            job.ack()
+            with self._lock:
+                self._succeeded += 1
+        except Exception as e:
+            logging.exception(f"Job failed: {str(e)}")
+            job.nack()
+            with self._lock:
+                self._failed += 1
+        finally:
+            slots.release()
@@ -0,0 +1,72 @@
+"""
+Long running report worker: pulls report task payloads (the body of the report Cloud Tasks, published by the GET
+dispatcher with ?dispatch=worker) from a Pub/Sub subscription and processes them with a pool of concurrent workers
+in one process, so auth, profile listing, report definitions and BigQuery clients are set up once for hundreds of
+reports instead of once per Cloud Function invocation.
+
+Usage (from repo root, also the `report-worker` Procfile process):
+    python worker.py --subscription projects/<project>/subscriptions/<subscription> --concurrency 8
+"""
+
+import argparse
+import logging
+import signal
+import time
+
+import config
+from main import process_report_task
+from services.amz_advertising.report_cache import disk_report_cache
+from utils.metrics import start_metrics_server
+from utils.worker import PubSubJobQueue, ReportWorker
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subscription", default=config.WORKER_SUBSCRIPTION)
+    parser.add_argument("--concurrency", type=int, default=config.WORKER_CONCURRENCY)
+    parser.add_argument("--max-jobs", type=int, default=None)
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=config.WORKER_IDLE_TIMEOUT_SECONDS or None,
+        help="exit after this many seconds without jobs, runs until SIGTERM by default",
+    )
+    parser.add_argument(
+        "--report-cache-bytes",
+        type=int,
+        default=config.WORKER_REPORT_CACHE_MAX_BYTES,
+        help="size of the disk cache of downloaded reports, 0 disables it",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=config.METRICS_PORT,
+        help="serve OpenMetrics on this port, disabled by default",
+    )
+    args = parser.parse_args()
+    if not args.subscription:
+        raise Exception("No subscription - pass --subscription or set WORKER_SUBSCRIPTION")
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port)
+    # A worker's disk is not memory, retried and re-enqueued reports are read from it instead of from Amazon
+    disk_report_cache.max_bytes = args.report_cache_bytes
+
+    job_queue = PubSubJobQueue(args.subscription, max_outstanding=args.concurrency)
+    report_worker = ReportWorker(
+        job_queue,
+        # No function timeout here, reports are waited for instead of re-enqueued
+        lambda payload: process_report_task(payload, time.time() + config.WORKER_REPORT_DEADLINE_SECONDS),
+        concurrency=args.concurrency,
+    )
+    signal.signal(signal.SIGTERM, lambda signum, frame: report_worker.stop())
+    signal.signal(signal.SIGINT, lambda signum, frame: report_worker.stop())
+
+    try:
+        report_worker.run(max_jobs=args.max_jobs, idle_timeout=args.idle_timeout)
+    finally:
+        job_queue.close()
+
+
+if __name__ == "__main__":
+    logging.getLogger().setLevel(logging.INFO)
+    main()